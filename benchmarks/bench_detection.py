@@ -0,0 +1,79 @@
+""" Compare repository detection through `git status` and `git rev-parse` with
+    the filesystem walk of `find_repository`
+
+    Usage: python -m benchmarks.bench_detection [-n FILES] [--depth DEPTH]
+"""
+from __future__ import print_function, absolute_import
+
+import argparse
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+from rcs_latexdiff import rcs
+from rcs_latexdiff.utils import execute
+
+
+def make_repo(n_files, depth):
+    path = tempfile.mkdtemp(prefix='rcs-latexdiff-bench-')
+    subprocess.check_call(['git', 'init', '-q'], cwd=path)
+    for i in range(n_files):
+        directory = os.path.join(path, 'assets', str(i % 100))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(os.path.join(directory, 'figure%d.tex' % i), 'w') as f:
+            f.write("figure %d\n" % i)
+    document = os.path.join(path, *['part%d' % i for i in range(depth)])
+    os.makedirs(document)
+    with open(os.path.join(document, 'main.tex'), 'w') as f:
+        f.write("\\documentclass{article}\n")
+    subprocess.check_call(['git', 'add', '-A'], cwd=path)
+    subprocess.check_call(['git', '-c', 'user.name=bench', '-c', 'user.email=bench@example.com',
+                           'commit', '-q', '-m', 'bench'], cwd=path)
+    return path, document
+
+
+def status_detection(document):
+    # What get_rcs_class and get_relative_paths used to run
+    execute(['git', 'status'], document)
+    return execute(['git', 'rev-parse', '--show-toplevel'], document).text.strip()
+
+
+def walk_detection(document):
+    rcs._repositories.clear()
+    return rcs.find_repository(document)[1]
+
+
+def timed(function, document, repeat):
+    start = time.time()
+    for _ in range(repeat):
+        root = function(document)
+    return (time.time() - start) / repeat, root
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('-n', '--files', type=int, default=20000, help='Number of files in the working tree.')
+    parser.add_argument('--depth', type=int, default=5, help='Depth of the document in the working tree.')
+    parser.add_argument('--repeat', type=int, default=5, help='Number of detections to average.')
+    args = parser.parse_args()
+
+    path, document = make_repo(args.files, args.depth)
+    try:
+        status_time, status_root = timed(status_detection, document, args.repeat)
+        walk_time, walk_root = timed(walk_detection, document, args.repeat)
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+    assert os.path.realpath(status_root) == os.path.realpath(walk_root), "detected roots differ"
+
+    print("files: %d, depth: %d" % (args.files, args.depth))
+    print("git status + rev-parse:  %.4fs" % status_time)
+    print("filesystem walk:         %.4fs" % walk_time)
+    print("speed-up:                %.1fx" % (status_time / walk_time if walk_time else float('inf')))
+
+
+if __name__ == '__main__':
+    main()
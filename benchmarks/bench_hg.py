@@ -0,0 +1,60 @@
+""" Compare `hg cat` per file with the persistent Mercurial command server
+
+    Usage: python -m benchmarks.bench_hg [-n FILES] [--size BYTES]
+"""
+from __future__ import print_function, absolute_import
+
+import argparse
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+from rcs_latexdiff.rcs import Hg
+
+
+def make_repo(n_files, size):
+    path = tempfile.mkdtemp(prefix='rcs-latexdiff-bench-')
+    subprocess.check_call(['hg', 'init'], cwd=path)
+    line = "Lorem ipsum dolor sit amet, consectetur adipiscing elit.\n"
+    body = line * max(1, size // len(line))
+    for i in range(n_files):
+        with open(os.path.join(path, 'chapter%d.tex' % i), 'w') as f:
+            f.write("\\section{Chapter %d}\n%s" % (i, body))
+    subprocess.check_call(['hg', '--config', 'ui.username=bench <bench@example.com>',
+                           'commit', '-q', '-A', '-m', 'bench'], cwd=path)
+    return path
+
+
+def timed(repo, path, n_files):
+    start = time.time()
+    contents = [repo.show_file(path, '0', 'chapter%d.tex' % i) for i in range(n_files)]
+    elapsed = time.time() - start
+    repo.close()
+    return elapsed, contents
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('-n', '--files', type=int, default=50, help='Number of files to read.')
+    parser.add_argument('--size', type=int, default=4096, help='Size of each file in bytes.')
+    args = parser.parse_args()
+
+    path = make_repo(args.files, args.size)
+    try:
+        process_time, process_contents = timed(Hg(server=False), path, args.files)
+        server_time, server_contents = timed(Hg(server=True), path, args.files)
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+    assert process_contents == server_contents, "command server output differs from hg cat"
+
+    print("files: %d, size: %d bytes" % (args.files, args.size))
+    print("hg cat per file:      %.3fs" % process_time)
+    print("hg command server:    %.3fs" % server_time)
+    print("speed-up:             %.1fx" % (process_time / server_time if server_time else float('inf')))
+
+
+if __name__ == '__main__':
+    main()
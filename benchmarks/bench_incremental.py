@@ -0,0 +1,79 @@
+""" Compare a full latexdiff run with --incremental on a synthetic thesis
+    where a single chapter changed
+
+    Usage: python -m benchmarks.bench_incremental [--chapters N] [--paragraphs N]
+"""
+from __future__ import print_function, absolute_import
+
+import argparse
+import distutils.spawn
+import os
+import time
+
+from rcs_latexdiff.includes import unchanged_subtrees
+from rcs_latexdiff.rcs import Git
+from rcs_latexdiff.rcs_latexdiff import get_graph, make_diff, UNCHANGED_PLACEHOLDER
+
+from .synthetic import make_thesis_repo, remove_repo
+
+
+def latexdiff_input_size(path, incremental):
+    """ Return the size of the files given to latexdiff """
+    git = Git()
+    try:
+        old_graph = get_graph(git, path, '', 'HEAD~1', 'main.tex')
+        new_graph = get_graph(git, path, '', 'HEAD', 'main.tex')
+    finally:
+        git.close()
+
+    replacements = {}
+    if incremental:
+        unchanged = unchanged_subtrees(old_graph, new_graph)
+        replacements = dict((filename, UNCHANGED_PLACEHOLDER % i) for i, filename in enumerate(unchanged))
+
+    return len(old_graph.expand(replacements=replacements)) + len(new_graph.expand(replacements=replacements))
+
+
+def timed(path, incremental):
+    git = Git()
+    dst_filename = os.path.join(path, 'diff-%s.tex' % ('incremental' if incremental else 'full'))
+    try:
+        start = time.time()
+        make_diff(git, 'HEAD~1', 'HEAD', path, '', 'main.tex', dst_filename, '', incremental=incremental)
+        elapsed = time.time() - start
+    finally:
+        git.close()
+
+    with open(dst_filename, 'rb') as f:
+        diff = f.read()
+    return elapsed, diff
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--chapters', type=int, default=30, help='Number of chapters.')
+    parser.add_argument('--paragraphs', type=int, default=200, help='Number of paragraphs per chapter.')
+    args = parser.parse_args()
+
+    path = make_thesis_repo(args.chapters, args.paragraphs, changed=(args.chapters // 2,))
+    try:
+        print("chapters: %d, paragraphs per chapter: %d, 1 chapter changed" % (args.chapters, args.paragraphs))
+        print("latexdiff input, full:         %d bytes" % latexdiff_input_size(path, False))
+        print("latexdiff input, incremental:  %d bytes" % latexdiff_input_size(path, True))
+
+        if not distutils.spawn.find_executable('latexdiff'):
+            print("latexdiff not found in PATH, skipping the timings")
+            return
+
+        full_time, full_diff = timed(path, False)
+        incremental_time, incremental_diff = timed(path, True)
+        print("full:         %.3fs" % full_time)
+        print("incremental:  %.3fs" % incremental_time)
+        print("speed-up:     %.1fx" % (full_time / incremental_time if incremental_time else float('inf')))
+        print("identical output: %s" % (full_diff == incremental_diff))
+    finally:
+        remove_repo(path)
+
+
+if __name__ == '__main__':
+    main()
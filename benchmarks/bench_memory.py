@@ -0,0 +1,71 @@
+""" Compare the peak memory of flattening a large document into a string and
+    writing it (`IncludeGraph.expand`) with streaming it to disk
+    (`IncludeGraph.write`)
+
+    Usage: python -m benchmarks.bench_memory [--chapters N] [--paragraphs N]
+"""
+from __future__ import print_function, absolute_import
+
+import argparse
+import os
+import tempfile
+import tracemalloc
+
+from rcs_latexdiff.includes import IncludeGraph
+from rcs_latexdiff.rcs import Git
+from rcs_latexdiff.utils import write_file
+
+from .synthetic import make_thesis_repo, remove_repo
+
+
+def build_graph(git, path):
+    graph = IncludeGraph(git, path, '', 'HEAD')
+    graph.build('main.tex')
+    return graph
+
+
+def peak(function):
+    """ Return the peak of memory allocated while running `function` """
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--chapters', type=int, default=40, help='Number of chapters.')
+    parser.add_argument('--paragraphs', type=int, default=5000, help='Number of paragraphs per chapter.')
+    args = parser.parse_args()
+
+    path = make_thesis_repo(args.chapters, args.paragraphs)
+    git = Git()
+    output = tempfile.mktemp(prefix='rcs-latexdiff-bench-', suffix='.tex')
+    try:
+        graph = build_graph(git, path)
+        source_size = sum(len(segment) for node in graph.nodes.values()
+                          for segment in node.segments if not isinstance(segment, tuple))
+
+        string_peak = peak(lambda: write_file(build_graph(git, path).expand(), output))
+        string_size = os.path.getsize(output)
+        stream_peak = peak(lambda: build_graph(git, path).write(output))
+        stream_size = os.path.getsize(output)
+    finally:
+        git.close()
+        remove_repo(path)
+        if os.path.exists(output):
+            os.remove(output)
+
+    assert string_size == stream_size, "streamed document differs"
+
+    mb = 1024.0 * 1024.0
+    print("chapters: %d, paragraphs: %d" % (args.chapters, args.paragraphs))
+    print("flattened document:   %.1f MB (%.1f MB of sources)" % (stream_size / mb, source_size / mb))
+    print("expand + write_file:  %.1f MB peak" % (string_peak / mb))
+    print("write (streaming):    %.1f MB peak" % (stream_peak / mb))
+
+
+if __name__ == '__main__':
+    main()
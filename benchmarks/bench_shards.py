@@ -0,0 +1,73 @@
+""" Compare latexdiff on a whole single-file document with --shard
+
+    Usage: python -m benchmarks.bench_shards [--sections N] [--paragraphs N] [-j N]
+"""
+from __future__ import print_function, absolute_import
+
+import argparse
+import distutils.spawn
+import os
+import shutil
+import tempfile
+import time
+
+from rcs_latexdiff.rcs_latexdiff import exec_diff, exec_sharded_diff
+from rcs_latexdiff.utils import write_file
+
+from .synthetic import PARAGRAPH
+
+
+def document(sections, paragraphs, revision):
+    body = ["\\documentclass{article}", "\\begin{document}"]
+    for i in range(sections):
+        body.append("\\section{Section %d}" % i)
+        for j in range(paragraphs):
+            text = PARAGRAPH
+            if revision and j % 7 == i % 7:
+                text = text.replace("dolor", "dolores")
+            body.append(text)
+    body += ["\\end{document}", ""]
+    return "\n".join(body)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--sections', type=int, default=40, help='Number of sections.')
+    parser.add_argument('--paragraphs', type=int, default=50, help='Number of paragraphs per section.')
+    parser.add_argument('-j', '--jobs', type=int, default=4, help='Number of latexdiff processes.')
+    args = parser.parse_args()
+
+    if not distutils.spawn.find_executable('latexdiff'):
+        print("latexdiff not found in PATH")
+        return
+
+    old_content = document(args.sections, args.paragraphs, 0)
+    new_content = document(args.sections, args.paragraphs, 1)
+
+    path = tempfile.mkdtemp(prefix='rcs-latexdiff-bench-')
+    try:
+        old_filename, new_filename = os.path.join(path, 'old.tex'), os.path.join(path, 'new.tex')
+        write_file(old_content, old_filename)
+        write_file(new_content, new_filename)
+
+        start = time.time()
+        exec_diff(old_filename, new_filename, os.path.join(path, 'full.tex'), '')
+        full_time = time.time() - start
+
+        start = time.time()
+        exec_sharded_diff(old_content, new_content, os.path.join(path, 'sharded.tex'), '', args.jobs)
+        sharded_time = time.time() - start
+
+        with open(os.path.join(path, 'full.tex'), 'rb') as f, open(os.path.join(path, 'sharded.tex'), 'rb') as g:
+            identical = f.read() == g.read()
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+    print("sections: %d, paragraphs per section: %d, %d bytes" % (args.sections, args.paragraphs, len(new_content)))
+    print("whole document:      %.3fs" % full_time)
+    print("sharded (-j %d):      %.3fs" % (args.jobs, sharded_time))
+    print("identical output: %s" % identical)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+""" Compare `git show` per file with the persistent `git cat-file --batch` reader
+    and the native object reader
+
+    Usage: python -m benchmarks.bench_show_file [-n FILES] [--size BYTES]
+"""
+from __future__ import print_function, absolute_import
+
+import argparse
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+from rcs_latexdiff.rcs import Git
+
+
+def make_repo(n_files, size):
+    path = tempfile.mkdtemp(prefix='rcs-latexdiff-bench-')
+    subprocess.check_call(['git', 'init', '-q'], cwd=path)
+    line = "Lorem ipsum dolor sit amet, consectetur adipiscing elit.\n"
+    body = line * max(1, size // len(line))
+    for i in range(n_files):
+        with open(os.path.join(path, 'chapter%d.tex' % i), 'w') as f:
+            f.write("\\section{Chapter %d}\n%s" % (i, body))
+    subprocess.check_call(['git', 'add', '-A'], cwd=path)
+    subprocess.check_call(['git', '-c', 'user.name=bench', '-c', 'user.email=bench@example.com',
+                           'commit', '-q', '-m', 'bench'], cwd=path)
+    return path
+
+
+def timed(git, path, n_files):
+    start = time.time()
+    contents = [git.show_file(path, 'HEAD', 'chapter%d.tex' % i) for i in range(n_files)]
+    elapsed = time.time() - start
+    git.close()
+    return elapsed, contents
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('-n', '--files', type=int, default=150, help='Number of files to read.')
+    parser.add_argument('--size', type=int, default=4096, help='Size of each file in bytes.')
+    args = parser.parse_args()
+
+    path = make_repo(args.files, args.size)
+    try:
+        process_time, process_contents = timed(Git(batch=False), path, args.files)
+        batch_time, batch_contents = timed(Git(batch=True, native=False), path, args.files)
+        subprocess.check_call(['git', 'gc', '-q'], cwd=path)
+        native_time, native_contents = timed(Git(batch=True), path, args.files)
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+    assert process_contents == batch_contents, "batch reader output differs from git show"
+    assert process_contents == native_contents, "native reader output differs from git show"
+
+    print("files: %d, size: %d bytes" % (args.files, args.size))
+    print("git show per file:     %.3fs" % process_time)
+    print("git cat-file --batch:  %.3fs" % batch_time)
+    print("native (packed):       %.3fs" % native_time)
+    print("speed-up:              %.1fx (batch), %.1fx (native)" % (
+        process_time / batch_time if batch_time else float('inf'),
+        process_time / native_time if native_time else float('inf')))
+
+
+if __name__ == '__main__':
+    main()
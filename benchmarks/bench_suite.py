@@ -0,0 +1,194 @@
+""" Time the main stages of rcs-latexdiff on a synthetic document, in git and
+    (if svn is installed) in a file:// SVN repository, and write the results as
+    JSON to compare versions
+
+    Stages: comment stripping (remove_latex_comments and scan_latex), RCS
+    fetches (show_file of every file), flattening (get_file) and the
+    end-to-end make_diff of the last two commits. latexdiff is replaced by a
+    copy of the new document when it is not installed (see "latexdiff" in the
+    results).
+
+    Usage: python -m benchmarks.bench_suite [--includes N] [--depth N]
+        [--paragraphs N] [--commits N] [--changed FRACTION] [--repeat N]
+        [--rcs git,svn] [-o results.json]
+
+    Compare two result files with --compare OLD.json NEW.json.
+"""
+from __future__ import print_function, absolute_import
+
+import argparse
+import distutils.spawn
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from rcs_latexdiff import rcs_latexdiff
+from rcs_latexdiff.rcs import Git, SVN
+from rcs_latexdiff.utils import remove_latex_comments, scan_latex
+
+from .synthetic import document_revisions, make_git_document_repo, make_svn_document_repo, remove_repo
+
+
+def measure(function, repeat):
+    """ Run `function` `repeat` times
+
+        :return: dict of the shortest, median and longest durations (in seconds)
+    """
+    durations = []
+    for i in range(repeat):
+        start = time.time()
+        function()
+        durations.append(time.time() - start)
+    durations.sort()
+    return {'min': durations[0], 'median': durations[len(durations) // 2], 'max': durations[-1], 'runs': repeat}
+
+
+def copy_diff(old_filename, new_filename, diff_filename, latexdiff_args):
+    """ Stands for latexdiff when it is not installed """
+    shutil.copyfile(new_filename, diff_filename)
+
+
+def bench_comments(files, repeat):
+    contents = list(files.values())
+    return {
+        'remove_latex_comments': measure(lambda: [remove_latex_comments(content) for content in contents], repeat),
+        'scan_latex': measure(lambda: [scan_latex(content) for content in contents], repeat),
+    }
+
+
+def bench_rcs(rcs_class, path, commits, filenames, repeat):
+    """ Time the stages reading a repository
+
+        :param rcs_class: RCS class to instantiate (fresh for each run, so
+            that no process or store is kept warm between runs)
+        :param commits: old and new commit
+    """
+    old, new = commits
+    output = tempfile.mkdtemp(prefix='rcs-latexdiff-bench-')
+
+    def fresh(function):
+        def run():
+            rcs = rcs_class()
+            try:
+                function(rcs)
+            finally:
+                rcs.close()
+        return run
+
+    def diff(rcs):
+        rcs_latexdiff.make_diff(rcs, old, new, path, '', 'main.tex', os.path.join(output, 'diff.tex'), '')
+
+    try:
+        return {
+            'show_file': measure(fresh(lambda rcs: [rcs.show_file(path, new, name) for name in filenames]), repeat),
+            'get_file': measure(fresh(lambda rcs: rcs_latexdiff.get_file(rcs, path, '', new, 'main.tex')), repeat),
+            'make_diff': measure(fresh(diff), repeat),
+        }
+    finally:
+        shutil.rmtree(output, ignore_errors=True)
+
+
+def run_suite(args):
+    revisions = document_revisions(args.includes, args.depth, args.paragraphs, args.commits, args.changed)
+    files = revisions[0]
+    results = {'comments': bench_comments(files, args.repeat)}
+
+    if 'git' in args.rcs:
+        path = make_git_document_repo(revisions)
+        try:
+            results['git'] = bench_rcs(Git, path, ('HEAD~1', 'HEAD'), sorted(files), args.repeat)
+        finally:
+            remove_repo(path)
+
+    if 'svn' in args.rcs:
+        if not distutils.spawn.find_executable('svn'):
+            print("svn not found in PATH, skipping the SVN benchmarks", file=sys.stderr)
+        else:
+            path, working_copy = make_svn_document_repo(revisions)
+            try:
+                commits = (str(args.commits - 1), str(args.commits))
+                results['svn'] = bench_rcs(SVN, working_copy, commits, sorted(files), args.repeat)
+            finally:
+                remove_repo(path)
+
+    return results
+
+
+def print_results(results):
+    for group in sorted(results):
+        for stage, timing in sorted(results[group].items()):
+            print("%-8s %-22s min %8.4fs  median %8.4fs" % (group, stage, timing['min'], timing['median']))
+
+
+def compare(old_filename, new_filename):
+    """ Print the change of the median durations between two result files """
+    with open(old_filename) as f:
+        old = json.load(f)
+    with open(new_filename) as f:
+        new = json.load(f)
+
+    if old['parameters'] != new['parameters']:
+        print("Warning: the results were measured with different parameters", file=sys.stderr)
+    for group in sorted(new['results']):
+        for stage, timing in sorted(new['results'][group].items()):
+            before = old['results'].get(group, {}).get(stage)
+            if before is None:
+                continue
+            ratio = timing['median'] / before['median'] if before['median'] else float('inf')
+            print("%-8s %-22s %8.4fs -> %8.4fs  (%.2fx)" % (group, stage, before['median'], timing['median'], ratio))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--includes', type=int, default=50, help='Number of included files.')
+    parser.add_argument('--depth', type=int, default=3, help='Nesting depth of the includes.')
+    parser.add_argument('--paragraphs', type=int, default=100, help='Number of paragraphs per included file.')
+    parser.add_argument('--commits', type=int, default=5, help='Number of commits.')
+    parser.add_argument('--changed', type=float, default=0.1,
+        help='Fraction of the included files modified by each commit.')
+    parser.add_argument('--repeat', type=int, default=5, help='Number of runs of each stage.')
+    parser.add_argument('--rcs', default='git,svn', help='Comma separated list of RCS to benchmark.')
+    parser.add_argument('-o', '--output', help='Write the results as JSON into this file.')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+        help='Compare two result files instead of running the benchmarks.')
+    args = parser.parse_args()
+
+    if args.compare:
+        return compare(*args.compare)
+
+    args.commits = max(2, args.commits)
+    args.rcs = args.rcs.split(',')
+    has_latexdiff = bool(distutils.spawn.find_executable('latexdiff'))
+    if has_latexdiff:
+        results = run_suite(args)
+    else:
+        with mock.patch.object(rcs_latexdiff, 'exec_diff', side_effect=copy_diff):
+            results = run_suite(args)
+
+    print_results(results)
+    if args.output:
+        report = {
+            'parameters': dict((name, getattr(args, name)) for name in
+                               ['includes', 'depth', 'paragraphs', 'commits', 'changed', 'repeat']),
+            'latexdiff': 'installed' if has_latexdiff else 'stub',
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'results': results,
+        }
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        print("Results written to %s" % args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+""" Generation of synthetic LaTeX documents in throwaway repositories """
+from __future__ import print_function, absolute_import
+
+import os
+import random
+import shutil
+import subprocess
+import tempfile
+
+PARAGRAPH = ("Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do "
+             "eiusmod tempor incididunt ut labore et dolore magna aliqua. % a comment\n")
+
+
+def git(path, *args):
+    subprocess.check_call(['git', '-c', 'user.name=bench', '-c', 'user.email=bench@example.com'] + list(args),
+                          cwd=path)
+
+
+def thesis_files(chapters, paragraphs, revision=0, changed=()):
+    """ Return the files of a thesis: main.tex including one file per chapter
+
+        :param chapters: number of chapters
+        :param paragraphs: number of paragraphs per chapter
+        :param revision: revision number, written into the changed chapters
+        :param changed: indexes of the chapters modified by this revision
+    """
+    main = ["\\documentclass{report}", "\\begin{document}"]
+    main += ["\\input{chapter%d.tex}" % i for i in range(chapters)]
+    main += ["\\end{document}", ""]
+    files = {'main.tex': "\n".join(main)}
+
+    for i in range(chapters):
+        body = ["\\chapter{Chapter %d}" % i]
+        for j in range(paragraphs):
+            text = PARAGRAPH
+            if i in changed and j % 10 == 0:
+                text = text.replace("Lorem", "Revision %d of" % revision)
+            body.append(text)
+        files['chapter%d.tex' % i] = "\n".join(body)
+
+    return files
+
+
+def make_thesis_repo(chapters=20, paragraphs=100, changed=(0,)):
+    """ Create a git repository with two commits of a thesis, the second one
+        modifying the chapters in `changed`
+
+        :return: path of the repository
+    """
+    path = tempfile.mkdtemp(prefix='rcs-latexdiff-bench-')
+    git(path, 'init', '-q')
+    for revision, changed_chapters in enumerate([(), changed]):
+        for filename, content in thesis_files(chapters, paragraphs, revision, changed_chapters).items():
+            with open(os.path.join(path, filename), 'w') as f:
+                f.write(content)
+        git(path, 'add', '-A')
+        git(path, 'commit', '-q', '-m', 'revision %d' % revision)
+    return path
+
+
+def document_files(includes, depth, paragraphs, revision=0, changed=()):
+    """ Return the files of a document: main.tex and `includes` included files,
+        nested `depth` levels deep (main.tex includes section0.tex, which
+        includes section1.tex, and so on until the depth is reached)
+
+        :param includes: number of included files
+        :param depth: nesting depth of the includes
+        :param paragraphs: number of paragraphs per included file
+        :param revision: revision number, written into the changed files
+        :param changed: indexes of the included files modified by this revision
+    """
+    depth = max(1, depth)
+    children = dict((i, []) for i in range(-1, includes))
+    for i in range(includes):
+        children[-1 if i % depth == 0 else i - 1].append(i)
+
+    def inputs(parent):
+        return ["\\input{section%d.tex}" % i for i in children[parent]]
+
+    main = ["\\documentclass{report}", "\\begin{document}"] + inputs(-1) + ["\\end{document}", ""]
+    files = {'main.tex': "\n".join(main)}
+
+    for i in range(includes):
+        body = ["\\section{Section %d}" % i]
+        for j in range(paragraphs):
+            text = PARAGRAPH
+            if i in changed and j % 10 == 0:
+                text = text.replace("Lorem", "Revision %d of" % revision)
+            body.append(text)
+        files['section%d.tex' % i] = "\n".join(body + inputs(i))
+
+    return files
+
+
+def document_revisions(includes, depth, paragraphs, commits, changed_fraction, seed=0):
+    """ Return the files of each commit of a document (see `document_files`),
+        every commit after the first one modifying a fraction of the included
+        files chosen at random
+
+        :param commits: number of commits
+        :param changed_fraction: fraction of the included files modified by
+            each commit
+        :return: a list of dicts {filename: content}, the first one holding
+            every file and the others the files modified by the commit
+    """
+    rng = random.Random(seed)
+    count = min(includes, max(1, int(round(changed_fraction * includes))))
+    previous = document_files(includes, depth, paragraphs)
+    revisions = [previous]
+    for revision in range(1, commits):
+        changed = rng.sample(range(includes), count) if includes else ()
+        files = document_files(includes, depth, paragraphs, revision, changed)
+        # Only the modified files are written by a commit
+        revisions.append(dict((name, content) for name, content in files.items() if content != previous[name]))
+        previous = files
+    return revisions
+
+
+def write_revision(path, files):
+    for filename, content in files.items():
+        with open(os.path.join(path, filename), 'w') as f:
+            f.write(content)
+
+
+def make_git_document_repo(revisions):
+    """ Create a git repository with one commit per revision
+
+        :param revisions: files of each commit (see `document_revisions`)
+        :return: path of the repository
+    """
+    path = tempfile.mkdtemp(prefix='rcs-latexdiff-bench-')
+    git(path, 'init', '-q')
+    for revision, files in enumerate(revisions):
+        write_revision(path, files)
+        git(path, 'add', '-A')
+        git(path, 'commit', '-q', '-m', 'revision %d' % revision)
+    return path
+
+
+def make_svn_document_repo(revisions):
+    """ Create a file:// SVN repository with one commit per revision, and a
+        working copy of it
+
+        :param revisions: files of each commit (see `document_revisions`)
+        :return: path of the directory holding both, and path of the working copy
+    """
+    path = tempfile.mkdtemp(prefix='rcs-latexdiff-bench-')
+    repository = os.path.join(path, 'repository')
+    working_copy = os.path.join(path, 'wc')
+    subprocess.check_call(['svnadmin', 'create', repository])
+    subprocess.check_call(['svn', 'checkout', '-q', 'file://' + repository, working_copy])
+    for revision, files in enumerate(revisions):
+        write_revision(working_copy, files)
+        subprocess.check_call(['svn', 'add', '-q', '--force', '.'], cwd=working_copy)
+        subprocess.check_call(['svn', 'commit', '-q', '-m', 'revision %d' % revision], cwd=working_copy)
+    subprocess.check_call(['svn', 'update', '-q'], cwd=working_copy)
+    return path, working_copy
+
+
+def remove_repo(path):
+    shutil.rmtree(path, ignore_errors=True)
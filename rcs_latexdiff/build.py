@@ -0,0 +1,286 @@
+from __future__ import print_function, absolute_import
+
+import os
+import re
+import shutil
+import hashlib
+import logging
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from .profile import Span
+
+logger = logging.getLogger("rcs-latexdiff")
+
+# Search paths of TeX, BibTeX and BibTeX styles
+_SEARCH_PATHS = ['TEXINPUTS', 'BIBINPUTS', 'BSTINPUTS']
+
+
+def source_paths(src_path):
+    """ Return the directories of the sources as a list
+
+        :param src_path: a directory, or a list of directories
+    """
+    return list(src_path) if isinstance(src_path, (list, tuple)) else [src_path]
+
+
+def search_path_env(src_path, env=None):
+    """ Return an environment in which TeX and BibTeX find the files of the
+        sources (figures, styles, bibliographies...) from another directory
+
+        :param src_path: directory of the sources, or list of directories,
+            searched first
+        :param env: environment to extend (default: the current one)
+    """
+    env = dict(os.environ if env is None else env)
+    paths = [os.path.abspath(path) for path in source_paths(src_path)]
+    for name in _SEARCH_PATHS:
+        # An empty entry (e.g. "src:") stands for the default search path
+        env[name] = os.pathsep.join(paths + [env.get(name, '')])
+    return env
+
+
+# Files written by pdflatex which the next pass reads: once they are the same
+# after two passes, cross-references have been sorted out
+_AUXILIARY_EXTENSIONS = ('.aux', '.toc', '.lof', '.lot', '.bbl', '.out', '.nav', '.snm')
+
+_BIBTEX_COMMAND = re.compile(br'^\\(citation|bibdata|bibstyle)\{(.*)\}\s*$', re.MULTILINE)
+
+
+def _digest(filename):
+    try:
+        with open(filename, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+    except (IOError, OSError):
+        return None
+
+
+def auxiliary_state(build_path):
+    """ Return the hashes of the auxiliary files of a build, which change as
+        long as another pdflatex pass is needed
+
+        :return: dict {file name: SHA1}
+    """
+    return dict((name, _digest(os.path.join(build_path, name)))
+                for name in sorted(os.listdir(build_path))
+                if os.path.splitext(name)[1] in _AUXILIARY_EXTENSIONS)
+
+
+def _find_source(src_path, filename):
+    for path in source_paths(src_path):
+        if os.path.isfile(os.path.join(path, filename)):
+            return os.path.join(path, filename)
+    return None
+
+
+def bibtex_state(build_path, src_path):
+    """ Return a hash of what the output of bibtex depends on: the citations,
+        the bibliography databases and style named in the .aux files, and the
+        content of the databases
+
+        :return: the hash, or `None` if the document has no bibliography
+    """
+    commands = []
+    for name in sorted(os.listdir(build_path)):
+        if name.endswith('.aux'):
+            with open(os.path.join(build_path, name), 'rb') as f:
+                commands += [match.group(0).strip() for match in _BIBTEX_COMMAND.finditer(f.read())]
+
+    databases = [match.group(2) for match in map(_BIBTEX_COMMAND.match, commands) if match.group(1) == b'bibdata']
+    if not databases:
+        return None
+
+    state = hashlib.sha1(b'\n'.join(commands))
+    for database in b','.join(databases).split(b','):
+        database = database.decode('utf-8', 'replace').strip()
+        if not database.endswith('.bib'):
+            database += '.bib'
+        filename = _find_source(src_path, database)
+        state.update(b'\0' + ((_digest(filename) if filename else None) or '-').encode('ascii'))
+    return state.hexdigest()
+
+
+# Lines of the output of TeX after which a compilation cannot produce a
+# usable pdf, whatever the number of passes
+_FATAL_ERROR = re.compile(br'^(?:! Emergency stop|!\s*==> Fatal error|! TeX capacity exceeded|Runaway argument\?'
+                          br'|! File ended while scanning)')
+
+
+def fatal_error(line):
+    """ Return the error reported by a line of the output of TeX if it is
+        fatal (see `execute_watched`), or `None`
+    """
+    if _FATAL_ERROR.match(line):
+        return line.decode('utf-8', 'replace').strip()
+    return None
+
+
+class CompileError(Exception):
+    """ A compiler stopped on a fatal error
+
+        :param stage: the stage which failed (e.g. "pdflatex pass 2")
+        :param reason: the line reporting the error
+        :param duration: how long the stage ran, in seconds
+    """
+
+    def __init__(self, stage, reason, duration):
+        self.stage = stage
+        self.reason = reason
+        self.duration = duration
+        super(CompileError, self).__init__("%s stopped after %.1fs: %s" % (stage, duration, reason))
+
+
+class AssetStore(object):
+    """ Content-addressed store of the files needed to compile the diffs
+        (figures, bibliographies...), hard linked into asset trees
+
+        Each distinct content is written once, however many revisions and
+        diffs use it. The store lives in the cache directory, so that its
+        entries are counted and evicted with the other entries of the cache
+        (the asset trees, in dot directories, are not).
+
+        :param path: directory of the store (default: a new temporary
+            directory, removed by `cleanup`)
+    """
+
+    def __init__(self, path=None):
+        self.temporary = path is None
+        self.path = tempfile.mkdtemp(prefix='rcs-latexdiff-assets-') if path is None else path
+
+    def add(self, content):
+        """ Store a content, unless it is already stored
+
+            :param content: bytes
+            :return: the name of the stored file
+        """
+        digest = hashlib.sha1(content).hexdigest()
+        filename = os.path.join(self.path, digest[:2], digest)
+        if os.path.isfile(filename):
+            # Mark the entry as recently used
+            os.utime(filename, None)
+            return filename
+
+        dirname = os.path.dirname(filename)
+        if not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                if not os.path.isdir(dirname):
+                    raise
+
+        # Write to a temporary file first so that readers never see partial entries
+        fd, tmp_filename = tempfile.mkstemp(dir=dirname, prefix='.tmp-')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+        os.rename(tmp_filename, filename)
+        return filename
+
+    def tree(self):
+        """ Return a new directory to materialize assets into, on the same
+            file system as the store
+        """
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        return tempfile.mkdtemp(dir=self.path, prefix='.tree-')
+
+    def materialize(self, blobs, directory):
+        """ Write files into a directory through the store, as hard links
+            (or copies, where hard links are not supported)
+
+            :param blobs: dict {filename relative to `directory`: bytes}
+            :return: the number of files written
+        """
+        for name, content in blobs.items():
+            entry = self.add(content)
+            filename = os.path.join(directory, name)
+            if not os.path.isdir(os.path.dirname(filename)):
+                os.makedirs(os.path.dirname(filename))
+            if os.path.lexists(filename):
+                os.remove(filename)
+            try:
+                os.link(entry, filename)
+            except (OSError, AttributeError):
+                shutil.copyfile(entry, filename)
+        return len(blobs)
+
+    def cleanup(self):
+        """ Remove the store if it is temporary """
+        if self.temporary:
+            shutil.rmtree(self.path, ignore_errors=True)
+
+
+class BuildDirectory(object):
+    """ Directory in which a diff is compiled, so that the auxiliary files of
+        concurrent builds never collide nor land next to the sources
+
+        :param path: directory to use, kept by `cleanup` (default: a new
+            temporary directory, removed by `cleanup`)
+    """
+
+    def __init__(self, path=None):
+        self.temporary = path is None
+        self.path = tempfile.mkdtemp(prefix='rcs-latexdiff-build-') if path is None else path
+
+    def collect(self, tex_filename, everything=False):
+        """ Copy the pdf built for `tex_filename` next to it
+
+            :param everything: copy all the files of the build (.aux, .log...)
+            :return: the names of the copied files
+        """
+        dst_path = os.path.dirname(os.path.abspath(tex_filename))
+        jobname = os.path.splitext(os.path.basename(tex_filename))[0]
+        names = os.listdir(self.path) if everything else [jobname + '.pdf']
+
+        copied = []
+        for name in names:
+            filename = os.path.join(self.path, name)
+            if os.path.isfile(filename):
+                shutil.copyfile(filename, os.path.join(dst_path, name))
+                copied.append(os.path.join(dst_path, name))
+        return copied
+
+    def cleanup(self):
+        """ Remove the directory if it is temporary """
+        if self.temporary:
+            with Span('build directory', 'cleanup', path=self.path):
+                shutil.rmtree(self.path, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.cleanup()
+
+
+class CompileScheduler(object):
+    """ Run compilations in parallel, each one in its own build directory
+
+        :param exec_fcn: compile function (`exec_latexmk` or `exec_pdflatex`)
+        :param workers: number of compilations run at once
+    """
+
+    def __init__(self, exec_fcn, workers=1):
+        self.exec_fcn = exec_fcn
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    def submit(self, tex_filename, src_path, repeat=1, keep=False):
+        """ Compile a diff file
+
+            :param keep: keep the auxiliary files next to the diff file
+            :return: a Future of the name of the pdf (`None` if not built)
+        """
+        return self.executor.submit(self._compile, tex_filename, src_path, repeat, keep)
+
+    def _compile(self, tex_filename, src_path, repeat, keep):
+        pdf_filename = self.exec_fcn(tex_filename, src_path, repeat=repeat, keep=keep)
+        return pdf_filename if os.path.isfile(pdf_filename) else None
+
+    def shutdown(self, wait=True):
+        """ Wait for the running compilations """
+        self.executor.shutdown(wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
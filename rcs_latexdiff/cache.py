@@ -0,0 +1,244 @@
+from __future__ import print_function, absolute_import
+
+import os
+import errno
+import hashlib
+import logging
+import shutil
+import tempfile
+import threading
+
+logger = logging.getLogger("rcs-latexdiff.cache")
+
+# Default upper bound of the on-disk cache
+DEFAULT_MAX_SIZE = 512 * 1024 * 1024
+
+
+def default_cache_dir():
+    """ Return the default location of the cache ($XDG_CACHE_HOME/rcs-latexdiff) """
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'rcs-latexdiff')
+
+
+def make_key(*parts):
+    """ Build a cache key out of several strings """
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part.encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+class Cache(object):
+    """ Content-addressed on-disk cache with a size-bounded LRU eviction
+
+        Entries are grouped in namespaces (e.g. "file", "expanded") and stored
+        as one file each. Reading an entry refreshes its modification time,
+        which is used to evict the least recently used entries first.
+
+        :param path: directory of the cache (default: `default_cache_dir()`)
+        :param max_size: maximum size of the cache in bytes
+    """
+
+    def __init__(self, path=None, max_size=DEFAULT_MAX_SIZE):
+        self.path = path or default_cache_dir()
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+    def _entry_path(self, namespace, key):
+        digest = make_key(key)
+        return os.path.join(self.path, namespace, digest[:2], digest)
+
+    def get(self, namespace, key):
+        """ Return the content stored for a key, or `None` """
+        filename = self._entry_path(namespace, key)
+        try:
+            with open(filename, 'rb') as f:
+                content = f.read().decode('utf-8')
+        except (IOError, OSError):
+            self.misses += 1
+            return None
+
+        # Mark the entry as recently used
+        try:
+            os.utime(filename, None)
+        except OSError:
+            pass
+
+        self.hits += 1
+        return content
+
+    def put(self, namespace, key, content):
+        """ Store the content of a key """
+        filename = self._entry_path(namespace, key)
+        dirname = os.path.dirname(filename)
+        try:
+            os.makedirs(dirname)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                logger.debug("Could not create cache directory %s: %s" % (dirname, e))
+                return
+
+        # Write to a temporary file first so that readers never see partial entries
+        try:
+            fd, tmp_filename = tempfile.mkstemp(dir=dirname, prefix='.tmp-')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(content.encode('utf-8'))
+            os.rename(tmp_filename, filename)
+        except (IOError, OSError) as e:
+            logger.debug("Could not write cache entry %s: %s" % (filename, e))
+
+    def get_file(self, namespace, key, filename):
+        """ Copy the file stored for a key to `filename`
+
+            :return: True if the key has been found
+        """
+        entry = self._entry_path(namespace, key)
+        try:
+            shutil.copyfile(entry, filename)
+            os.utime(entry, None)
+        except (IOError, OSError):
+            self.misses += 1
+            return False
+
+        self.hits += 1
+        return True
+
+    def put_file(self, namespace, key, filename):
+        """ Store a copy of a file for a key """
+        entry = self._entry_path(namespace, key)
+        dirname = os.path.dirname(entry)
+        try:
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            fd, tmp_filename = tempfile.mkstemp(dir=dirname, prefix='.tmp-')
+            os.close(fd)
+            shutil.copyfile(filename, tmp_filename)
+            os.rename(tmp_filename, entry)
+        except (IOError, OSError) as e:
+            logger.debug("Could not store %s in the cache: %s" % (filename, e))
+
+    def entries(self):
+        """ Return all entries as (mtime, size, filename) tuples """
+        entries = []
+        for dirpath, dirnames, filenames in os.walk(self.path):
+            # Dot directories are not entries (e.g. the asset trees of the
+            # "blob" store, see `AssetStore`)
+            dirnames[:] = [name for name in dirnames if not name.startswith('.')]
+            for filename in filenames:
+                filename = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(filename)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, filename))
+        return entries
+
+    def stats(self):
+        """ Return statistics about the cache
+
+            :return: a dict with the path, the number of entries and the size
+                of the cache, plus the size and the number of entries of each
+                namespace
+        """
+        namespaces = {}
+        for mtime, size, filename in self.entries():
+            namespace = os.path.relpath(filename, self.path).split(os.sep)[0]
+            count, total = namespaces.get(namespace, (0, 0))
+            namespaces[namespace] = (count + 1, total + size)
+
+        return {
+            'path': self.path,
+            'max_size': self.max_size,
+            'entries': sum(count for count, total in namespaces.values()),
+            'size': sum(total for count, total in namespaces.values()),
+            'namespaces': namespaces,
+        }
+
+    def prune(self, max_size=None):
+        """ Evict the least recently used entries until the cache fits in `max_size`
+
+            :param max_size: size to reach (default: the size of the cache)
+            :return: number of removed entries and number of freed bytes
+        """
+        if max_size is None:
+            max_size = self.max_size
+
+        entries = sorted(self.entries())
+        size = sum(entry[1] for entry in entries)
+        removed, freed = 0, 0
+        for mtime, entry_size, filename in entries:
+            if size <= max_size:
+                break
+            try:
+                os.remove(filename)
+            except OSError:
+                continue
+            size -= entry_size
+            removed += 1
+            freed += entry_size
+
+        if removed:
+            logger.info("Evicted %d cache entries (%d bytes)" % (removed, freed))
+        return removed, freed
+
+
+class MemoryCache(object):
+    """ In-memory stand-in for `Cache`, for entries only worth keeping while
+        the process runs (e.g. working copy files in watch mode), or in front
+        of an on-disk cache to keep its entries warm (e.g. in the daemon)
+
+        :param max_entries: number of entries above which the cache is emptied
+        :param backend: if given, Cache instance looked up on misses and
+            written through; files are only stored in the backend
+    """
+
+    def __init__(self, max_entries=10000, backend=None):
+        self.max_entries = max_entries
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, namespace, key):
+        """ Return the content stored for a key, or `None` """
+        content = self._entries.get((namespace, key))
+        if content is not None:
+            self.hits += 1
+            return content
+
+        self.misses += 1
+        if self.backend is not None:
+            content = self.backend.get(namespace, key)
+            if content is not None:
+                self._store(namespace, key, content)
+        return content
+
+    def put(self, namespace, key, content):
+        """ Store the content of a key """
+        self._store(namespace, key, content)
+        if self.backend is not None:
+            self.backend.put(namespace, key, content)
+
+    def _store(self, namespace, key, content):
+        with self._lock:
+            if len(self._entries) >= self.max_entries:
+                self._entries = {}
+            self._entries[(namespace, key)] = content
+
+    def get_file(self, namespace, key, filename):
+        """ See `Cache.get_file` """
+        return self.backend is not None and self.backend.get_file(namespace, key, filename)
+
+    def put_file(self, namespace, key, filename):
+        """ See `Cache.put_file` """
+        if self.backend is not None:
+            self.backend.put_file(namespace, key, filename)
+
+    def prune(self, max_size=None):
+        """ See `Cache.prune` """
+        if self.backend is None:
+            return 0, 0
+        return self.backend.prune(max_size)
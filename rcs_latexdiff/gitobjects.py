@@ -0,0 +1,458 @@
+from __future__ import print_function, absolute_import
+
+import os
+import re
+import glob
+import mmap
+import zlib
+import struct
+import logging
+import binascii
+import threading
+
+logger = logging.getLogger("rcs-latexdiff")
+
+# Types of the objects, as numbered in packfiles
+_OBJECT_TYPES = {1: 'commit', 2: 'tree', 3: 'blob', 4: 'tag'}
+_OFS_DELTA = 6
+_REF_DELTA = 7
+
+# Type of the objects referenced by a tree, from their mode
+_MODE_TYPES = {b'40000': 'tree', b'160000': 'commit'}
+
+_SHA1 = re.compile(r'^[0-9a-f]{40}$')
+
+# Environment variables which change where git looks for objects
+_GIT_ENVIRONMENT = ['GIT_DIR', 'GIT_OBJECT_DIRECTORY', 'GIT_ALTERNATE_OBJECT_DIRECTORIES']
+
+# Number of delta bases kept in memory, chains often share their bases
+_BASE_CACHE_SIZE = 64
+
+# Number of parsed trees and of commit trees kept in memory, the store living
+# as long as the daemon
+_TREE_CACHE_SIZE = 1024
+_COMMIT_CACHE_SIZE = 256
+
+
+class UnsupportedObjectStore(Exception):
+    """ The repository, or the requested object, cannot be read without git
+        (alternates, partial clones, abbreviated names, ...)
+    """
+    pass
+
+
+def find_git_dir(path):
+    """ Return the git directory holding the objects of a working tree
+
+        :param path: root path of the working tree
+        :raise UnsupportedObjectStore: the git directory cannot be found
+    """
+    git_dir = os.path.join(path or '.', '.git')
+    if os.path.isfile(git_dir):
+        # Worktrees and submodules: "gitdir: <path>"
+        with open(git_dir, 'rb') as f:
+            line = f.read().decode('utf-8').strip()
+        if not line.startswith('gitdir: '):
+            raise UnsupportedObjectStore("unknown .git file in %s" % path)
+        git_dir = os.path.join(os.path.dirname(git_dir), line[len('gitdir: '):])
+
+    if not os.path.isdir(git_dir):
+        raise UnsupportedObjectStore("no git directory in %s" % path)
+
+    # Linked worktrees share the objects of the main repository
+    commondir = os.path.join(git_dir, 'commondir')
+    if os.path.isfile(commondir):
+        with open(commondir, 'rb') as f:
+            git_dir = os.path.join(git_dir, f.read().decode('utf-8').strip())
+
+    return os.path.normpath(git_dir)
+
+
+def apply_delta(base, delta):
+    """ Rebuild an object from its base and a git delta
+
+        :param base: content of the base object
+        :param delta: delta instructions, as stored in the packfile
+        :return: the content of the object
+    """
+    delta = bytearray(delta)
+    pos = 0
+
+    # Sizes of the base and of the result
+    sizes = []
+    for _ in range(2):
+        size = shift = 0
+        while True:
+            c = delta[pos]
+            pos += 1
+            size |= (c & 0x7f) << shift
+            shift += 7
+            if not c & 0x80:
+                break
+        sizes.append(size)
+
+    if sizes[0] != len(base):
+        raise ValueError("delta base size mismatch")
+
+    pieces = []
+    while pos < len(delta):
+        c = delta[pos]
+        pos += 1
+        if c & 0x80:
+            # Copy a range of the base: which offset and size bytes follow is
+            # given by the bits of the opcode
+            offset = size = 0
+            for i in range(4):
+                if c & (1 << i):
+                    offset |= delta[pos] << (8 * i)
+                    pos += 1
+            for i in range(3):
+                if c & (1 << (4 + i)):
+                    size |= delta[pos] << (8 * i)
+                    pos += 1
+            pieces.append(base[offset:offset + (size or 0x10000)])
+        elif c:
+            # Insert the next c bytes of the delta
+            pieces.append(bytes(delta[pos:pos + c]))
+            pos += c
+        else:
+            raise ValueError("invalid delta opcode")
+
+    result = b''.join(pieces)
+    if len(result) != sizes[1]:
+        raise ValueError("delta result size mismatch")
+    return result
+
+
+def _inflate(buf, pos, size):
+    """ Inflate a zlib stream of a known uncompressed size """
+    decompressor = zlib.decompressobj()
+    chunks = []
+    length = 0
+    # The compressed stream is rarely larger than the content
+    chunk_size = size + 64
+    while length < size:
+        chunk = buf[pos:pos + chunk_size]
+        if not chunk:
+            raise ValueError("truncated zlib stream")
+        pos += chunk_size
+        chunk = decompressor.decompress(chunk)
+        chunks.append(chunk)
+        length += len(chunk)
+    return b''.join(chunks)
+
+
+class Pack(object):
+    """ A packfile and its version 2 index, both memory-mapped
+
+        :param idx_path: path of the `.idx` file
+    """
+
+    def __init__(self, idx_path):
+        self.idx_path = idx_path
+        self.pack_path = idx_path[:-len('.idx')] + '.pack'
+        self._idx_file = open(idx_path, 'rb')
+        self._pack_file = open(self.pack_path, 'rb')
+        self.idx = mmap.mmap(self._idx_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.pack = mmap.mmap(self._pack_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self.idx[:8] != b'\377tOc\0\0\0\2':
+            self.close()
+            raise UnsupportedObjectStore("unsupported pack index %s" % idx_path)
+        if self.pack[:4] != b'PACK':
+            self.close()
+            raise UnsupportedObjectStore("invalid packfile %s" % self.pack_path)
+
+        self.fanout = struct.unpack_from('>256I', self.idx, 8)
+        self.count = self.fanout[255]
+        self._names = 8 + 256 * 4
+        self._offsets = self._names + self.count * (20 + 4)
+        self._large_offsets = self._offsets + self.count * 4
+
+    def find(self, sha):
+        """ Return the offset of an object in the packfile, or `None`
+
+            :param sha: binary SHA1 of the object
+        """
+        # The fan-out table gives the range of names starting with each byte
+        first = struct.unpack('B', sha[:1])[0]
+        low = self.fanout[first - 1] if first else 0
+        high = self.fanout[first]
+        while low < high:
+            middle = (low + high) // 2
+            start = self._names + middle * 20
+            name = self.idx[start:start + 20]
+            if name < sha:
+                low = middle + 1
+            elif name > sha:
+                high = middle
+            else:
+                return self._offset(middle)
+        return None
+
+    def _offset(self, index):
+        offset = struct.unpack_from('>I', self.idx, self._offsets + index * 4)[0]
+        if offset & 0x80000000:
+            # Packs larger than 2 GB: index in the table of 8-byte offsets
+            index = offset & 0x7fffffff
+            offset = struct.unpack_from('>Q', self.idx, self._large_offsets + index * 8)[0]
+        return offset
+
+    def close(self):
+        for handle in (self.idx, self.pack, self._idx_file, self._pack_file):
+            handle.close()
+
+
+class ObjectStore(object):
+    """ Read-only access to the objects of a git repository without running git
+
+        Loose objects and packfiles are read directly from `.git/objects`.
+        Anything else (alternates, partial clones, replace refs, SHA-256
+        repositories, ...) raises `UnsupportedObjectStore` so that the caller
+        can fall back to git itself.
+
+        :param git_dir: path of the git directory
+        :raise UnsupportedObjectStore: the repository layout is not supported
+    """
+
+    def __init__(self, git_dir):
+        self.git_dir = git_dir
+        self.objects_dir = os.path.join(git_dir, 'objects')
+
+        for name in _GIT_ENVIRONMENT:
+            if name in os.environ:
+                raise UnsupportedObjectStore("%s is set" % name)
+        if not os.path.isdir(self.objects_dir):
+            raise UnsupportedObjectStore("no objects directory in %s" % git_dir)
+        if os.path.exists(os.path.join(self.objects_dir, 'info', 'alternates')):
+            raise UnsupportedObjectStore("alternates are not supported")
+        if os.path.isdir(os.path.join(git_dir, 'refs', 'replace')) or self._has_replace_refs():
+            raise UnsupportedObjectStore("replace refs are not supported")
+        self._check_config()
+
+        self._packs = None
+        self._lock = threading.Lock()
+        # Delta bases: (pack, offset) -> (type, content)
+        self._bases = {}
+        # Tree SHA1 -> {name: (mode, binary SHA1)}
+        self._trees = {}
+        # Commit SHA1 -> binary SHA1 of its tree
+        self._commit_trees = {}
+
+    @classmethod
+    def open(cls, path):
+        """ Open the object store of a working tree (see `find_git_dir`) """
+        return cls(find_git_dir(path))
+
+    def _check_config(self):
+        try:
+            with open(os.path.join(self.git_dir, 'config'), 'rb') as f:
+                config = f.read().decode('utf-8', 'replace').lower()
+        except (IOError, OSError):
+            return
+
+        if 'partialclone' in config or 'objectformat' in config:
+            raise UnsupportedObjectStore("repository extensions are not supported")
+
+    def _has_replace_refs(self):
+        try:
+            with open(os.path.join(self.git_dir, 'packed-refs'), 'rb') as f:
+                return b' refs/replace/' in f.read()
+        except (IOError, OSError):
+            return False
+
+    def _load_packs(self):
+        pack_dir = os.path.join(self.objects_dir, 'pack')
+        if glob.glob(os.path.join(pack_dir, '*.promisor')):
+            raise UnsupportedObjectStore("partial clones are not supported")
+
+        packs = []
+        for idx_path in sorted(glob.glob(os.path.join(pack_dir, '*.idx'))):
+            try:
+                packs.append(Pack(idx_path))
+            except (IOError, OSError, ValueError) as e:
+                # e.g. a pack removed by a concurrent gc
+                logger.debug("Could not open %s: %s" % (idx_path, e))
+        return packs
+
+    def _get_packs(self, reload=False):
+        with self._lock:
+            if self._packs is None or reload:
+                # Previous packs are left to the garbage collector, as other
+                # threads may still be reading them
+                self._packs = self._load_packs()
+                self._bases = {}
+            return self._packs
+
+    def read_object(self, sha):
+        """ Read an object
+
+            :param sha: hexadecimal SHA1 of the object
+            :return: a (type, content) tuple
+            :raise UnsupportedObjectStore: the object cannot be found
+
+        """
+        obj = self._read_loose(sha)
+        if obj is not None:
+            return obj
+
+        binary = binascii.unhexlify(sha)
+        # Packs may have been rewritten since they were opened
+        for reload in (False, True):
+            for pack in self._get_packs(reload):
+                offset = pack.find(binary)
+                if offset is not None:
+                    return self._read_packed(pack, offset)
+
+        raise UnsupportedObjectStore("object %s not found" % sha)
+
+    def _read_loose(self, sha):
+        try:
+            with open(os.path.join(self.objects_dir, sha[:2], sha[2:]), 'rb') as f:
+                data = zlib.decompress(f.read())
+        except (IOError, OSError):
+            return None
+
+        # "<type> <size>\0<content>"
+        header, content = data.split(b'\0', 1)
+        obj_type, size = header.decode('ascii').split()
+        if int(size) != len(content):
+            raise UnsupportedObjectStore("corrupt object %s" % sha)
+        return obj_type, content
+
+    def _remember(self, name, key, value, size):
+        """ Keep `value` in the cache `name` (e.g. "_trees"), emptied when it
+            holds `size` entries. Other threads may read the caches meanwhile,
+            with `dict.get`, or replace them (see `_get_packs`)
+        """
+        with self._lock:
+            cache = getattr(self, name)
+            if len(cache) >= size:
+                cache.clear()
+            cache[key] = value
+
+    def _read_packed(self, pack, offset):
+        key = (pack.pack_path, offset)
+        obj = self._bases.get(key)
+        if obj is not None:
+            return obj
+
+        buf = pack.pack
+        # Type and size of the entry, in a variable-length header
+        header = bytearray(buf[offset:offset + 32])
+        c = header[0]
+        pack_type = (c >> 4) & 7
+        size = c & 0x0f
+        shift = 4
+        pos = 1
+        while c & 0x80:
+            c = header[pos]
+            pos += 1
+            size |= (c & 0x7f) << shift
+            shift += 7
+
+        if pack_type in _OBJECT_TYPES:
+            obj = _OBJECT_TYPES[pack_type], _inflate(buf, offset + pos, size)
+        elif pack_type == _OFS_DELTA:
+            # Base at a negative offset from this entry
+            c = header[pos]
+            pos += 1
+            base_offset = c & 0x7f
+            while c & 0x80:
+                c = header[pos]
+                pos += 1
+                base_offset = ((base_offset + 1) << 7) | (c & 0x7f)
+            base_type, base = self._read_packed(pack, offset - base_offset)
+            obj = base_type, apply_delta(base, _inflate(buf, offset + pos, size))
+        elif pack_type == _REF_DELTA:
+            base_sha = binascii.hexlify(bytes(header[pos:pos + 20])).decode('ascii')
+            base_type, base = self.read_object(base_sha)
+            obj = base_type, apply_delta(base, _inflate(buf, offset + pos + 20, size))
+        else:
+            raise UnsupportedObjectStore("unknown pack entry type %d" % pack_type)
+
+        self._remember('_bases', key, obj, _BASE_CACHE_SIZE)
+        return obj
+
+    def _tree_of(self, commit):
+        tree = self._commit_trees.get(commit)
+        if tree is not None:
+            return tree
+
+        obj_type, content = self.read_object(commit)
+        # Annotated tags point to the commit
+        while obj_type == 'tag':
+            obj_type, content = self.read_object(content[7:47].decode('ascii'))
+        if obj_type != 'commit' or not content.startswith(b'tree '):
+            raise UnsupportedObjectStore("%s is not a commit" % commit)
+
+        tree = binascii.unhexlify(content[5:45])
+        self._remember('_commit_trees', commit, tree, _COMMIT_CACHE_SIZE)
+        return tree
+
+    def _read_tree(self, sha):
+        entries = self._trees.get(sha)
+        if entries is not None:
+            return entries
+
+        obj_type, content = self.read_object(binascii.hexlify(sha).decode('ascii'))
+        if obj_type != 'tree':
+            raise UnsupportedObjectStore("invalid tree")
+
+        # "<mode> <name>\0<binary SHA1>" entries
+        entries = {}
+        pos = 0
+        while pos < len(content):
+            space = content.index(b' ', pos)
+            nul = content.index(b'\0', space)
+            entries[content[space + 1:nul]] = (content[pos:space], content[nul + 1:nul + 21])
+            pos = nul + 21
+
+        self._remember('_trees', sha, entries, _TREE_CACHE_SIZE)
+        return entries
+
+    def read(self, commit, filename, content=True):
+        """ Read a file of a commit, as `git cat-file --batch` would
+
+            :param commit: full hexadecimal SHA1 of the commit
+            :param filename: path of the file relative to the repository
+            :param content: if False, only look the file up
+            :return: a (sha1, type, content) tuple, or `None` if the file does
+                not exist. The content is `None` if not requested.
+            :raise UnsupportedObjectStore: git must be asked instead
+
+        """
+        if not commit or not _SHA1.match(commit):
+            raise UnsupportedObjectStore("not a full SHA1: %s" % commit)
+
+        parts = filename.encode('utf-8').split(b'/')
+        if any(part in (b'', b'.', b'..') for part in parts):
+            raise UnsupportedObjectStore("not a normalized path: %s" % filename)
+
+        mode, sha = None, self._tree_of(commit)
+        for part in parts:
+            if mode is not None and mode != b'40000':
+                return None
+            entry = self._read_tree(sha).get(part)
+            if entry is None:
+                return None
+            mode, sha = entry
+
+        obj_type = _MODE_TYPES.get(mode, 'blob')
+        if obj_type == 'commit':
+            raise UnsupportedObjectStore("submodules are not supported")
+
+        sha = binascii.hexlify(sha).decode('ascii')
+        if not content:
+            return sha, obj_type, None
+
+        obj_type, data = self.read_object(sha)
+        return sha, obj_type, data
+
+    def close(self):
+        """ Unmap the packfiles """
+        with self._lock:
+            packs, self._packs = self._packs or [], None
+            self._bases = {}
+        for pack in packs:
+            pack.close()
@@ -0,0 +1,464 @@
+from __future__ import print_function, absolute_import
+
+import io
+import os
+import re
+import json
+import logging
+
+from .cache import make_key
+from .profile import Span
+from .utils import scan_latex, find_assets, Include, Verbatim
+
+logger = logging.getLogger("rcs-latexdiff")
+
+# Version of the flattening algorithm, part of every cache key
+FLATTEN_VERSION = "3"
+
+_BIBLIOGRAPHY = re.compile(r'\\bibliography(?![a-zA-Z@])\s*\{[^}]*\}')
+
+
+class IncludeCycleError(Exception):
+    """ A file includes itself, directly or not """
+
+    def __init__(self, cycle):
+        self.cycle = cycle
+        super(IncludeCycleError, self).__init__("Include cycle: %s" % " -> ".join(cycle))
+
+
+class FileNode(object):
+    """ A file read from the RCS along with the files it includes
+
+        :param filename: name of the file
+        :param file_id: identifier of its content (see `RCS.file_id`) or `None`
+        :param segments: content of the file, without comments, as returned
+            by `scan_latex`
+    """
+
+    def __init__(self, filename, file_id, segments):
+        self.filename = filename
+        self.file_id = file_id
+        self.segments = segments
+        # (name as written in the include command, name of the included file,
+        # FileNode or None if it could not be found), in order of appearance
+        self.includes = []
+        self._key = False
+
+    def include_names(self):
+        """ Return the distinct names of the included files, as written """
+        names = []
+        for segment in self.segments:
+            if isinstance(segment, Include) and segment.name not in names:
+                names.append(segment.name)
+        return names
+
+    def key(self):
+        """ Return a key identifying the expanded content of the file, built
+            from the identifiers of the whole include subtree (`None` if one of
+            them is unknown)
+        """
+        if self._key is False:
+            parts = [FLATTEN_VERSION, self.filename, self.file_id]
+            for name, input_name, child in self.includes:
+                parts += [name, input_name, child.key() if child else "missing"]
+            self._key = make_key(*parts) if None not in parts else None
+        return self._key
+
+
+def dump_segments(segments):
+    """ Serialize the segments of a file (see `scan_latex`) for the cache """
+    def dump(segment):
+        if isinstance(segment, Include):
+            return list(segment)
+        if isinstance(segment, Verbatim):
+            return {'verbatim': segment}
+        return segment
+    return json.dumps([dump(segment) for segment in segments])
+
+
+def load_segments(data):
+    """ Deserialize the segments of a file stored by `dump_segments` """
+    def load(segment):
+        if isinstance(segment, list):
+            return Include(*segment)
+        if isinstance(segment, dict):
+            return Verbatim(segment['verbatim'])
+        return segment
+    return [load(segment) for segment in json.loads(data)]
+
+
+def read_file(rcs, root_path, relative_path, commit, filename, cache=None):
+    """ Read a file, remove its comments and look for its includes
+
+        :param cache: if given, the content is looked up in (and stored into)
+            this cache
+        :return: identifier of the file and its segments (see `scan_latex`)
+        :raise IOError: the file does not exist in the working copy
+
+    """
+    path = os.path.join(relative_path, filename)
+    file_id = rcs.file_id(root_path, commit, path) if cache is not None else None
+    key = "%s:%s" % (FLATTEN_VERSION, file_id) if file_id else None
+
+    data = cache.get('file', key) if key else None
+    if data is not None:
+        return file_id, load_segments(data)
+
+    with Span('show_file', 'rcs', file=path, commit=commit) as span:
+        content = rcs.show_file(root_path, commit, path)
+        if span.start is not None:
+            span.args['bytes'] = len(content.encode('utf-8'))
+    segments = scan_latex(content)
+    if key:
+        cache.put('file', key, dump_segments(segments))
+
+    return file_id, segments
+
+
+def fetch_input(rcs, root_path, relative_path, commit, input_name, cache=None):
+    """ Read an included file, trying the `.tex` extension if the name as
+        written cannot be read.
+
+        :return: the name that has been read, its identifier and its segments
+            (`None` if the file could not be found)
+
+    """
+    with Span('include', 'flatten', file=input_name, commit=commit):
+        try:
+            return (input_name,) + read_file(rcs, root_path, relative_path, commit, input_name, cache)
+        except IOError:
+            input_name += ".tex"
+
+        try:
+            return (input_name,) + read_file(rcs, root_path, relative_path, commit, input_name, cache)
+        except Exception:
+            return input_name, None, None
+
+
+class IncludeGraph(object):
+    """ Include graph of a document for one commit
+
+        Every distinct file is read and expanded only once, however many
+        times it is included.
+
+        :param rcs: Rcs instance
+        :type rcs: RCS object
+        :param root_path: root path of the repository
+        :param relative_path: path of the document relative to `root_path`
+        :param commit: Commit name or `None` for the working copy
+        :param executor: if given, sibling includes are fetched concurrently
+            through this executor
+        :param cache: if given, file and expanded contents are cached into
+            this Cache instance
+    """
+
+    def __init__(self, rcs, root_path, relative_path, commit, executor=None, cache=None):
+        self.rcs = rcs
+        self.root_path = root_path
+        self.relative_path = relative_path
+        self.commit = commit
+        self.executor = executor
+        self.cache = cache
+        self.root = None
+        # Name of the .bbl file inlined by `inline_bibliography`
+        self.bibliography = None
+        # Name of the file -> FileNode
+        self.nodes = {}
+        # Name as written in the include command -> (name read, id, segments)
+        self._inputs = {}
+        self._expanded = {}
+
+    def build(self, filename):
+        """ Read a file and, recursively, the files it includes
+
+            :param filename: name of the main file
+            :return: the FileNode of the main file
+            :raise IOError: the main file does not exist in the working copy
+            :raise IncludeCycleError: a file includes itself
+
+        """
+        with Span('build', 'flatten', file=filename, commit=self.commit):
+            file_id, segments = read_file(self.rcs, self.root_path, self.relative_path, self.commit, filename, self.cache)
+            self.root = self._build_node(filename, file_id, segments, [])
+        return self.root
+
+    def _fetch(self, input_names):
+        """ Read the included files that have not been read yet """
+        args = (self.rcs, self.root_path, self.relative_path, self.commit)
+        input_names = [name for name in input_names if name not in self._inputs]
+        if self.executor is not None:
+            futures = [self.executor.submit(fetch_input, *(args + (name, self.cache))) for name in input_names]
+            results = [future.result() for future in futures]
+        else:
+            results = [fetch_input(*(args + (name, self.cache))) for name in input_names]
+        self._inputs.update(zip(input_names, results))
+
+    def _build_node(self, filename, file_id, segments, stack):
+        node = self.nodes[filename] = FileNode(filename, file_id, segments)
+        stack = stack + [filename]
+
+        # Look for external inputs, and read them
+        input_names = node.include_names()
+        logger.info("Found {} distinct \\include{{}} or \\input{{}} in {}".format(len(input_names), filename))
+        self._fetch(input_names)
+
+        for name in input_names:
+            input_name, input_id, input_segments = self._inputs[name]
+            logger.info("Inserting {}...".format(input_name))
+
+            if input_name in stack:
+                raise IncludeCycleError(stack[stack.index(input_name):] + [input_name])
+
+            if input_segments is None:
+                logger.info("Could not find {}, ignoring and hoping for the best.".format(os.path.join(self.root_path, self.relative_path, input_name)))
+                child = None
+            elif input_name in self.nodes:
+                # Already read and expanded through another include
+                child = self.nodes[input_name]
+            else:
+                child = self._build_node(input_name, input_id, input_segments, stack)
+            node.includes.append((name, input_name, child))
+
+        return node
+
+    def _join(self, node, expand_child):
+        """ Join the segments of a file, with the expanded content of its
+            includes between delimiters
+
+            :param expand_child: function returning the expanded content of
+                an included FileNode
+        """
+        includes = {}
+        for name, input_name, child in node.includes:
+            # Add delimiters
+            includes[name] = ["%% Input %s\n" % input_name,
+                              expand_child(child) if child else '',
+                              "\n%% End of Input %s" % input_name]
+
+        # Join all segments at once
+        pieces = []
+        for segment in node.segments:
+            if isinstance(segment, Include):
+                pieces.extend(includes[segment.name])
+            else:
+                pieces.append(segment)
+        return ''.join(pieces)
+
+    def expand(self, node=None, replacements=None):
+        """ Replace the includes and inputs of a file by their expanded content
+
+            :param node: FileNode of the file (default: the main file)
+            :param replacements: if given, dict {filename: text} of files
+                whose expanded content is replaced by the given text
+            :return: the expanded content
+
+        """
+        node = node or self.root
+        if replacements:
+            return self._expand_replacing(node, replacements, {})
+
+        if node.filename in self._expanded:
+            return self._expanded[node.filename]
+
+        key = node.key() if self.cache is not None and node.includes else None
+        content = self.cache.get('expanded', key) if key else None
+
+        if content is None:
+            content = self._join(node, self.expand)
+            if key:
+                self.cache.put('expanded', key, content)
+
+        self._expanded[node.filename] = content
+        return content
+
+    def chunks(self, node=None, replacements=None):
+        """ Generate the expanded content of a file piece by piece, as
+            `expand` would return it, without ever building it in memory
+
+            Only the generators of the includes being expanded are alive at
+            once, so memory does not grow with the size of the document.
+
+            :param node: FileNode of the file (default: the main file)
+            :param replacements: see `expand`
+        """
+        node = node or self.root
+        replacements = replacements or {}
+        includes = dict((name, (input_name, child)) for name, input_name, child in node.includes)
+
+        for segment in node.segments:
+            if not isinstance(segment, Include):
+                yield segment
+                continue
+
+            input_name, child = includes[segment.name]
+            yield "%% Input %s\n" % input_name
+            if child is None:
+                pass
+            elif child.filename in replacements:
+                yield replacements[child.filename]
+            elif child.filename in self._expanded and not replacements:
+                # Already expanded for another reason
+                yield self._expanded[child.filename]
+            else:
+                for chunk in self.chunks(child, replacements):
+                    yield chunk
+            yield "\n%% End of Input %s" % input_name
+
+    def write(self, filename, node=None, replacements=None):
+        """ Write the expanded content of a file (see `chunks`) into `filename`
+
+            :param node: FileNode of the file (default: the main file)
+            :param replacements: see `expand`
+        """
+        with Span('write', 'flatten', file=filename, commit=self.commit), \
+                io.open(filename, 'w', encoding='utf-8', newline='') as f:
+            for chunk in self.chunks(node, replacements):
+                f.write(chunk)
+
+    def _expand_replacing(self, node, replacements, expanded):
+        if node.filename not in expanded:
+            expanded[node.filename] = self._join(node, lambda child: replacements[child.filename]
+                if child.filename in replacements else self._expand_replacing(child, replacements, expanded))
+        return expanded[node.filename]
+
+    def inline_bibliography(self, bbl, filename, bbl_id=None):
+        """ Replace the \\bibliography{} commands of the document by the
+            content of its .bbl file, as LaTeX would insert it (the content
+            of verbatim-like environments and \\verb is left untouched)
+
+            :param bbl: content of the .bbl file
+            :param filename: name of the .bbl file
+            :param bbl_id: identifier of the content of the .bbl file (see
+                `RCS.file_id`), part of the keys of the modified files
+            :return: the number of replaced commands
+        """
+        count = 0
+        for node in self.nodes.values():
+            segments = []
+            for segment in node.segments:
+                if not isinstance(segment, (Include, Verbatim)):
+                    segment, n = _BIBLIOGRAPHY.subn(lambda match: bbl, segment)
+                    count += n
+                    if n:
+                        node.file_id = make_key(node.file_id, bbl_id) if node.file_id and bbl_id else None
+                segments.append(segment)
+            node.segments = segments
+
+        # Keys and expanded contents are out of date
+        for node in self.nodes.values():
+            node._key = False
+        self._expanded = {}
+        if count:
+            self.bibliography = filename
+        return count
+
+    def assets(self):
+        """ Return the files which the document may need to compile, besides
+            the included ones (see `find_assets`), relative to its directory
+        """
+        content = '\n'.join(segment for filename in sorted(self.nodes) for segment in self.nodes[filename].segments
+                            if not isinstance(segment, Include))
+        return find_assets(content)
+
+    def to_dict(self):
+        """ Return the graph as a JSON-serializable dict """
+        nodes = {}
+        for filename, node in self.nodes.items():
+            nodes[filename] = {
+                'id': node.file_id,
+                'includes': [input_name for name, input_name, child in node.includes if child],
+                'missing': [input_name for name, input_name, child in node.includes if not child],
+            }
+
+        return {
+            'commit': self.commit,
+            'root': self.root.filename if self.root else None,
+            'nodes': nodes,
+        }
+
+
+# Commands which must be seen by latexdiff, as it inserts its own preamble
+# before \begin{document}
+_DOCUMENT_MARKERS = ['\\documentclass', '\\begin{document}', '\\end{document}']
+
+
+def _same_content(first, second):
+    """ Return whether or not two sequences of strings (see
+        `IncludeGraph.chunks`) are the same once joined, without joining them
+    """
+    first, second = iter(first), iter(second)
+    a = b = ''
+    while True:
+        while a == '':
+            a = next(first, None)
+        while b == '':
+            b = next(second, None)
+        if a is None or b is None:
+            return a is None and b is None
+        n = min(len(a), len(b))
+        if a[:n] != b[:n]:
+            return False
+        a, b = a[n:], b[n:]
+
+
+def unchanged_subtrees(old_graph, new_graph):
+    """ Look for the included files whose expanded content is the same for
+        both commits
+
+        Only the largest such subtrees are returned, and only if they are
+        included in the body of the document (after \\begin{document}).
+        The subtrees are compared through their keys when known, and
+        otherwise streamed: nothing is expanded in memory.
+
+        :return: list of file names, in document order
+
+    """
+    def is_unchanged(node):
+        old_node = old_graph.nodes.get(node.filename)
+        if old_node is None:
+            return False
+        # Compare the identifiers of the subtrees when both are known
+        if old_node.key() is not None and node.key() is not None:
+            return old_node.key() == node.key()
+        return _same_content(old_graph.chunks(old_node), new_graph.chunks(node))
+
+    # File name -> document markers found in its subtree
+    found_markers = {}
+
+    def markers(node):
+        if node.filename not in found_markers:
+            text = ''.join(segment for segment in node.segments if not isinstance(segment, Include))
+            found = set(marker for marker in _DOCUMENT_MARKERS if marker in text)
+            for name, input_name, child in node.includes:
+                if child is not None:
+                    found |= markers(child)
+            found_markers[node.filename] = found
+        return found_markers[node.filename]
+
+    unchanged = []
+    visited = set()
+
+    def visit(node, in_body):
+        visited.add(node.filename)
+        children = dict((name, child) for name, input_name, child in node.includes)
+        for segment in node.segments:
+            if not isinstance(segment, Include):
+                in_body = in_body or '\\begin{document}' in segment
+                continue
+
+            child = children[segment.name]
+            if child is None:
+                continue
+            if child.filename in visited:
+                in_body = in_body or '\\begin{document}' in markers(child)
+                continue
+
+            if in_body and not markers(child) and is_unchanged(child):
+                visited.add(child.filename)
+                unchanged.append(child.filename)
+            else:
+                in_body = visit(child, in_body)
+        return in_body
+
+    visit(new_graph.root, False)
+    return unchanged
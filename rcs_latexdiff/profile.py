@@ -0,0 +1,141 @@
+from __future__ import print_function, absolute_import
+
+import os
+import json
+import time
+import logging
+import threading
+
+logger = logging.getLogger("rcs-latexdiff")
+
+# Functions called with every finished span (see `add_hook`)
+_hooks = []
+_hooks_lock = threading.Lock()
+
+
+def add_hook(hook):
+    """ Call `hook` with every span recorded from now on
+
+        A span is a dict with the keys `name` (e.g. "show_file"), `category`
+        ("rcs", "flatten", "diff", "compile" or "cleanup"), `start` (time.time()
+        when it started), `duration` (in seconds), `pid`, `tid` and `args` (a
+        dict describing the span, e.g. the file name and the byte count).
+        Hooks are called from the thread which ran the span.
+
+        :param hook: function taking a span
+    """
+    with _hooks_lock:
+        _hooks.append(hook)
+
+
+def remove_hook(hook):
+    """ Stop calling a hook added by `add_hook` """
+    with _hooks_lock:
+        if hook in _hooks:
+            _hooks.remove(hook)
+
+
+class Span(object):
+    """ Context manager timing a stage, and handing it to the hooks
+
+        Nothing is measured when there is no hook. Arguments known at the end
+        of the stage (e.g. a byte count) can be added to `args`.
+
+        :param name: name of the stage
+        :param category: category of the stage
+        :param args: description of the span
+    """
+
+    def __init__(self, name, category, **args):
+        self.name = name
+        self.category = category
+        self.args = args
+        self.start = None
+
+    def __enter__(self):
+        if _hooks:
+            self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.start is None:
+            return
+        duration = time.time() - self.start
+        if exc_info[0] is not None:
+            self.args['error'] = exc_info[0].__name__
+
+        event = {'name': self.name, 'category': self.category, 'start': self.start, 'duration': duration,
+                 'pid': os.getpid(), 'tid': threading.current_thread().ident, 'args': self.args}
+        for hook in list(_hooks):
+            hook(event)
+
+
+class Profiler(object):
+    """ Hook collecting the spans, to write them as a Chrome trace (see
+        chrome://tracing or https://ui.perfetto.dev) and summarize them
+
+        Usage:
+            with Profiler() as profiler:
+                ...
+            profiler.write('profile.json')
+    """
+
+    def __init__(self):
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        with self._lock:
+            self.spans.append(event)
+
+    def start(self):
+        """ Start collecting spans """
+        add_hook(self)
+
+    def stop(self):
+        """ Stop collecting spans """
+        remove_hook(self)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def trace(self):
+        """ Return the spans in the Chrome trace event format """
+        with self._lock:
+            spans = list(self.spans)
+        origin = min([event['start'] for event in spans] or [0])
+
+        events = []
+        for event in sorted(spans, key=lambda event: event['start']):
+            events.append({'name': event['name'], 'cat': event['category'], 'ph': 'X',
+                           'ts': int((event['start'] - origin) * 1e6), 'dur': int(event['duration'] * 1e6),
+                           'pid': event['pid'], 'tid': event['tid'], 'args': event['args']})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def write(self, filename):
+        """ Write the trace (see `trace`) as JSON into `filename` """
+        with open(filename, 'w') as f:
+            json.dump(self.trace(), f)
+        logger.info("Profile written to %s" % filename)
+
+    def summary(self):
+        """ Return a table of the number of spans and their total and
+            longest duration, by stage
+        """
+        stages = {}
+        with self._lock:
+            for event in self.spans:
+                stage = stages.setdefault((event['category'], event['name']), [0, 0.0, 0.0, 0])
+                stage[0] += 1
+                stage[1] += event['duration']
+                stage[2] = max(stage[2], event['duration'])
+                stage[3] += event['args'].get('bytes', 0)
+
+        lines = ["%-10s %-18s %6s %10s %10s %12s" % ('category', 'stage', 'count', 'total (s)', 'max (s)', 'bytes')]
+        for (category, name), (count, total, longest, size) in sorted(stages.items(), key=lambda item: -item[1][1]):
+            lines.append("%-10s %-18s %6d %10.3f %10.3f %12s" % (category, name, count, total, longest, size or ''))
+        return "\n".join(lines)
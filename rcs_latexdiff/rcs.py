@@ -1,9 +1,17 @@
 from __future__ import print_function, absolute_import
 
+import re
 import os
+import shutil
 import logging
+import tempfile
+import subprocess
+import threading
+import struct
+import zlib
 
-from .utils import run_command
+from .utils import execute, CommandResult
+from .gitobjects import ObjectStore, UnsupportedObjectStore
 
 logger = logging.getLogger("rcs-latexdiff")
 
@@ -32,6 +40,69 @@ class RCS(object):
                 logger.debug("Error reading working copy: {}".format(os.path.join(path, filename)))
                 raise IOError("Error reading working copy: {}".format(os.path.join(path, filename)))
 
+    def read_blob(self, path, commit, filename):
+        """ Return the raw content of a file for a commit (e.g. a figure). If
+            the commit is `None`, read the current working copy.
+
+            :param path: path of the repository
+            :param commit: Commit name or `None`
+            :param filename: Name of the file
+            :return: the content of the file (bytes), or `None` if the file
+                does not exist
+
+        """
+        # Use current working copy
+        if commit is None:
+            try:
+                with open(os.path.join(path, filename), 'rb') as f:
+                    return f.read()
+            except IOError:
+                return None
+
+    def read_blobs(self, path, commit, filenames):
+        """ Return the raw content of several files for a commit, missing
+            files being left out (see `read_blob`)
+
+            :return: dict {filename: bytes}
+
+        """
+        blobs = {}
+        for filename in filenames:
+            content = self.read_blob(path, commit, filename)
+            if content is not None:
+                blobs[filename] = content
+        return blobs
+
+    def file_id(self, path, commit, filename):
+        """ Return an identifier of the content of a file for a commit. Two
+            files with the same identifier have the same content, which makes
+            it usable as a cache key.
+
+            :param path: path of the repository
+            :param commit: Commit name or `None`
+            :param filename: Name of the file
+            :return: the identifier, or `None` if the file cannot be identified
+
+        """
+        # Use current working copy: rely on the modification time and size
+        if commit is None:
+            filename = os.path.abspath(os.path.join(path, filename))
+            try:
+                st = os.stat(filename)
+            except OSError:
+                return None
+            return "wc:%s:%d:%d" % (filename, int(st.st_mtime * 1e9), st.st_size)
+
+    def has_marker(self, path):
+        """ Return wheter or not a directory holds the metadata of the RCS
+            (e.g. a `.git` directory), without running any command
+
+            :param path: Path of the dir
+            :return: True/False
+
+        """
+        return False
+
     def is_valid_directory(self, path):
         """ Return wheter or not the directory is a valid RCS repository
 
@@ -51,6 +122,48 @@ class RCS(object):
         """
         pass
 
+    def resolve_commit(self, path, commit):
+        """ Return the immutable identifier of a commit (e.g. the SHA1 of a
+            branch)
+
+            :param path: path of the repository
+            :param commit: Commit name or `None`
+            :return: the identifier, or `None` for the working copy or if the
+                commit cannot be resolved
+
+        """
+        pass
+
+    def resolve_commits(self, path, commits):
+        """ Resolve several commits at once (see `resolve_commit`)
+
+            :param path: path of the repository
+            :param commits: list of commit names (or `None`)
+            :return: list of identifiers
+
+        """
+        return [self.resolve_commit(path, commit) for commit in commits]
+
+    def list_revisions(self, path, revision_range):
+        """ Return the revisions of a range, oldest first, including the
+            first revision of the range
+
+            :param path: path of the repository
+            :param revision_range: range of revisions (e.g. `OLD..NEW`)
+            :return: list of revisions, or `None` if the range is invalid
+
+        """
+        pass
+
+    def list_tags(self, path):
+        """ Return the tags of the repository, oldest first
+
+            :param path: path of the repository
+            :return: list of tags, or `None` if not supported
+
+        """
+        pass
+
     def get_relative_paths(self, filename):
         """ Return the root path of the repository
 
@@ -60,58 +173,296 @@ class RCS(object):
         """
         pass
 
+    def refresh(self):
+        """ Forget what was read about the working copies, which may have
+            changed since (e.g. between the jobs of the daemon)
+        """
+        pass
+
+    def close(self):
+        """ Release any resource (e.g. long-running processes) held by the RCS """
+        pass
+
+
+class GitBatchReader(object):
+    """ Persistent `git cat-file --batch` process bound to a repository
+
+        Objects are requested through the stdin pipe of a single git process
+        instead of spawning one `git show` per file.
+
+        :param check: use `--batch-check`, which only returns the object
+            names and types, not their content
+    """
+
+    def __init__(self, path, check=False):
+        self.path = path
+        self.check = check
+        self._process = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        option = '--batch-check' if self.check else '--batch'
+        logger.debug("Start git cat-file %s in %s" % (option, self.path))
+        with open(os.devnull, 'w') as devnull:
+            self._process = subprocess.Popen(['git', 'cat-file', option],
+                cwd=self.path or None, stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE, stderr=devnull)
+
+    def read(self, name):
+        """ Read an object from the repository
+
+            :param name: object name (e.g. `commit:path/to/file`)
+            :return: a (sha1, type, content) tuple, or `None` if the object
+                does not exist. The content is `None` in check mode.
+
+        """
+        with self._lock:
+            if self._process is None:
+                self._start()
+
+            process = self._process
+            process.stdin.write(name.encode('utf-8') + b'\n')
+            process.stdin.flush()
+
+            header = process.stdout.readline()
+            if not header:
+                # The process died, forget about it so that it can be restarted
+                self.close_process()
+                raise IOError("git cat-file --batch exited unexpectedly")
+
+            fields = header.split()
+            if len(fields) != 3:
+                # "<name> missing" or "<name> ambiguous"
+                return None
+
+            sha1, obj_type, size = fields[0].decode('ascii'), fields[1].decode('ascii'), int(fields[2])
+            if self.check:
+                return sha1, obj_type, None
+
+            content = process.stdout.read(size)
+            # Each object is followed by a newline
+            process.stdout.read(1)
+
+            return sha1, obj_type, content
+
+    def close_process(self):
+        if self._process is None:
+            return
+
+        process, self._process = self._process, None
+        try:
+            process.stdin.close()
+        except (IOError, OSError):
+            pass
+        process.wait()
+        process.stdout.close()
+        logger.debug("Stopped git cat-file in %s" % self.path)
+
+    def close(self):
+        """ Stop the git process """
+        with self._lock:
+            self.close_process()
+
 
 
 class Git(RCS):
-    """ Git Revision Control System class """
+    """ Git Revision Control System class
+
+        :param batch: read files through a persistent `git cat-file --batch`
+            process rather than one `git show` process per file
+        :param native: in batch mode, read the objects directly from
+            `.git/objects` when possible, without running git at all
+    """
+
+    def __init__(self, batch=True, native=True):
+        self.batch = batch
+        self.native = native
+        self._stores = {}
+        self._readers = {}
+        self._check_readers = {}
+        self._readers_lock = threading.Lock()
 
     def show_file(self, path, commit, filename):
         
         # Use current working copy
         if commit is None:
             return super(Git, self).show_file(path, commit, filename)
-        
+
+        if self.batch:
+            return self._show_file_batch(path, commit, filename)
+
+        return self._show_file_process(path, commit, filename)
+
+    def _get_reader(self, path, check=False):
+        readers = self._check_readers if check else self._readers
+        with self._readers_lock:
+            reader = readers.get(path)
+            if reader is None:
+                reader = readers[path] = GitBatchReader(path, check)
+            return reader
+
+    def _get_store(self, path):
+        with self._readers_lock:
+            if path not in self._stores:
+                try:
+                    self._stores[path] = ObjectStore.open(path)
+                except (UnsupportedObjectStore, IOError, OSError) as e:
+                    logger.debug("Not reading objects natively in %s: %s" % (path, e))
+                    self._stores[path] = None
+            return self._stores[path]
+
+    def _read_object(self, path, commit, filename, check=False):
+        """ Read a file of a commit from the object store if possible, or
+            through `git cat-file`
+
+            :return: see `GitBatchReader.read`
+        """
+        store = self._get_store(path) if self.native else None
+        if store is not None:
+            try:
+                return store.read(commit, filename, content=not check)
+            except (UnsupportedObjectStore, ValueError, zlib.error) as e:
+                logger.debug("Could not read %s:%s natively (%s)" % (commit, filename, e))
+
+        return self._get_reader(path, check).read("%s:%s" % (commit, filename))
+
+    def file_id(self, path, commit, filename):
+        # Use current working copy
+        if commit is None:
+            return super(Git, self).file_id(path, commit, filename)
+
+        # Blobs are content-addressed: their SHA1 is a perfect identifier
+        try:
+            obj = self._read_object(path, commit, filename, check=True)
+        except (IOError, OSError):
+            return None
+
+        # Missing files are read as empty files
+        if obj is None:
+            return "git:missing"
+
+        if obj[1] != 'blob':
+            return None
+
+        return "git:%s" % obj[0]
+
+    def _show_file_batch(self, path, commit, filename):
+        try:
+            obj = self._read_object(path, commit, filename)
+        except (IOError, OSError) as e:
+            logger.debug("git cat-file --batch failed (%s), falling back to git show" % e)
+            return self._show_file_process(path, commit, filename)
+
+        # Does the file exist ?
+        if obj is None:
+            return ""
+
+        # Not a file (e.g. a tree): let git show render it
+        if obj[1] != 'blob':
+            return self._show_file_process(path, commit, filename)
+
+        # Same decoding as git show, so that both paths are identical
+        return obj[2].decode('utf-8').strip()
+
+    def read_blob(self, path, commit, filename):
+        # Use current working copy
+        if commit is None:
+            return super(Git, self).read_blob(path, commit, filename)
+
+        if self.batch:
+            try:
+                obj = self._read_object(path, commit, filename)
+                return obj[2] if obj is not None and obj[1] == 'blob' else None
+            except (IOError, OSError) as e:
+                logger.debug("git cat-file --batch failed (%s), falling back to git show" % e)
+
+        result = execute(['git', 'show', "%s:%s" % (commit, filename)], path)
+        return result.stdout if result.ok else None
+
+    def _show_file_process(self, path, commit, filename):
         # Execute 'git show' command and return content or empty string
-        git_show_command = "git show %s:%s" % (commit, filename)
-        ret, file_content = run_command(git_show_command, path)
+        result = execute(['git', 'show', "%s:%s" % (commit, filename)], path)
 
         # Does the file exist ?
-        if ret:
+        if not result.ok:
             # Return code != 0, file not found for this commit
-            file_content = ""
+            return ""
+
+        return result.text.strip()
 
-        return file_content.strip()
+    def has_marker(self, path):
+        # A .git directory, or a .git file pointing to it (worktrees, submodules)
+        git_path = os.path.join(path, '.git')
+        if os.path.isdir(git_path):
+            return True
+        try:
+            with open(git_path, 'rb') as f:
+                return f.read(8) == b'gitdir: '
+        except (IOError, OSError):
+            return False
 
     def is_valid_directory(self, path):
-        # Verify that path is a valid repository
-        # Following command do :
-        #   - jump to path
-        #   - git status
-        #   - jump back to the current dir
-        git_status_command = "git status"
-        ret, output = run_command(git_status_command, path)
+        # Verify that path is a valid repository ('git status' would scan the
+        # whole working tree)
+        result = execute(['git', 'rev-parse', '--git-dir'], path)
 
         # Does the repository is a valid RCS dir
-        return ret == 0
+        return result.ok
 
     def is_commit(self, path, commit):
-        # Execute 'git show' command and return True of False according to ret code
-        git_show_command = "git show %s" % (commit)
-        ret, output = run_command(git_show_command, path)
+        # Only look the commit up, 'git show' would render the whole patch
+        return self.resolve_commit(path, commit) is not None
+
+    def resolve_commit(self, path, commit):
+        if commit is None:
+            return None
+
+        # Resolved through the persistent 'git cat-file --batch-check', so
+        # resolving many commits costs a single process
+        try:
+            obj = self._get_reader(path, check=True).read("%s^{commit}" % commit)
+        except (IOError, OSError):
+            result = execute(['git', 'rev-parse', '--verify', '--quiet', "%s^{commit}" % commit], path)
+            return result.text.strip() if result.ok else None
+
+        if obj is None or obj[1] != 'commit':
+            return None
+
+        return obj[0]
+
+    def list_revisions(self, path, revision_range):
+        if '..' not in revision_range or '...' in revision_range:
+            return None
 
-        # Valid commit ?
-        return ret == 0
+        # Resolve the start of the range, which rev-list excludes
+        old_commit = revision_range.split('..')[0] or 'HEAD'
+        first = self.resolve_commit(path, old_commit)
+        if first is None:
+            return None
 
+        # Follow the first parent only, so that revisions form a chain
+        result = execute(['git', 'rev-list', '--reverse', '--first-parent', revision_range], path)
+        if not result.ok:
+            return None
+
+        return [first] + result.text.split()
+
+    def list_tags(self, path):
+        result = execute(['git', 'tag', '--sort=creatordate'], path)
+        if not result.ok:
+            return None
+
+        return result.text.split()
 
     def get_relative_paths(self, filename):
         path = os.path.dirname(filename)
         path = '.' if path == '' else path
 
-        # Get the root path of the repository
-        git_path_command= "git rev-parse --show-toplevel"
-        ret, root_path = run_command(git_path_command, path)
-
-        root_path = os.path.abspath(root_path.strip())
+        # Get the root path of the repository, found while detecting the RCS
+        rcs, root_path = find_repository(path)
+        if not isinstance(rcs, Git):
+            result = execute(['git', 'rev-parse', '--show-toplevel'], path)
+            root_path = os.path.abspath(result.text.strip())
 
         # Get the relative path of the file
         relative_path = os.path.dirname(os.path.abspath(filename)[len(root_path)+1:])
@@ -120,8 +471,71 @@ class Git(RCS):
 
         return root_path, relative_path, filename
 
+    def close(self):
+        with self._readers_lock:
+            readers = list(self._readers.values()) + list(self._check_readers.values())
+            readers += [store for store in self._stores.values() if store is not None]
+            self._readers, self._check_readers, self._stores = {}, {}, {}
+
+        for reader in readers:
+            reader.close()
+
+def svn_path(filename):
+    """ Escape a path for svn, which reads anything after a @ as a revision """
+    return filename + '@' if '@' in filename else filename
+
+
 class SVN(RCS):
-    """ SVN Revision Control System class """
+    """ SVN Revision Control System class
+
+        :param export: read the files of a numeric revision from a single
+            `svn export` of the directory of the document, rather than with
+            one `svn cat` (and one server round trip) per file
+    """
+
+    def __init__(self, export=True):
+        self.export = export
+        self._infos = {}
+        self._revisions = {}
+        # (path, revision) -> directory exported for this revision, or None
+        self._exports = {}
+        self._export_locks = {}
+        self._exports_lock = threading.Lock()
+
+    def refresh(self):
+        # The URL of a working copy changes with svn switch
+        self._infos = {}
+
+    def _info(self, path):
+        """ Return the fields of 'svn info' for the working copy `path` """
+        info = self._infos.get(path)
+        if info is None:
+            result = execute(['svn', 'info'], path)
+            info = dict(line.split(': ', 1) for line in result.text.splitlines() if ': ' in line)
+            info = self._infos[path] = info if result.ok else {}
+        return info
+
+    def _repository_id(self, path):
+        """ Return the UUID of the repository and the URL of `path` relative
+            to the root of the repository (`None` if unavailable) """
+        info = self._info(path)
+        uuid, relative_url = info.get('Repository UUID'), info.get('Relative URL')
+        return "%s%s" % (uuid, relative_url[1:]) if uuid and relative_url else None
+
+    def file_id(self, path, commit, filename):
+        # Use current working copy
+        if commit is None:
+            return super(SVN, self).file_id(path, commit, filename)
+
+        # Only numeric revisions are immutable (HEAD, PREV... are not)
+        if not str(commit).isdigit():
+            return None
+
+        repository_id = self._repository_id(path)
+        if repository_id is None:
+            return None
+
+        return "svn:%s/%s@%s" % (repository_id, filename, commit)
 
     def show_file(self, path, commit, filename):
 
@@ -129,36 +543,137 @@ class SVN(RCS):
         if commit is None:
             return super(SVN, self).show_file(path, commit, filename) 
         
+        # Read the file from the export of its revision when it is part of it
+        exported = self._exported_filename(path, commit, filename)
+        if exported is not None:
+            try:
+                with open(exported, 'rb') as f:
+                    return f.read().decode('utf-8').strip()
+            except (IOError, OSError):
+                # File not found for this commit
+                return ""
+
         # Execute 'svn cat' command and return content or empty string
-        svn_cat_command = "svn cat -r %s %s" % (commit, filename)
-        ret, file_content = run_command(svn_cat_command, path)
+        result = execute(['svn', 'cat', '-r', str(commit), svn_path(filename)], path)
 
         # Does the file exist ?
-        if ret:
+        if not result.ok:
             # Return code != 0, file not found for this commit
-            file_content = ""
+            return ""
+
+        return result.text.strip()
+
+    def read_blob(self, path, commit, filename):
+        # Use current working copy
+        if commit is None:
+            return super(SVN, self).read_blob(path, commit, filename)
+
+        exported = self._exported_filename(path, commit, filename)
+        if exported is not None:
+            try:
+                with open(exported, 'rb') as f:
+                    return f.read()
+            except (IOError, OSError):
+                return None
+
+        result = execute(['svn', 'cat', '-r', str(commit), svn_path(filename)], path)
+        return result.stdout if result.ok else None
+
+    def _exported_filename(self, path, commit, filename):
+        """ Return the name of a file in the export of its revision (see
+            `_get_export`), or `None` if it cannot be read from an export
+        """
+        local_filename = os.path.normpath(filename)
+        if not self.export or not str(commit).isdigit() or os.path.isabs(local_filename) \
+                or local_filename.startswith(os.pardir):
+            return None
 
-        return file_content.strip()
+        directory = self._get_export(path, str(commit))
+        return os.path.join(directory, local_filename) if directory is not None else None
+
+    def _get_export(self, path, revision):
+        """ Export the directory `path` at a numeric revision, once
+
+            :return: the exported directory, or `None` if it cannot be exported
+        """
+        key = (path, revision)
+        with self._exports_lock:
+            lock = self._export_locks.setdefault(key, threading.Lock())
+
+        # Concurrent readers of the same revision wait for a single export
+        with lock:
+            if key not in self._exports:
+                self._exports[key] = self._export(path, revision)
+            return self._exports[key]
+
+    def _export(self, path, revision):
+        url = self._info(path).get('URL')
+        if url is None:
+            return None
+
+        directory = tempfile.mkdtemp(prefix='rcs-latexdiff-svn-')
+        export_path = os.path.join(directory, 'r%s' % revision)
+
+        # Same content as 'svn cat': no externals, repository line endings
+        result = execute(['svn', 'export', '-q', '--ignore-externals', '--native-eol', 'LF',
+                          '-r', revision, "%s@%s" % (url, revision), export_path], path)
+        if not result.ok:
+            logger.debug("Could not export %s@%s, falling back to svn cat" % (url, revision))
+            shutil.rmtree(directory, ignore_errors=True)
+            return None
+
+        logger.debug("Exported %s@%s to %s" % (url, revision, export_path))
+        return export_path
+
+    def has_marker(self, path):
+        return os.path.isdir(os.path.join(path, '.svn'))
 
     def is_valid_directory(self, path):
         # Verify that path is a valid repository
-        # Following command do :
-        #   - jump to path
-        #   - svn info
-        #   - jump back to the current dir
-        svn_status_command = "svn info"
-        ret, output = run_command(svn_status_command, path)
+        result = execute(['svn', 'info'], path)
 
         # Does the repository is a valid RCS dir
-        return ret == 0
+        return result.ok
 
     def is_commit(self, path, commit):
-        # Execute 'svn show' command and return True of False according to ret code
-        svn_info_command = "svn info -r %s" % (commit)
-        ret, output = run_command(svn_info_command, path)
+        return self.resolve_commit(path, commit) is not None
+
+    def resolve_commit(self, path, commit):
+        if commit is None:
+            return None
+
+        # Resolve HEAD, PREV, {DATE}... to a numeric revision. Only numeric
+        # revisions are resolved once: the others move with new commits
+        key = (path, str(commit))
+        if key in self._revisions:
+            return self._revisions[key]
+
+        result = execute(['svn', 'info', '-r', str(commit)], path)
+        revision = None
+        for line in result.text.splitlines():
+            if result.ok and line.startswith('Revision: '):
+                revision = line.split(': ', 1)[1].strip()
+        if str(commit).isdigit():
+            self._revisions[key] = revision
+        return revision
 
-        # Valid commit ?
-        return ret == 0
+    def list_revisions(self, path, revision_range):
+        if ':' not in revision_range:
+            return None
+
+        # 'svn log' lists the revisions which changed something in path
+        result = execute(['svn', 'log', '-q', '-r', revision_range], path)
+        if not result.ok:
+            return None
+
+        revisions = [line.split()[0][1:] for line in result.text.splitlines() if line.startswith('r')]
+
+        # Always start from the first revision of the range
+        first = revision_range.split(':')[0]
+        if first.isdigit() and (not revisions or revisions[0] != first):
+            revisions.insert(0, first)
+
+        return revisions
 
     def get_relative_paths(self, filename):
         # In the case of SVN, we can consider use SVN commands whatever the path is
@@ -172,6 +687,248 @@ class SVN(RCS):
 
         return root_path, relative_path, filename
 
+    def close(self):
+        with self._exports_lock:
+            exports, self._exports, self._export_locks = self._exports, {}, {}
+
+        for directory in exports.values():
+            if directory is not None:
+                shutil.rmtree(os.path.dirname(directory), ignore_errors=True)
+
+
+
+class HgCommandServer(object):
+    """ Persistent `hg serve --cmdserver pipe` process bound to a repository
+
+        Commands are sent through the framed protocol of the command server,
+        so that the Python interpreter of Mercurial starts only once.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._process = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        logger.debug("Start hg command server in %s" % self.path)
+        # Plain, untranslated output and UTF-8 file names
+        env = dict(os.environ, HGPLAIN='1', HGENCODING='UTF-8')
+        with open(os.devnull, 'w') as devnull:
+            self._process = subprocess.Popen(['hg', 'serve', '--cmdserver', 'pipe'],
+                cwd=self.path or None, stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE, stderr=devnull, env=env)
+
+        # The server introduces itself on the output channel
+        channel, data = self._read_channel()
+        if channel != b'o' or b'runcommand' not in data:
+            self.close_process()
+            raise IOError("unexpected hello from the hg command server")
+
+    def _read_channel(self):
+        """ Read a message: a channel letter, a big-endian length and data """
+        header = self._process.stdout.read(5)
+        if len(header) < 5:
+            self.close_process()
+            raise IOError("hg command server exited unexpectedly")
+
+        channel, length = header[:1], struct.unpack('>I', header[1:])[0]
+        # Input channels give the size requested, not the size of data
+        if channel in (b'I', b'L'):
+            return channel, length
+        return channel, self._process.stdout.read(length)
+
+    def runcommand(self, args):
+        """ Run a Mercurial command
+
+            :param args: arguments of the command (e.g. ['cat', 'file'])
+            :return: the CommandResult of the command
+            :raise IOError: the server could not be started or died
+
+        """
+        with self._lock:
+            if self._process is None:
+                self._start()
+
+            data = b'\0'.join(arg.encode('utf-8') for arg in args)
+            self._process.stdin.write(b'runcommand\n' + struct.pack('>I', len(data)) + data)
+            self._process.stdin.flush()
+
+            output, error = [], []
+            while True:
+                channel, data = self._read_channel()
+                if channel == b'o':
+                    output.append(data)
+                elif channel == b'e':
+                    error.append(data)
+                elif channel == b'r':
+                    returncode = struct.unpack('>i', data)[0]
+                    break
+                elif channel in (b'I', b'L'):
+                    # Never prompt: answer with an empty input
+                    self._process.stdin.write(struct.pack('>I', 0))
+                    self._process.stdin.flush()
+                elif channel.isupper():
+                    # Required channels cannot be ignored
+                    self.close_process()
+                    raise IOError("unsupported hg command server channel %r" % channel)
+
+            return CommandResult(['hg'] + list(args), returncode, b''.join(output), b''.join(error))
+
+    def close_process(self):
+        if self._process is None:
+            return
+
+        process, self._process = self._process, None
+        try:
+            process.stdin.close()
+        except (IOError, OSError):
+            pass
+        process.wait()
+        process.stdout.close()
+        logger.debug("Stopped hg command server in %s" % self.path)
+
+    def close(self):
+        """ Stop the hg process """
+        with self._lock:
+            self.close_process()
+
+
+class Hg(RCS):
+    """ Mercurial Revision Control System class
+
+        :param server: run commands through a persistent command server
+            rather than one `hg` process per command
+    """
+
+    def __init__(self, server=True):
+        self.server = server
+        self._servers = {}
+        self._servers_lock = threading.Lock()
+        self._revisions = {}
+
+    def _run(self, path, args):
+        if self.server:
+            with self._servers_lock:
+                server = self._servers.get(path)
+                if server is None:
+                    server = self._servers[path] = HgCommandServer(path)
+            try:
+                return server.runcommand(args)
+            except (IOError, OSError) as e:
+                logger.debug("hg command server failed (%s), falling back to hg" % e)
+
+        return execute(['hg'] + list(args), path, env=dict(os.environ, HGPLAIN='1', HGENCODING='UTF-8'))
+
+    def show_file(self, path, commit, filename):
+
+        # Use current working copy
+        if commit is None:
+            return super(Hg, self).show_file(path, commit, filename)
+
+        # 'path:' patterns are exact paths relative to the root of the repository
+        result = self._run(path, ['cat', '-r', str(commit), 'path:%s' % filename])
+
+        # Does the file exist ?
+        if not result.ok:
+            # Return code != 0, file not found for this commit
+            return ""
+
+        return result.text.strip()
+
+    def read_blob(self, path, commit, filename):
+        # Use current working copy
+        if commit is None:
+            return super(Hg, self).read_blob(path, commit, filename)
+
+        result = self._run(path, ['cat', '-r', str(commit), 'path:%s' % filename])
+        return result.stdout if result.ok else None
+
+    def file_id(self, path, commit, filename):
+        # Use current working copy
+        if commit is None:
+            return super(Hg, self).file_id(path, commit, filename)
+
+        # Changesets are immutable: a file of a changeset never changes
+        node = self.resolve_commit(path, commit)
+        if node is None:
+            return None
+
+        return "hg:%s:%s" % (node, filename)
+
+    def has_marker(self, path):
+        return os.path.isdir(os.path.join(path, '.hg'))
+
+    def is_valid_directory(self, path):
+        # Verify that path is a valid repository
+        result = execute(['hg', 'root'], path)
+
+        # Does the repository is a valid RCS dir
+        return result.ok
+
+    def is_commit(self, path, commit):
+        return self.resolve_commit(path, commit) is not None
+
+    def resolve_commit(self, path, commit):
+        if commit is None:
+            return None
+
+        # Full changeset hash. Only full hashes are resolved once: tip, ., a
+        # bookmark or a branch move with new commits
+        key = (path, str(commit))
+        if key in self._revisions:
+            return self._revisions[key]
+
+        result = self._run(path, ['identify', '--debug', '--id', '-r', str(commit)])
+        node = result.text.strip() if result.ok else ''
+        node = node if len(node) == 40 else None
+        if re.match(r'^[0-9a-f]{40}$', str(commit)):
+            self._revisions[key] = node
+        return node
+
+    def list_revisions(self, path, revision_range):
+        if '::' not in revision_range:
+            return None
+
+        # First parents only, so that revisions form a chain
+        end = revision_range.split('::', 1)[1] or '.'
+        revset = "sort((%s) and _firstancestors(%s))" % (revision_range, end)
+        result = self._run(path, ['log', '-r', revset, '--template', '{node}\n'])
+        if not result.ok:
+            return None
+
+        return result.text.split()
+
+    def list_tags(self, path):
+        result = self._run(path, ['tags', '--template', '{tag}\n'])
+        if not result.ok:
+            return None
+
+        # Newest first, without the 'tip' pseudo-tag
+        return [tag for tag in reversed(result.text.splitlines()) if tag != 'tip']
+
+    def get_relative_paths(self, filename):
+        path = os.path.dirname(filename)
+        path = '.' if path == '' else path
+
+        # Get the root path of the repository, found while detecting the RCS
+        rcs, root_path = find_repository(path)
+        if not isinstance(rcs, Hg):
+            result = execute(['hg', 'root'], path)
+            root_path = os.path.abspath(result.text.strip())
+
+        # Get the relative path of the file
+        relative_path = os.path.dirname(os.path.abspath(filename)[len(root_path)+1:])
+
+        filename = os.path.basename(filename)
+
+        return root_path, relative_path, filename
+
+    def close(self):
+        with self._servers_lock:
+            servers, self._servers = list(self._servers.values()), {}
+
+        for server in servers:
+            server.close()
 
 
 # Contains all classes
@@ -181,12 +938,76 @@ for cls in RCS.__subclasses__():
     _RCS.append(cls())
 
 
+# Directory -> (RCS instance, root path of the repository), see find_repository
+_repositories = {}
+_repositories_lock = threading.Lock()
+
+
+def find_repository(path):
+    """ Look for the repository of a directory by walking up the filesystem
+        until a directory holds the metadata of an RCS (see `RCS.has_marker`).
+        Results are cached for every directory of the walk.
+
+        :param path: path of the directory
+        :return: the RCS instance and the root path of the repository, or
+            (None, None) if none or several RCS have been found
+
+    """
+    directory = os.path.abspath(path)
+    visited = []
+    result = (None, None)
+
+    with _repositories_lock:
+        while True:
+            if directory in _repositories:
+                result = _repositories[directory]
+                break
+            visited.append(directory)
+
+            found = [cls for cls in _RCS if cls.has_marker(directory)]
+            if found:
+                # Several RCS for the same directory: let them decide
+                result = (found[0], directory) if len(found) == 1 else (None, None)
+                break
+
+            parent = os.path.dirname(directory)
+            if parent == directory:
+                break
+            directory = parent
+
+        for directory in visited:
+            _repositories[directory] = result
+
+    return result
+
+
+def forget_repositories():
+    """ Forget the results of `find_repository`, repositories having been
+        created or removed since (e.g. between the jobs of the daemon)
+    """
+    with _repositories_lock:
+        _repositories.clear()
+
+
+def get_rcs_instances():
+    """ Return the instances of every RCS class """
+    return list(_RCS)
+
+
 def get_rcs_class(path):
     """ Get the RCS class
 
         :param path: path of the file
         :return: the rcs instance or None if no class is valid
     """
+    # Git may be told where the repository is through its environment
+    if 'GIT_DIR' not in os.environ:
+        rcs, root_path = find_repository(path)
+        if rcs is not None:
+            logger.debug("Found %s repository in %s" % (rcs.__class__.__name__, root_path))
+            return rcs
+
+    # Ambiguous or unusual layout: ask each RCS
     for cls in _RCS:
         if cls.is_valid_directory(path):
             return cls
@@ -2,20 +2,70 @@ from __future__ import print_function, absolute_import
 
 import re
 import argparse
+import json
+import shlex
 import logging
 import os
-import glob
 import sys
 import subprocess
+import time
+import shutil
+import socket
+import threading
 import distutils.spawn
+from concurrent.futures import ThreadPoolExecutor
 
-from .rcs import get_rcs_class
-from .utils import run_command, write_file, remove_latex_comments
+from .rcs import get_rcs_class, get_rcs_instances, forget_repositories
+from .cache import Cache, MemoryCache, make_key, default_cache_dir, DEFAULT_MAX_SIZE
+from .includes import IncludeGraph, IncludeCycleError, unchanged_subtrees
+from .shards import shard_documents, join_diffs
+from .utils import execute, execute_watched, write_file, read_text
+from .server import DiffServer, default_socket_path, send_job
+from .profile import Profiler, Span
+from .build import AssetStore, BuildDirectory, CompileError, CompileScheduler, fatal_error, search_path_env, source_paths, auxiliary_state, bibtex_state
 
 
 logger = logging.getLogger("rcs-latexdiff")
 
-def get_file(rcs, root_path, relative_path, commit, filename):
+def get_graph(rcs, root_path, relative_path, commit, filename, executor=None, cache=None, inline_bbl=False):
+    """ Build the include graph of a file
+
+        :param inline_bbl: replace \\bibliography{} by the .bbl file of the
+            commit (see `inline_bbl_file`)
+        :return: the IncludeGraph instance
+
+    """
+    graph = IncludeGraph(rcs, root_path, relative_path, commit, executor, cache)
+    graph.build(filename)
+    if inline_bbl:
+        inline_bbl_file(graph)
+    return graph
+
+
+def inline_bbl_file(graph):
+    """ Replace the \\bibliography{} commands of a document by its .bbl file
+        (the name of the main file with the .bbl extension), read from the
+        same commit, so that bibtex is not needed to compile it and the
+        changes of the bibliography show in the diff
+
+        :param graph: IncludeGraph of the document
+        :return: whether or not the .bbl file has been inlined
+
+    """
+    bbl_filename = os.path.splitext(graph.root.filename)[0] + ".bbl"
+    path = os.path.join(graph.relative_path, bbl_filename)
+    content = graph.rcs.read_blob(graph.root_path, graph.commit, path)
+    if content is None:
+        logger.info("No %s in commit %s, keeping \\bibliography" % (bbl_filename, graph.commit))
+        return False
+
+    bbl_id = graph.rcs.file_id(graph.root_path, graph.commit, path)
+    count = graph.inline_bibliography(content.decode('utf-8', 'replace'), bbl_filename, bbl_id)
+    logger.info("Inlined %s in place of %d \\bibliography (commit %s)" % (bbl_filename, count, graph.commit))
+    return count > 0
+
+
+def get_file(rcs, root_path, relative_path, commit, filename, executor=None, cache=None):
     # TODO docs path root and relative
     """ Process a File that includes
         - Read a file
@@ -27,63 +77,134 @@ def get_file(rcs, root_path, relative_path, commit, filename):
         :param path: path of the repository
         :param commit: Commit name
         :param filename: Name of the file
+        :param executor: if given, sibling includes are fetched concurrently
+            through this executor
+        :param cache: if given, file and expanded contents are cached into
+            this Cache instance
         :return: the content of the file
 
     """
     # Debug info
     logger.info("> Get file %s" % filename)
 
-    # Read the file
-    file_content = rcs.show_file(root_path, commit, os.path.join(relative_path, filename))
+    # Read the file and its includes, then return the content
+    return get_graph(rcs, root_path, relative_path, commit, filename, executor, cache).expand()
+
+
+def exec_diff(old_filename, new_filename, diff_filename, latexdiff_args):
+    """ Exec Latexdiff
+
+        :param old_filename:
+        :param new_filename:
+        :param diff_filename:
+        :param latexdiff_args: arguments, as a string parsed like a shell would
+        :return: the CommandResult of latexdiff (stdout being in diff_filename)
 
-    # Remove all latex comments
-    file_content = remove_latex_comments(file_content)
+    """
+    argv = ['latexdiff'] + shlex.split(latexdiff_args) + [old_filename, new_filename]
+    with Span('latexdiff', 'diff', file=diff_filename) as span, open(diff_filename, 'wb') as diff_file:
+        result = execute(argv, stdout=diff_file)
+        span.args['returncode'] = result.returncode
 
-    # Look for external inputs
-    external_inputs = re.findall(r"\\(?:input|include)\{[^\}]*\}",file_content)
-    logger.info("Found {} instances of \\include{{}} or \\input{{}} in {}".format(len(external_inputs), filename))
+    if not result.ok:
+        logger.info("latexdiff failed: %s" % result.error_text.strip())
+    return result
 
-    for external_input in external_inputs:
+def get_shard_key(old_shard, new_shard, latexdiff_args):
+    """ Return the cache key of the diff of a pair of shards """
+    return make_key(RESULT_VERSION, latexdiff_args, old_shard, new_shard)
 
 
-        # For each external input, find the name of the file, read it and replace it in the original content
-        input_name = re.search("\{(.*)\}", external_input).group(1)
+def exec_sharded_diff(old_content, new_content, diff_filename, latexdiff_args, jobs=1, cache=None):
+    """ Exec Latexdiff on each section of a document, in parallel
 
-        # Read the content of the input
-        logger.info("Inserting {}...".format(input_name))
+        Both versions are split at aligned \\chapter and \\section headings,
+        each pair of shards is diffed by its own latexdiff process and the
+        results are joined under a single preamble.
+
+        :param jobs: number of latexdiff processes run in parallel
+        :param cache: if given, the diffs of the shards are looked up in (and
+            stored into) this cache, so that only the shards which changed
+            go through latexdiff
+        :return: True if the diff has been made, False if the document could
+            not be split (then nothing has been done)
+
+    """
+    shards = shard_documents(old_content, new_content)
+    if not shards or len(shards) < 2:
+        logger.info("Document cannot be split, running latexdiff on the whole document")
+        return False
+
+    keys = [get_shard_key(old_shard, new_shard, latexdiff_args) for old_shard, new_shard in shards]
+    diffs = [cache.get('shard', key) if cache is not None else None for key in keys]
+
+    filenames = []
+    for i, (old_shard, new_shard) in enumerate(shards):
+        if diffs[i] is not None:
+            continue
+        old_filename = "%s.shard%d.old" % (diff_filename, i)
+        new_filename = "%s.shard%d.new" % (diff_filename, i)
+        write_file(old_shard, old_filename)
+        write_file(new_shard, new_filename)
+        filenames.append((i, old_filename, new_filename, "%s.shard%d.tex" % (diff_filename, i)))
+
+    logger.info("Execute latexdiff on %d of %d shards" % (len(filenames), len(shards)))
+    results = []
+    if filenames:
+        # The threads only wait for latexdiff: unlike worker processes, they
+        # can be started from the threads of the daemon, and report their spans
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = [executor.submit(exec_diff, old_filename, new_filename, shard_filename, latexdiff_args)
+                       for i, old_filename, new_filename, shard_filename in filenames]
+            results = [future.result() for future in futures]
+
+    for (i, old_filename, new_filename, shard_filename), result in zip(filenames, results):
         try:
-            input_content = get_file(rcs, root_path, relative_path, commit, input_name)
+            with open(shard_filename, 'rb') as f:
+                diffs[i] = f.read().decode('utf-8')
         except IOError:
-            input_name += ".tex"
-            logger.info("Inserting {}...".format(input_name))
-            input_content = get_file(rcs, root_path, relative_path, commit, input_name)
-        except:
-            logger.info("Could not find {}, ignoring and hoping for the best.".format(os.path.join(root_path, relative_path, input_name)))
-            input_content = ''
+            diffs[i] = ''
+        if cache is not None and result.ok and diffs[i]:
+            cache.put('shard', keys[i], diffs[i])
 
-        # Add delimiters
-        begin_delimiter = "%% Input %s" % input_name
-        end_delimeter = "%% End of Input %s" % input_name
-        input_content = "%s\n%s\n%s" % (begin_delimiter, input_content, end_delimeter)
+    clean_output_files([filename for shard in filenames for filename in shard[1:]])
 
-        # Replace
-        file_content = file_content.replace(external_input, input_content)
+    diff = join_diffs(diffs)
+    if diff is None:
+        logger.info("latexdiff failed on a shard, running it on the whole document")
+        return False
 
+    write_file(diff, diff_filename)
+    return True
 
-    # Return the content
-    return file_content
 
+# Stands for an unchanged include subtree while running latexdiff
+UNCHANGED_PLACEHOLDER = "\\rcslatexdiffunchanged{%d}"
 
-def exec_diff(old_filename, new_filename, diff_filename, latexdiff_args):
-    """ Exec Latexdiff
 
-        :param old_filename:
-        :param new_filename:
-        :param diff_filename:
-        :param latexdiff_args:
+def stitch_diff(diff_filename, placeholders):
+    """ Put the unchanged include subtrees back into a diff file
+
+        :param placeholders: dict {placeholder: content}
+        :return: True if each placeholder has been found once, and replaced
+            (latexdiff may mark one as both deleted and added, which must not
+            put its subtree twice in the diff)
 
     """
-    run_command("latexdiff %s %s %s > %s" % (latexdiff_args, old_filename, new_filename, diff_filename))
+    with open(diff_filename, 'rb') as f:
+        diff = f.read()
+
+    for placeholder, content in placeholders.items():
+        placeholder = placeholder.encode('utf-8')
+        count = diff.count(placeholder)
+        if count != 1:
+            logger.info("Placeholder %s found %d times in the diff" % (placeholder.decode('utf-8'), count))
+            return False
+        diff = diff.replace(placeholder, content.encode('utf-8'))
+
+    write_file(diff, diff_filename)
+    return True
+
 
 def has_latexmk():
     """
@@ -93,89 +214,170 @@ def has_latexmk():
     """
     return distutils.spawn.find_executable("latexmk")
 
-def exec_latexmk(tex_filename, src_path, repeat=1):
+def run_compiler(stage, argv, cwd, env):
+    """ Run a compiler, reading its output as it is written to stop it on
+        the first fatal error (see `fatal_error`) rather than letting it run
+        its remaining passes
+
+        :param stage: name of the stage, reported by the CompileError
+        :return: the CommandResult
+        :raise CompileError: the compiler stopped on a fatal error
+
+    """
+    started = time.time()
+    result = execute_watched(argv, cwd, env=env, watch=fatal_error)
+    if result.aborted is not None:
+        raise CompileError(stage, result.aborted, time.time() - started)
+    return result
+
+
+def exec_latexmk(tex_filename, src_path, repeat=1, build_dir=None, keep=False, cwd=None):
     """
     Exect latexmk. With -pdf option, this runs pdflatex and bibtex
     enough times until all cross-references have been sorted out.
 
     :param tex_filename: File name of the .tex to compile.
-    :param src_path: Path from which pdflatex will be called (this should
-        make most figures work).
+    :param src_path: Path of the sources, or list of paths, searched by
+        pdflatex and bibtex (see `compile_search_path`).
+    :param build_dir: Directory of the output and auxiliary files (default:
+        a temporary directory).
+    :param cwd: Directory where latexmk runs, against which the file names
+        starting with ./ or ../ are resolved (default: the first path of
+        `src_path`).
+    :param keep: Copy the auxiliary files (.aux, .log...) next to the .tex.
     :return: PDF file name.
+    :raise CompileError: the compilation stopped on a fatal error.
     """
-
-    tex_path = os.path.dirname(tex_filename)
-    if tex_path == '':
-        tex_path = '.'
-
-    aux_filename = os.path.splitext(tex_filename)[0] + ".aux"
     pdf_filename = os.path.splitext(tex_filename)[0] + ".pdf"
 
-    # We enter the folder of the source to get proper relative paths to
-    # figures
-    starting_dir = os.getcwd()
-    if src_path != '':
-        os.chdir(src_path)
+    # Compile from the sources into a directory of our own, finding the
+    # sources through the search paths of TeX: TeX does not search them for
+    # the file names starting with ./ or ../, which are relative to `cwd`
+    build = BuildDirectory(build_dir)
+    env = search_path_env(src_path)
+    cwd = source_paths(src_path)[0] if cwd is None else cwd
 
     # Run pdflatex and bibtex a bunch of times
     try:
         for k in range(repeat):
-            run_command(
-                "latexmk -pdf -interaction=nonstopmode -output-directory={} {}".format(tex_path, tex_filename)
-            )
-        logger.info("Ran latexmk on {} outputting to {}".format(tex_filename, tex_path))
-    except:
-        logger.debug("Problem building pdf file.")
-
-    # Return to original directory
-    os.chdir(starting_dir)
+            with Span('latexmk', 'compile', file=tex_filename, run=k + 1):
+                run_compiler("latexmk run %d" % (k + 1), ['latexmk', '-pdf', '-interaction=nonstopmode',
+                             '-output-directory={}'.format(build.path), os.path.abspath(tex_filename)], cwd, env)
+        build.collect(tex_filename, keep)
+        logger.info("Ran latexmk on {} in {}".format(tex_filename, build.path))
+    except (IOError, OSError) as e:
+        logger.error("Problem building pdf file: %s" % e)
+    finally:
+        build.cleanup()
+
     return pdf_filename
 
 
-def exec_pdflatex(tex_filename, src_path, repeat=1):
+# Upper bound of the pdflatex passes of a build, in case the auxiliary files
+# never settle (e.g. a reference moving a page break back and forth)
+MAX_PDFLATEX_PASSES = 5
+
+
+def exec_pdflatex(tex_filename, src_path, repeat=1, build_dir=None, keep=False, cwd=None):
     """
-    Exect pdflatex
+    Exect pdflatex, as many times as needed for the auxiliary files (.aux,
+    .toc, .bbl...) to stop changing, and bibtex when the citations change
     :param tex_filename: File name of the .tex to compile.
-    :param src_path: Path from which pdflatex will be called (this should
-    make most figures work).
+    :param src_path: Path of the sources, or list of paths, searched by
+    pdflatex and bibtex (see `compile_search_path`).
+    :param build_dir: Directory of the output and auxiliary files (default:
+    a temporary directory), where bibtex runs.
+    :param cwd: Directory where pdflatex runs, against which the file names
+    starting with ./ or ../ are resolved (default: the first path of
+    `src_path`).
+    :param keep: Copy the auxiliary files (.aux, .log...) next to the .tex.
     :return: PDF file name.
+    :raise CompileError: the compilation stopped on a fatal error.
     """
-    tex_path = os.path.dirname(tex_filename)
-    if tex_path == '':
-        tex_path = '.'
+    pdf_filename = os.path.splitext(tex_filename)[0] + ".pdf"
+    jobname = os.path.splitext(os.path.basename(tex_filename))[0]
+
+    # Compile from the sources into a directory of our own, finding the
+    # sources through the search paths of TeX: TeX does not search them for
+    # the file names starting with ./ or ../, which are relative to `cwd`
+    build = BuildDirectory(build_dir)
+    env = search_path_env(src_path)
+    cwd = source_paths(src_path)[0] if cwd is None else cwd
+
+    def single_run(number):
+        with Span('pdflatex', 'compile', file=tex_filename, run=number):
+            run_compiler("pdflatex pass %d" % number, ['pdflatex', '-interaction', 'nonstopmode', '-output-directory',
+                         build.path, os.path.abspath(tex_filename)], cwd, env)
+
+    # Run pdflatex until the auxiliary files do not change anymore, and bibtex
+    # whenever the citations or the bibliography databases change
+    passes = bibtex_runs = 0
+    bibtex_filename = os.path.join(build.path, jobname + '.bibstate')
+    try:
+        # The bibliography of a previous build in the same directory is reused
+        bibtex_done = read_text(bibtex_filename) if os.path.isfile(bibtex_filename) else None
+        for k in range(repeat):
+            state = auxiliary_state(build.path)
+            for i in range(MAX_PDFLATEX_PASSES):
+                passes += 1
+                single_run(passes)
+
+                bibtex = bibtex_state(build.path, src_path)
+                if bibtex is not None and bibtex != bibtex_done:
+                    bibtex_runs += 1
+                    with Span('bibtex', 'compile', file=tex_filename, run=bibtex_runs):
+                        execute(['bibtex', jobname], build.path, env=env)
+                    bibtex_done = bibtex
+                    write_file(bibtex, bibtex_filename)
+
+                previous, state = state, auxiliary_state(build.path)
+                if state == previous:
+                    break
+            else:
+                logger.info("Auxiliary files still changing after %d passes, giving up" % MAX_PDFLATEX_PASSES)
 
-    raw_filename = os.path.splitext(tex_filename)[0]
-    aux_filename = raw_filename + ".aux"
-    pdf_filename = raw_filename + ".pdf"
+        build.collect(tex_filename, keep)
+        logger.info("Ran pdflatex %d times and bibtex %d times." % (passes, bibtex_runs))
+    except (IOError, OSError) as e:
+        logger.error("Problem building pdf file: %s" % e)
+    finally:
+        build.cleanup()
 
-    # We enter the folder of the source to get proper relative paths to
-    # figures
-    starting_dir = os.getcwd()
-    if src_path != '':
-        os.chdir(src_path)
+    return pdf_filename
 
-    def single_run():
-        run_command("pdflatex -interaction nonstopmode -output-directory {} {}".format(tex_path, tex_filename))
+# latexdiff arguments added for the second attempt at a diff which does not
+# compile: no markup in sectioning commands (as with --exclude-section-titles),
+# math and figures, where it breaks the most often
+SAFE_LATEXDIFF_ARGS = ('--exclude-textcmd="chapter,section,subsection,subsubsection,paragraph" '
+                       '--math-markup=off --graphics-markup=none ')
 
-    # Run pdflatex and bibtex a bunch of times
-    try:
-        for k in range(repeat):
-            single_run()
 
-            if os.path.isfile(aux_filename):
-                run_command("bibtex {}".format(raw_filename))
-                run_command("bibtex {}".format(aux_filename))
+def compile_with_fallback(exec_fcn, tex_filename, src_path, remake_diff, **options):
+    """ Compile a diff and, if the compiler stops on a fatal error (see
+        `run_compiler`), make the diff again with safer latexdiff arguments
+        and compile it once more
 
-            single_run()
-            single_run()
+        :param exec_fcn: compile function (`exec_latexmk` or `exec_pdflatex`)
+        :param remake_diff: function making the diff again, into
+            `tex_filename`, with the given latexdiff arguments
+        :param options: arguments of `exec_fcn`
+        :return: the name of the pdf (which does not exist if both attempts
+            failed)
 
-        logger.info("Ran pdflatex and bibtex.")
-    except:
-        logger.debug("Problem building pdf file.")
+    """
+    try:
+        return exec_fcn(tex_filename, src_path, **options)
+    except CompileError as e:
+        logger.error("Could not compile %s: %s" % (tex_filename, e))
+
+    logger.error("Making the diff again with safer latexdiff arguments (%s)" % SAFE_LATEXDIFF_ARGS.strip())
+    remake_diff(SAFE_LATEXDIFF_ARGS)
+    try:
+        return exec_fcn(tex_filename, src_path, **options)
+    except CompileError as e:
+        logger.error("Could not compile %s with safer latexdiff arguments either: %s" % (tex_filename, e))
+    return os.path.splitext(tex_filename)[0] + ".pdf"
 
-    # Return to original directory
-    os.chdir(starting_dir)
-    return pdf_filename
 
 def open_pdf(pdf_filename):
     """
@@ -200,7 +402,114 @@ def open_pdf(pdf_filename):
 
     logger.info("Opened in default {} PDF viewer: {}".format(os_str, pdf_filename))
 
-def make_diff(rcs, old_commit, new_commit, root_path, relative_path, src_filename, dst_filename, latexdiff_args):
+def get_graphs_concurrently(rcs, root_path, relative_path, commits, filename, jobs, cache=None, inline_bbl=False):
+    """ Build the include graph of a file for several commits at once
+
+        Each commit is read in its own thread while the files themselves
+        are fetched through a pool of `jobs` workers.
+
+        :param commits: list of commits
+        :param jobs: maximum number of concurrent RCS fetches
+        :param inline_bbl: see `get_graph`
+        :return: the IncludeGraph of the file for each commit
+
+    """
+    with ThreadPoolExecutor(max_workers=jobs) as fetch_executor:
+        with ThreadPoolExecutor(max_workers=len(commits)) as commit_executor:
+            futures = []
+            for commit in commits:
+                logger.info("Get content (commit %s)..." % commit)
+                futures.append(commit_executor.submit(get_graph, rcs, root_path, relative_path,
+                    commit, filename, fetch_executor, cache, inline_bbl))
+
+            return [future.result() for future in futures]
+
+
+def get_graphs(rcs, root_path, relative_path, old_commit, new_commit, filename, jobs=1, cache=None, inline_bbl=False):
+    """ Build the include graphs of a file for the old and the new commits
+
+        :param jobs: number of files fetched concurrently from the RCS
+            (1 fetches everything sequentially)
+        :param inline_bbl: see `get_graph`
+        :return: the IncludeGraph of both commits
+
+    """
+    if jobs > 1:
+        return get_graphs_concurrently(rcs, root_path, relative_path, [old_commit, new_commit], filename, jobs, cache,
+                                       inline_bbl)
+
+    logger.info("Get old content (commit %s)..." % old_commit)
+    old_graph = get_graph(rcs, root_path, relative_path, old_commit, filename, cache=cache, inline_bbl=inline_bbl)
+    logger.info("Get new content (commit %s)..." % new_commit)
+    new_graph = get_graph(rcs, root_path, relative_path, new_commit, filename, cache=cache, inline_bbl=inline_bbl)
+    return old_graph, new_graph
+
+
+# Version of the diff results, part of their cache keys
+RESULT_VERSION = "1"
+
+
+def get_result_key(rcs, root_path, commits, graphs, *options):
+    """ Return the cache key of a diff
+
+        The key is built from the resolved commits (never from ref names,
+        which move), the content of the flattened files and the options
+        which change the result.
+
+        :param commits: old and new commits
+        :param graphs: IncludeGraph of the old and new commits
+        :param options: latexdiff arguments, compiler...
+
+    """
+    parts = [RESULT_VERSION]
+    for commit, graph in zip(commits, graphs):
+        content_key = graph.root.key() or make_key(graph.expand())
+        parts += [rcs.resolve_commit(root_path, commit) or '', content_key]
+    return make_key(*(parts + [str(option) for option in options]))
+
+
+def get_assets_key(rcs, root_path, relative_path, graphs):
+    """ Return the cache key of the files which the compilation of a diff
+        reads besides the diff (see `IncludeGraph.assets`): their content in
+        the revisions and in the working copy, which is searched as well (see
+        `compile_search_path`)
+
+        :param graphs: IncludeGraph of the old and new commits
+        :return: the key, or `None` if a file cannot be identified
+
+    """
+    parts = [os.path.abspath(os.path.join(root_path, relative_path))]
+    for graph in graphs:
+        for name in graph.assets():
+            path = os.path.normpath(os.path.join(relative_path, name))
+            commits = [None] if graph.commit is None else [graph.commit, None]
+            for commit in commits:
+                if commit is None and not os.path.exists(os.path.join(root_path, path)):
+                    file_id = 'missing'
+                else:
+                    file_id = rcs.file_id(root_path, commit, path)
+                if file_id is None:
+                    return None
+                parts += [name, file_id]
+    return make_key(*parts)
+
+
+def write_include_graphs(old_graph, new_graph, filename):
+    """ Dump the include graphs of both commits as JSON
+
+        :param filename: name of the output file, "-" for stdout
+
+    """
+    graphs = json.dumps({'old': old_graph.to_dict(), 'new': new_graph.to_dict()}, indent=2, sort_keys=True)
+    if filename == '-':
+        print(graphs)
+    else:
+        with open(filename, 'w') as f:
+            f.write(graphs + '\n')
+        logger.info("Include graphs written to %s" % filename)
+
+
+def make_diff(rcs, old_commit, new_commit, root_path, relative_path, src_filename, dst_filename, latexdiff_args, jobs=1, cache=None, dump_includes=None, incremental=False, shard=False, graphs=None):
     # TODO docs path root and relative
     """ Make a diff for a name between two commits
 
@@ -212,6 +521,19 @@ def make_diff(rcs, old_commit, new_commit, root_path, relative_path, src_filenam
         :param src_filename: name of the file
         :param dst_filename: name of the output file
         :param latexdiff_args: args to pass through to latexdiff
+        :param jobs: number of files fetched concurrently from the RCS
+            (1 fetches everything sequentially)
+        :param cache: Cache instance used by `get_file` and
+            `exec_sharded_diff`
+        :param dump_includes: if given, name of the file ("-" for stdout)
+            where the include graphs are dumped as JSON
+        :param incremental: only give latexdiff the parts of the document
+            which changed, the unchanged include subtrees being put back
+            afterwards
+        :param shard: run latexdiff on each section of the document in
+            parallel (see `exec_sharded_diff`), with `jobs` processes
+        :param graphs: include graphs of both commits, if they have already
+            been built (see `get_graphs`)
         :return: destination file and temporary files
 
     """
@@ -223,27 +545,219 @@ def make_diff(rcs, old_commit, new_commit, root_path, relative_path, src_filenam
     logger.info("Output: %s" % dst_filename)
 
     # Get files
-    logger.info("Get old content (commit %s)..." % old_commit)
-    old_content = get_file(rcs, root_path, relative_path, old_commit, src_filename)
-    logger.info("Get new content (commit %s)..." % new_commit)
-    new_content = get_file(rcs, root_path, relative_path, new_commit, src_filename)
-
-    # Write files (in same folder as dst_filename)
+    if graphs is None:
+        graphs = get_graphs(rcs, root_path, relative_path, old_commit, new_commit, src_filename, jobs, cache)
+    old_graph, new_graph = graphs
+
+    if dump_includes:
+        write_include_graphs(old_graph, new_graph, dump_includes)
+
+    # Replace the unchanged include subtrees by placeholders
+    replacements = {}
+    if incremental:
+        unchanged = unchanged_subtrees(old_graph, new_graph)
+        replacements = dict((filename, UNCHANGED_PLACEHOLDER % i) for i, filename in enumerate(unchanged))
+        logger.info("%d unchanged include subtrees skipped by latexdiff" % len(unchanged))
+
+    # Write files (in same folder as dst_filename), streaming the flattened
+    # contents rather than building them in memory
     dst_path = os.path.dirname(os.path.abspath(dst_filename))
     old_filename = os.path.join(dst_path, os.path.basename(dst_filename) + ".old")
     new_filename = os.path.join(dst_path, os.path.basename(dst_filename) + ".new")
 
-    write_file(old_content, old_filename)
-    write_file(new_content, new_filename)
+    old_graph.write(old_filename, replacements=replacements)
+    new_graph.write(new_filename, replacements=replacements)
 
     # Exec diff
     logger.info("Execute latexdiff")
-    exec_diff(old_filename, new_filename, dst_filename, latexdiff_args)
+    if not (shard and exec_sharded_diff(read_text(old_filename), read_text(new_filename),
+                                        dst_filename, latexdiff_args, jobs, cache)):
+        exec_diff(old_filename, new_filename, dst_filename, latexdiff_args)
+
+    if replacements:
+        placeholders = dict((placeholder, ''.join(new_graph.chunks(new_graph.nodes[filename])))
+                            for filename, placeholder in replacements.items())
+        if not stitch_diff(dst_filename, placeholders):
+            logger.info("Could not stitch the diff, running latexdiff on the whole document")
+            old_graph.write(old_filename)
+            new_graph.write(new_filename)
+            exec_diff(old_filename, new_filename, dst_filename, latexdiff_args)
 
     return dst_filename, old_filename, new_filename
 
 
-def parse_arguments():
+def get_asset_store(cache=None):
+    """ Return the AssetStore of the files needed to compile the diffs: in
+        the on-disk cache, or in a temporary directory without one
+
+        :param cache: Cache instance (or MemoryCache in front of one)
+    """
+    backend = getattr(cache, 'backend', cache)
+    path = getattr(backend, 'path', None)
+    return AssetStore(os.path.join(path, 'blob') if path else None)
+
+
+def materialize_assets(rcs, root_path, relative_path, graphs, store):
+    """ Write the figures, bibliographies, styles... of the committed
+        revisions of a diff, as found by `IncludeGraph.assets`, into a new
+        asset tree (see `AssetStore.tree`), the files of the last revisions
+        replacing the ones of the first revisions
+
+        Only the referenced files are read from the RCS, and they are hard
+        linked from the store. Files outside of the directory of the document
+        are left out.
+
+        :param graphs: include graphs of the revisions, oldest first (the
+            working copy is skipped)
+        :param store: AssetStore instance
+        :return: the asset tree, to be removed by the caller
+
+    """
+    tree = store.tree()
+    for graph in graphs:
+        if graph.commit is None:
+            continue
+
+        names = [os.path.normpath(name) for name in graph.assets()]
+        paths = dict((os.path.join(relative_path, name), name) for name in names
+                     if not os.path.isabs(name) and not name.startswith(os.pardir))
+        with Span('assets', 'rcs', commit=graph.commit) as span:
+            blobs = rcs.read_blobs(root_path, graph.commit, sorted(paths))
+            span.args['files'] = len(blobs)
+            span.args['bytes'] = sum(len(content) for content in blobs.values())
+
+        count = store.materialize(dict((paths[path], content) for path, content in blobs.items()), tree)
+        logger.info("Materialized %d files needed to compile commit %s" % (count, graph.commit))
+    return tree
+
+
+def compile_search_path(root_path, relative_path, new_commit, tree):
+    """ Return the directories where the compiler looks for the files of the
+        sources: the asset tree of the revisions (see `materialize_assets`)
+        and the working copy, which is searched first when it is the new
+        revision, and last otherwise for the files which could not be found
+
+        :return: the list of directories
+    """
+    src_path = os.path.join(root_path, relative_path)
+    return [src_path, tree] if new_commit is None else [tree, src_path]
+
+
+def revision_label(revision):
+    """ Return a label of a revision usable in a file name """
+    if re.match(r'^[0-9a-f]{40}$', revision):
+        return revision[:7]
+    return re.sub(r'[^\w.-]+', '_', revision)
+
+
+def make_series(rcs, revisions, root_path, relative_path, src_filename, output_dir, latexdiff_args,
+                jobs=1, cache=None, exec_fcn=None, repeat=1, clean=True, labels=None, inline_bbl=False):
+    """ Make the diffs between each pair of consecutive revisions
+
+        Each revision is flattened only once, its snapshot being shared by the
+        diffs with its predecessor and its successor. Up to `jobs` latexdiff
+        processes run in parallel, and the diffs are compiled by a
+        CompileScheduler of `jobs` workers.
+
+        :param revisions: list of revisions, oldest first
+        :param output_dir: directory of the `diff-<old>-<new>` files
+        :param exec_fcn: compile function (`exec_latexmk` or
+            `exec_pdflatex`), or `None` to skip the compilation
+        :param labels: names of the revisions used in the file names
+            (default: derived from the revisions)
+        :return: summary of the diffs, as written in `index.json`
+
+    """
+    output_dir = os.path.abspath(output_dir)
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+
+    labels = labels or [revision_label(revision) for revision in revisions]
+    logger.info("Making %d diffs into %s" % (len(revisions) - 1, output_dir))
+
+    # Flatten each revision once
+    if jobs > 1:
+        graphs = get_graphs_concurrently(rcs, root_path, relative_path, revisions, src_filename, jobs, cache,
+                                         inline_bbl)
+    else:
+        graphs = [get_graph(rcs, root_path, relative_path, revision, src_filename, cache=cache, inline_bbl=inline_bbl)
+                  for revision in revisions]
+
+    snapshots = []
+    for label, graph in zip(labels, graphs):
+        snapshot = os.path.join(output_dir, "snapshot-%s.tex" % label)
+        graph.write(snapshot)
+        snapshots.append(snapshot)
+
+    # Diff each pair with its own latexdiff process, started from a pool of
+    # threads (which report their spans), and compile each diff as soon as it
+    # is made, in its own build directory
+    store = get_asset_store(cache)
+    trees = []
+    summary = []
+    compiles = []
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = []
+        for i in range(len(revisions) - 1):
+            dst_filename = os.path.join(output_dir, "diff-%s-%s.tex" % (labels[i], labels[i + 1]))
+            futures.append(executor.submit(exec_diff, snapshots[i], snapshots[i + 1], dst_filename, latexdiff_args))
+            summary.append({'old': revisions[i], 'new': revisions[i + 1], 'tex': dst_filename})
+
+        def compile_diff(tex_filename, src_path, **options):
+            i = [entry['tex'] for entry in summary].index(tex_filename)
+            return compile_with_fallback(exec_fcn, tex_filename, src_path,
+                lambda safe_args: exec_diff(snapshots[i], snapshots[i + 1], tex_filename, latexdiff_args + safe_args),
+                cwd=os.path.join(root_path, relative_path), **options)
+
+        with CompileScheduler(compile_diff, jobs) as scheduler:
+            for entry, future in zip(summary, futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    logger.error("Diff between %s and %s failed: %s" % (entry['old'], entry['new'], e))
+                    compiles.append(None)
+                    continue
+                if exec_fcn is None:
+                    compiles.append(None)
+                    continue
+                i = len(compiles)
+                trees.append(materialize_assets(rcs, root_path, relative_path, graphs[i:i + 2], store))
+                src_path = compile_search_path(root_path, relative_path, revisions[i + 1], trees[-1])
+                compiles.append(scheduler.submit(entry['tex'], src_path, repeat, keep=not clean))
+
+    for tree in trees:
+        shutil.rmtree(tree, ignore_errors=True)
+    store.cleanup()
+
+    for entry, future in zip(summary, compiles):
+        try:
+            entry['pdf'] = future.result() if future is not None else None
+        except Exception as e:
+            logger.error("Compilation of %s failed: %s" % (entry['tex'], e))
+            entry['pdf'] = None
+        # The diff is only removed in favour of its pdf
+        if clean:
+            clean_diff_files(entry['tex'], entry['pdf'] is not None)
+            if entry['pdf'] is not None:
+                entry['tex'] = None
+
+    if clean:
+        clean_output_files(snapshots)
+
+    index_filename = os.path.join(output_dir, 'index.json')
+    with open(index_filename, 'w') as f:
+        json.dump({'file': os.path.join(relative_path, src_filename), 'revisions': revisions, 'diffs': summary},
+                  f, indent=2)
+    logger.info("Summary written to %s" % index_filename)
+
+    return summary
+
+
+# Trace written by a bare --profile
+DEFAULT_PROFILE = 'rcs-latexdiff-profile.json'
+
+
+def parse_arguments(argv=None):
 
     description = """\
 A tool to generate LaTeX Diff between two Revision
@@ -261,6 +775,22 @@ EXAMPLE USAGE:
         Display the latexdiff'd PDF of the changes in the "advisor" branch
         compared to the master branch.
 
+    rcs-latexdiff --range HEAD~20..HEAD -o diffs document.tex
+        Create diffs/diff-<old>-<new>.pdf for each of the last 20 commits,
+        along with a summary in diffs/index.json.
+
+    rcs-latexdiff --series tags document.tex
+        Same, for each pair of consecutive tags.
+
+    rcs-latexdiff cache stats
+        Show the size of the on-disk cache of flattened files
+        ("rcs-latexdiff cache prune" evicts its least recently used entries).
+
+    rcs-latexdiff serve &
+    rcs-latexdiff --server document.tex HEAD
+        Start a daemon keeping its caches and RCS processes warm, then
+        let it make the diff ("rcs-latexdiff serve -h" for its options).
+
     rcs-latexdiff --no-open -o /home/myself/thediff.tex git/repo/doc.tex HEAD^^ HEAD
         Create (but don't open) the difference between the HEAD and the
         grandparent of HEAD as /home/myself/thediff.pdf using the git
@@ -296,6 +826,72 @@ EXAMPLE USAGE:
         help="Number of times to run the latex compiler.",
         type=int)
 
+    parser.add_argument("-j", "--jobs",
+        default=1,
+        dest='jobs',
+        help="Number of files fetched concurrently from the RCS. "
+             "Both revisions are fetched at the same time when greater than 1. "
+             "With --range, --series or --shard, also the number of latexdiff "
+             "processes run in parallel.",
+        type=int)
+
+    parser.add_argument('--no-cache', action='store_false',
+        dest='cache',
+        help='Don\'t use the on-disk cache of flattened files and diff '
+             'results (see "rcs-latexdiff cache -h").')
+
+    parser.add_argument('--rebuild', action='store_true',
+        dest='rebuild',
+        help='Don\'t reuse a diff or a pdf found in the cache, make them again.')
+
+    parser.add_argument('--dump-includes', dest='dump_includes', metavar='JSON',
+        help='Write the include graphs of both commits as JSON into this '
+             'file ("-" for stdout).')
+
+    parser.add_argument('--incremental', action='store_true',
+        dest='incremental',
+        help='Don\'t give latexdiff the included files which are the same '
+             'in both commits, and put them back in the diff afterwards.')
+
+    parser.add_argument('--shard', action='store_true',
+        dest='shard',
+        help='Split the document at its \\chapter and \\section headings and '
+             'run latexdiff on each part in parallel (see -j).')
+
+    parser.add_argument('--inline-bbl', action='store_true',
+        dest='inline_bbl',
+        help='Replace \\bibliography{...} by the .bbl file committed next to '
+             'FILE (FILE.bbl) in each revision, so that the changes of the '
+             'bibliography show in the diff and bibtex does not run.')
+
+    parser.add_argument('--range', dest='range', metavar='RANGE',
+        help='Diff each pair of consecutive revisions of a range (OLD..NEW '
+             'for Git, OLD:NEW for SVN, OLD::NEW for Mercurial). OLD and NEW '
+             'are then omitted, and -o is the output directory.')
+
+    parser.add_argument('--series', dest='series', metavar='REVISIONS',
+        help='Same as --range for a comma separated list of revisions, or '
+             '"tags" for every tag.')
+
+    parser.add_argument('--watch', action='store_true',
+        dest='watch',
+        help='Compare OLD with the working copy, then make the diff (and the '
+             'pdf) again whenever one of the included files is saved, until '
+             'interrupted with Ctrl-C.')
+
+    parser.add_argument('--server', action='store_true',
+        dest='server',
+        help='Let a "rcs-latexdiff serve" daemon make the diff.')
+
+    parser.add_argument('--socket', dest='socket', default=default_socket_path(),
+        help='Socket of the daemon for --server (default: %(default)s).')
+
+    parser.add_argument('--profile', dest='profile', metavar='JSON',
+        help='--profile[=JSON]: record how long each stage takes (RCS reads, '
+             'flattening, latexdiff, compiler passes, cleanup), write it as a '
+             'Chrome trace into JSON (default: %s) and print a summary '
+             'on stderr.' % DEFAULT_PROFILE)
+
     parser.add_argument('--utf8', action='store_true',
         dest='utf8',
         help='Pass "--encoding=utf8" to latexdiff.')
@@ -315,14 +911,57 @@ EXAMPLE USAGE:
 
     parser.add_argument('FILE', help='File to be compared.')
 
-    parser.add_argument('OLD', help='Old commit (SHA1 or branch name).')
+    parser.add_argument('OLD', help='Old commit (SHA1 or branch name).',
+        nargs='?')
 
     parser.add_argument('NEW',
         help='New commit (SHA1 or branch name). If omitted, '
         'will use the current working copy as NEW.',
         nargs='?')
 
-    return parser.parse_args()
+    # A bare --profile must not take FILE as its value
+    argv = sys.argv[1:] if argv is None else argv
+    argv = ['--profile=' + DEFAULT_PROFILE if arg == '--profile' else arg for arg in argv]
+
+    args = parser.parse_args(argv)
+    if args.OLD is None and not (args.range or args.series):
+        parser.error("OLD is required unless --range or --series is given")
+    if args.watch and (args.NEW is not None or args.range or args.series):
+        parser.error("--watch compares OLD with the working copy, NEW, --range and --series cannot be given")
+    if args.server and (args.watch or args.range or args.series or args.dump_includes == '-'):
+        parser.error("--server only makes single diffs, written to files")
+    if args.server and args.profile:
+        parser.error("--profile cannot be given with --server, the diff is made by the daemon")
+
+    return args
+
+
+def cache_main(argv):
+    """ Entry point of the `cache` subcommand
+
+        :param argv: arguments following `cache`
+
+    """
+    parser = argparse.ArgumentParser(prog='rcs-latexdiff cache',
+        description='Inspect or prune the on-disk cache of flattened files.')
+    parser.add_argument('--cache-dir', dest='cache_dir',
+        help='Location of the cache (default: %s).' % default_cache_dir())
+    parser.add_argument('--max-size', dest='max_size', type=int, default=DEFAULT_MAX_SIZE,
+        help='Size (in bytes) the cache is pruned to (default: %(default)s).')
+    parser.add_argument('action', choices=['stats', 'prune'])
+    args = parser.parse_args(argv)
+
+    cache = Cache(args.cache_dir, args.max_size)
+    if args.action == 'prune':
+        removed, freed = cache.prune()
+        print("Removed %d entries (%d bytes)" % (removed, freed))
+
+    stats = cache.stats()
+    print("Cache: %s" % stats['path'])
+    print("Entries: %d" % stats['entries'])
+    print("Size: %d / %d bytes" % (stats['size'], stats['max_size']))
+    for namespace, (count, size) in sorted(stats['namespaces'].items()):
+        print("  %s: %d entries, %d bytes" % (namespace, count, size))
 
 
 def init_logger(verbosity):
@@ -344,20 +983,35 @@ def clean_output_files(files):
         :param files: files to be removed
 
     """
-    for filename in files:
-        try:
-            os.remove(filename)
-            logger.info("Removed file: %s" % filename)
-        except OSError:
-            logger.debug("Could not remove file: %s" % filename)
+    with Span('remove', 'cleanup', files=len(files)):
+        for filename in files:
+            try:
+                os.remove(filename)
+                logger.info("Removed file: %s" % filename)
+            except OSError:
+                logger.debug("Could not remove file: %s" % filename)
+
+def clean_diff_files(dst_filename, makepdf):
+    """ Clean the files made along with a diff file (its flattened inputs),
+        and the diff file itself if a pdf has been built
+
+        The compilers run in their own build directories, so nothing else is
+        left next to the diff file.
+
+        :param dst_filename: name of the diff file
+        :param makepdf: whether or not a pdf has been built
+
+    """
+    files = [dst_filename + ".old", dst_filename + ".new"]
+    if makepdf:
+        files.append(dst_filename)
+
+    clean_output_files(files)
 
 def check_latexdiff():
     """ Check that latexdiff binary is in the PATH """
-    check_latexdiff = ("where" if sys.platform == "win32" else "which") + " latexdiff"
-    ret, output = run_command(check_latexdiff)
-
     # latexdiff tool not available ?
-    if ret:
+    if not distutils.spawn.find_executable("latexdiff"):
         print("""latexdiff tool not found in PATH
 Install it or correct your PATH
 
@@ -372,14 +1026,155 @@ You can install it as follows:
 
 
 
-def main():
-    # Make sure that latexdiff is available
+def serve_main(argv):
+    """ Entry point of the `serve` subcommand
+
+        :param argv: arguments following `serve`
+
+    """
+    parser = argparse.ArgumentParser(prog='rcs-latexdiff serve',
+        description='Run diff jobs sent by "rcs-latexdiff --server", keeping '
+                    'the RCS processes and the caches warm between jobs.')
+    parser.add_argument('--socket', dest='socket', default=default_socket_path(),
+        help='Unix socket to listen on (default: %(default)s).')
+    parser.add_argument('-w', '--workers', dest='workers', type=int, default=2,
+        help='Number of jobs run concurrently (default: %(default)s).')
+    parser.add_argument('--no-cache', action='store_false', dest='cache',
+        help='Don\'t use the on-disk cache, only keep entries in memory.')
+    parser.add_argument('-v', '--verbose', action='store_const',
+        const=logging.INFO, dest='verbosity',
+        help='Show all messages.')
+    parser.add_argument('-D', '--debug', action='store_const',
+        const=logging.DEBUG, dest='verbosity',
+        help='Show all message, including debug messages.')
+    args = parser.parse_args(argv)
+    init_logger(args.verbosity)
+
+    # Make sure that latexdiff is available, once for all jobs
     check_latexdiff()
 
+    # Entries of the on-disk cache used by the jobs are kept in memory
+    cache = MemoryCache(backend=Cache() if args.cache else None)
+    server = DiffServer(args.socket, lambda job: run_job(job, cache), args.workers)
+    try:
+        server.bind()
+    except (IOError, OSError) as e:
+        logger.error(str(e))
+        exit(1)
+
+    print("Listening on %s, press Ctrl-C to stop" % args.socket)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        close_rcs()
+        cache.prune()
+
+
+# Output file name -> lock held by the job of the daemon writing it
+_output_locks = {}
+_output_locks_lock = threading.Lock()
+
+
+def output_lock(filename):
+    """ Return the lock of the jobs of the daemon writing the diff
+        `filename`, and the files next to it (.old, .new, .pdf...)
+    """
+    with _output_locks_lock:
+        return _output_locks.setdefault(os.path.abspath(filename), threading.Lock())
+
+
+def run_job(job, cache=None):
+    """ Make a diff for the daemon (see `serve_main`)
+
+        Jobs writing the same diff file (e.g. different commits of a document
+        without -o) run one at a time.
+
+        :param job: parsed command line arguments of the client, as a dict
+            (see `send_to_server`)
+        :param cache: Cache instance (`None` to disable caching)
+        :return: the result of the job: the names of the diff and of the pdf
+            (`None` if not built), or an error message
+
+    """
+    args = argparse.Namespace(**job)
+    logger.info("Job: %s %s %s" % (args.FILE, args.OLD, args.NEW or ''))
+
+    # Repositories and working copies may have changed since the last job
+    forget_repositories()
+    dirname = os.path.dirname(args.FILE)
+    rcs = get_rcs_class('.' if dirname == '' else dirname)
+    if not rcs:
+        return {'ok': False, 'error': "No RCS repository found"}
+    rcs.refresh()
+
+    root_path, relative_path, filename = rcs.get_relative_paths(args.FILE)
+    try:
+        with output_lock(output_filename(root_path, relative_path, args)):
+            tex_filename, pdf_filename = run(rcs, args, cache)
+    except SystemExit:
+        return {'ok': False, 'error': "The diff could not be made, see the log of the daemon"}
+
+    return {'ok': True, 'tex': tex_filename, 'pdf': pdf_filename}
+
+
+def send_to_server(args):
+    """ Send the diff requested on the command line to the daemon (--server)
+
+        :param args: parsed command line arguments
+
+    """
+    job = dict(vars(args))
+    # Paths are resolved by the client, the pdf is opened by the client
+    job['FILE'] = os.path.abspath(args.FILE)
+    if args.output is not None:
+        job['output'] = os.path.abspath(args.output)
+    if args.dump_includes:
+        job['dump_includes'] = os.path.abspath(args.dump_includes)
+    job['openpdf'] = False
+    job['server'] = False
+
+    try:
+        result = send_job(args.socket, job)
+    except socket.error as e:
+        logger.error("Could not reach the daemon on %s: %s" % (args.socket, e))
+        exit(1)
+
+    if not result.get('ok'):
+        logger.error(result.get('error'))
+        exit(1)
+
+    print(result['pdf'] or result['tex'])
+    if args.openpdf and result['pdf']:
+        open_pdf(result['pdf'])
+
+
+def close_rcs():
+    """ Stop the processes kept alive by every RCS (e.g. git cat-file --batch) """
+    for rcs in get_rcs_instances():
+        rcs.close()
+
+
+def main():
+    # Subcommands
+    if sys.argv[1:2] == ['cache']:
+        return cache_main(sys.argv[2:])
+    if sys.argv[1:2] == ['serve']:
+        return serve_main(sys.argv[2:])
+
     # Parse arguments, init logger and extract information
     args = parse_arguments()
     init_logger(args.verbosity)
 
+    # The daemon makes the diff
+    if args.server:
+        return send_to_server(args)
+
+    # Make sure that latexdiff is available
+    check_latexdiff()
+
     # Get the current rcs class
     dirname = os.path.dirname(args.FILE)
     path = '.' if dirname == '' else dirname
@@ -388,44 +1183,241 @@ def main():
         logger.info("No RCS repository found")
         exit(1)
 
-    root_path, relative_path, filename = rcs.get_relative_paths(args.FILE)
+    cache = Cache() if args.cache else None
 
-    # Ensure that commits exist
-    for commit in [args.OLD, args.NEW]:
-        if not rcs.is_commit(root_path, commit) and commit is not None:
-            logger.info("Commit does not exist: %s" % (commit))
-            exit(1)
+    # Record the duration of every stage
+    profiler = Profiler() if args.profile else None
+    if profiler is not None:
+        profiler.start()
 
-    # Populate the default output file
-    if args.output is None:
-        dst_filename = os.path.join(root_path, relative_path, 'diff.tex')
+    try:
+        if args.range or args.series:
+            run_series(rcs, args, cache)
+        elif args.watch:
+            watch(rcs, args, cache)
+        else:
+            run(rcs, args, cache)
+    finally:
+        # Stop any process kept alive by the RCS (e.g. git cat-file --batch)
+        rcs.close()
+
+        # Keep the cache within its size limit
+        if cache is not None:
+            cache.prune()
+
+        if profiler is not None:
+            profiler.stop()
+            write_profile(profiler, args.profile)
+
+
+def write_profile(profiler, filename):
+    """ Write the trace of a run and print its summary on stderr
+
+        :param profiler: Profiler instance which recorded the run
+        :param filename: name of the trace file
+
+    """
+    try:
+        profiler.write(filename)
+    except (IOError, OSError) as e:
+        logger.error("Could not write the profile: %s" % e)
+        return
+    print(profiler.summary(), file=sys.stderr)
+
+
+def choose_compiler(args):
+    """ Return the function used to compile the diff: exec_latexmk or exec_pdflatex
+
+        :param args: parsed command line arguments
+
+    """
+    if has_latexmk() and not args.force_pdflatex:
+        logger.info("Proceeding with latexmk.")
+        return exec_latexmk
+
+    if args.force_pdflatex:
+        logger.info("latexmk found but you said not to use it...using pdflatex and bibtex")
     else:
-        dst_filename = args.output
+        logger.info("latexmk wasn't found...using pdflatex and bibtex")
+    return exec_pdflatex
 
-    # Gather arguments to pass through to latexdiff
+
+def get_latexdiff_args(args):
+    """ Gather arguments to pass through to latexdiff
+
+        :param args: parsed command line arguments
+
+    """
     latexdiff_args = ''
     if args.exclude_sections:
         latexdiff_args += '--exclude-textcmd="section,subsection" '
     if args.utf8:
         latexdiff_args += '--encoding=utf8 '
+    return latexdiff_args
+
+
+def resolve_commits(rcs, root_path, commits):
+    """ Resolve commit names to their immutable identifiers, exiting if one
+        of them does not exist
+
+        :param commits: list of commit names (`None` for the working copy)
+        :return: list of identifiers (`None` for the working copy)
+
+    """
+    resolved = rcs.resolve_commits(root_path, commits)
+    for commit, commit_id in zip(commits, resolved):
+        if commit is not None and commit_id is None:
+            logger.info("Commit does not exist: %s" % (commit))
+            exit(1)
+        if commit is not None:
+            logger.debug("Commit %s resolved to %s" % (commit, commit_id))
+    return resolved
+
+
+def run_series(rcs, args, cache=None):
+    """ Make the diffs of a range or a series of revisions (--range/--series)
+
+        :param rcs: Rcs instance
+        :type rcs: RCS object
+        :param args: parsed command line arguments
+        :param cache: Cache instance (`None` to disable caching)
+
+    """
+    root_path, relative_path, filename = rcs.get_relative_paths(args.FILE)
+
+    if args.range:
+        names = rcs.list_revisions(root_path, args.range)
+    elif args.series == 'tags':
+        names = rcs.list_tags(root_path)
+    else:
+        names = [revision.strip() for revision in args.series.split(',') if revision.strip()]
+
+    if not names or len(names) < 2:
+        logger.info("Not enough revisions to diff")
+        exit(1)
+
+    revisions = resolve_commits(rcs, root_path, names)
+
+    if args.output is None:
+        output_dir = os.path.join(root_path, relative_path, 'diffs')
+    else:
+        output_dir = args.output
+
+    exec_fcn = choose_compiler(args) if args.makepdf else None
+
+    try:
+        make_series(rcs, revisions, root_path, relative_path, filename, output_dir, get_latexdiff_args(args),
+            jobs=args.jobs, cache=cache, exec_fcn=exec_fcn, repeat=args.repeat, clean=args.clean,
+            labels=[revision_label(name) for name in names], inline_bbl=args.inline_bbl)
+    except IncludeCycleError as e:
+        logger.error(str(e))
+        exit(1)
+
+
+def output_filename(root_path, relative_path, args):
+    """ Return the name of the diff file: the output file, or `diff.tex`
+        next to the document
+    """
+    if args.output is None:
+        return os.path.join(root_path, relative_path, 'diff.tex')
+    return args.output
+
+
+def run(rcs, args, cache=None):
+    """ Make the diff (and the pdf) requested on the command line
+
+        :param rcs: Rcs instance
+        :type rcs: RCS object
+        :param args: parsed command line arguments
+        :param cache: Cache instance (`None` to disable caching)
+        :return: the name of the diff and of the pdf (`None` if not built)
+
+    """
+    root_path, relative_path, filename = rcs.get_relative_paths(args.FILE)
+
+    # Ensure that commits exist, and only use their immutable identifiers
+    # from now on
+    old_commit, new_commit = resolve_commits(rcs, root_path, [args.OLD, args.NEW])
+
+    dst_filename = output_filename(root_path, relative_path, args)
+
+    # Gather arguments to pass through to latexdiff
+    latexdiff_args = get_latexdiff_args(args)
+    exec_fcn = choose_compiler(args) if args.makepdf else None
 
     # Make the diff
-    make_diff(rcs, args.OLD, args.NEW, root_path, relative_path, filename, dst_filename, latexdiff_args)
+    try:
+        graphs = get_graphs(rcs, root_path, relative_path, old_commit, new_commit, filename, args.jobs, cache,
+                            args.inline_bbl)
+
+        # Look for the diff (and the pdf) in the cache
+        tex_key = pdf_key = None
+        have_tex = have_pdf = False
+        if cache is not None:
+            tex_key = get_result_key(rcs, root_path, [old_commit, new_commit], graphs, latexdiff_args,
+                                     args.incremental, args.shard, args.inline_bbl)
+            # The pdf also depends on the figures, bibliographies... it is
+            # compiled with
+            assets_key = get_assets_key(rcs, root_path, relative_path, graphs) if exec_fcn is not None else None
+            if assets_key is not None:
+                pdf_key = make_key(tex_key, assets_key, exec_fcn.__name__, str(args.repeat))
+
+            if not args.rebuild:
+                pdf_filename = os.path.splitext(dst_filename)[0] + ".pdf"
+                have_pdf = pdf_key is not None and cache.get_file('result', pdf_key, pdf_filename)
+                have_tex = cache.get_file('result', tex_key, dst_filename)
+                if have_pdf or have_tex:
+                    logger.info("Reusing the %s found in the cache" % ("pdf" if have_pdf else "diff"))
+
+        if not (have_tex or have_pdf):
+            make_diff(rcs, old_commit, new_commit, root_path, relative_path, filename, dst_filename, latexdiff_args,
+                jobs=args.jobs, cache=cache, dump_includes=args.dump_includes,
+                incremental=args.incremental, shard=args.shard, graphs=graphs)
+            if tex_key is not None and os.path.isfile(dst_filename):
+                cache.put_file('result', tex_key, dst_filename)
+        elif args.dump_includes:
+            write_include_graphs(graphs[0], graphs[1], args.dump_includes)
+    except IncludeCycleError as e:
+        logger.error(str(e))
+        exit(1)
 
     # Make the pdf
-    if args.makepdf:
-        if has_latexmk() and not args.force_pdflatex:
-            logger.info("Proceeding with latexmk.")
-            exec_fcn = exec_latexmk
-        else:
-            if args.force_pdflatex:
-                logger.info("latexmk found but you said not to use it...using pdflatex and bibtex")
-            else:
-                logger.info("latexmk wasn't found...using pdflatex and bibtex")
-            exec_fcn = exec_pdflatex
-        if args.repeat > 1:
-            logger.info("Going to try and repeat the build function {} times...standby".format(args.repeat))
-        pdf_filename = exec_fcn(dst_filename, os.path.join(root_path, relative_path), repeat=args.repeat)
+    if exec_fcn is not None:
+        if not have_pdf:
+            if args.repeat > 1:
+                logger.info("Going to try and repeat the build function {} times...standby".format(args.repeat))
+            started = time.time()
+
+            # Compile against the figures, bibliographies... of the commits
+            store = get_asset_store(cache)
+            tree = materialize_assets(rcs, root_path, relative_path, graphs, store)
+            # The diff made with safer arguments has its own key, so that it
+            # never stands for the diff asked for
+            safe_keys = []
+            def remake_diff(safe_args):
+                safe_key = make_key(tex_key, safe_args) if tex_key is not None else None
+                safe_keys.append(safe_key)
+                if safe_key is None or not cache.get_file('result', safe_key, dst_filename):
+                    make_diff(rcs, old_commit, new_commit, root_path, relative_path, filename, dst_filename,
+                        latexdiff_args + safe_args, jobs=args.jobs, cache=cache, incremental=args.incremental,
+                        shard=args.shard, graphs=graphs)
+
+            try:
+                pdf_filename = compile_with_fallback(exec_fcn, dst_filename,
+                    compile_search_path(root_path, relative_path, new_commit, tree), remake_diff,
+                    repeat=args.repeat, keep=not args.clean, cwd=os.path.join(root_path, relative_path))
+            finally:
+                shutil.rmtree(tree, ignore_errors=True)
+                store.cleanup()
+
+            # Only cache a pdf built by this run, and the safer diff once it
+            # compiles
+            built = os.path.isfile(pdf_filename) and os.path.getmtime(pdf_filename) >= int(started)
+            if built and safe_keys:
+                if safe_keys[0] is not None:
+                    cache.put_file('result', safe_keys[0], dst_filename)
+            elif built and pdf_key is not None:
+                cache.put_file('result', pdf_key, pdf_filename)
 
         # Open the pdf
         if args.openpdf:
@@ -434,11 +1426,157 @@ def main():
     # Clean output files
     if args.clean:
         # Clean everything except diff.pdf or diff.tex depending on makepdf
-        clean_glob = glob.glob(os.path.splitext(dst_filename)[0] + '.*')
-        keep_ext = 'pdf' if args.makepdf else 'tex'
-        clean_glob = [f for f in clean_glob if f[-3:] != keep_ext]
+        clean_diff_files(dst_filename, args.makepdf)
+
+    if exec_fcn is None or not os.path.isfile(pdf_filename):
+        pdf_filename = None
+    return dst_filename, pdf_filename
+
+
+
+# Polling period of --watch, and time during which the files must not change
+# before the diff is made again (editors often save in several steps)
+WATCH_INTERVAL = 0.5
+WATCH_DEBOUNCE = 0.3
+
+
+def watched_files(graph):
+    """ Return the files of a working copy include graph, including the
+        includes which could not be found, as they may be created
+
+        :param graph: IncludeGraph of the working copy
+        :return: sorted list of file names
+    """
+    path = os.path.join(graph.root_path, graph.relative_path)
+    filenames = set()
+    if graph.bibliography:
+        filenames.add(os.path.join(path, graph.bibliography))
+    for node in graph.nodes.values():
+        filenames.add(os.path.join(path, node.filename))
+        for name, input_name, child in node.includes:
+            if child is None:
+                filenames.update([os.path.join(path, name), os.path.join(path, input_name)])
+    return sorted(filenames)
+
+
+def file_states(filenames):
+    """ Return the modification time and size of files (`None` if missing) """
+    states = {}
+    for filename in filenames:
+        try:
+            st = os.stat(filename)
+            states[filename] = (st.st_mtime, st.st_size)
+        except OSError:
+            states[filename] = None
+    return states
+
+
+def wait_for_changes(filenames, interval=WATCH_INTERVAL, debounce=WATCH_DEBOUNCE):
+    """ Poll files until some of them change and then stay unchanged for
+        `debounce` seconds
+
+        :return: the changed files
+    """
+    states = file_states(filenames)
+    while True:
+        time.sleep(interval)
+        current = file_states(filenames)
+        if current != states:
+            break
+
+    while True:
+        time.sleep(debounce)
+        settled = file_states(filenames)
+        if settled == current:
+            break
+        current = settled
+
+    return [filename for filename in filenames if current[filename] != states[filename]]
+
+
+def watch(rcs, args, cache=None):
+    """ Make the diff between OLD and the working copy again each time one of
+        the included files changes (--watch)
 
-        clean_output_files(clean_glob)
+        OLD is flattened once. The working copy files are kept in memory and
+        read again only when they change, and the diff is made per section
+        (see `exec_sharded_diff`), latexdiff running only on the sections
+        which changed. The auxiliary files are kept between two builds, so
+        that the compiler reuses them.
+
+        :param cache: Cache instance used for OLD (`None` to disable caching)
+
+    """
+    root_path, relative_path, filename = rcs.get_relative_paths(args.FILE)
+    old_commit, = resolve_commits(rcs, root_path, [args.OLD])
+
+    if args.output is None:
+        dst_filename = os.path.join(root_path, relative_path, 'diff.tex')
+    else:
+        dst_filename = args.output
+
+    latexdiff_args = get_latexdiff_args(args)
+    exec_fcn = choose_compiler(args) if args.makepdf else None
+
+    try:
+        old_graph = get_graph(rcs, root_path, relative_path, old_commit, filename, cache=cache,
+                              inline_bbl=args.inline_bbl)
+    except IncludeCycleError as e:
+        logger.error(str(e))
+        exit(1)
+
+    # Working copy files and shard diffs of this session, and a build directory
+    # whose auxiliary files are reused from one build to the next
+    session = MemoryCache()
+    build = BuildDirectory()
+    store = get_asset_store(cache)
+    src_path = None
+    filenames = [os.path.join(root_path, relative_path, filename)]
+    opened = False
+
+    try:
+        while True:
+            try:
+                new_graph = get_graph(rcs, root_path, relative_path, None, filename, cache=session,
+                                      inline_bbl=args.inline_bbl)
+            except (IOError, IncludeCycleError) as e:
+                logger.error(str(e))
+                new_graph = None
+
+            if new_graph is not None:
+                filenames = watched_files(new_graph)
+                make_diff(rcs, old_commit, None, root_path, relative_path, filename, dst_filename, latexdiff_args,
+                    jobs=args.jobs, cache=session, incremental=args.incremental, shard=True,
+                    graphs=(old_graph, new_graph))
+
+                if exec_fcn is not None:
+                    # The files of OLD (e.g. removed figures) are materialized once
+                    if src_path is None:
+                        src_path = compile_search_path(root_path, relative_path, None,
+                                                       materialize_assets(rcs, root_path, relative_path, [old_graph], store))
+                    pdf_filename = compile_with_fallback(exec_fcn, dst_filename, src_path,
+                        lambda safe_args: make_diff(rcs, old_commit, None, root_path, relative_path, filename,
+                            dst_filename, latexdiff_args + safe_args, jobs=args.jobs, cache=session,
+                            incremental=args.incremental, shard=True, graphs=(old_graph, new_graph)),
+                        build_dir=build.path, cwd=os.path.join(root_path, relative_path))
+                    if args.openpdf and not opened and os.path.isfile(pdf_filename):
+                        open_pdf(pdf_filename)
+                        opened = True
+
+            print("Watching %d files, press Ctrl-C to stop" % len(filenames))
+            changed = wait_for_changes(filenames)
+            print("Changed: %s" % ", ".join(os.path.relpath(changed_filename) for changed_filename in changed))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        build.cleanup()
+        if src_path is not None:
+            shutil.rmtree(src_path[1], ignore_errors=True)
+        store.cleanup()
+
+    # Clean output files
+    if args.clean:
+        clean_diff_files(dst_filename, args.makepdf)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,155 @@
+from __future__ import print_function, absolute_import
+
+import os
+import json
+import errno
+import socket
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+logger = logging.getLogger("rcs-latexdiff")
+
+
+def default_socket_path():
+    """ Return the default socket of the daemon ($XDG_RUNTIME_DIR/rcs-latexdiff.sock) """
+    base = os.environ.get('XDG_RUNTIME_DIR') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'rcs-latexdiff.sock')
+
+
+def job_key(job):
+    """ Return a key identifying a job, identical jobs having the same key """
+    return json.dumps(job, sort_keys=True)
+
+
+class _JobHandler(socketserver.StreamRequestHandler):
+    """ Read one job (a line of JSON) and answer with its result """
+
+    def handle(self):
+        line = self.rfile.readline()
+        try:
+            job = json.loads(line.decode('utf-8'))
+            response = self.server.diff_server.submit(job).result()
+        except Exception as e:
+            logger.debug("Job failed: %s" % e)
+            response = {'ok': False, 'error': str(e) or e.__class__.__name__}
+        self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class DiffServer(object):
+    """ Daemon running diff jobs received on a Unix socket
+
+        Jobs are JSON objects sent on a single line, and answered with a
+        single line of JSON. They run in a bounded pool of workers, and
+        identical jobs submitted while one of them is running share its result.
+
+        :param path: path of the socket
+        :param handler: function running a job and returning its result (a
+            JSON-serializable dict)
+        :param workers: number of jobs run concurrently
+    """
+
+    def __init__(self, path, handler, workers=1):
+        self.path = path
+        self.handler = handler
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self._running = {}
+        self._lock = threading.Lock()
+        self._server = None
+
+    def submit(self, job):
+        """ Run a job, or join the identical job already running
+
+            :return: a Future of the result
+        """
+        key = job_key(job)
+        with self._lock:
+            future = self._running.get(key)
+            if future is None:
+                future = self._running[key] = self.executor.submit(self._run, key, job)
+            else:
+                logger.info("Joining an identical job in progress")
+        return future
+
+    def _run(self, key, job):
+        try:
+            return self.handler(job)
+        finally:
+            with self._lock:
+                del self._running[key]
+
+    def bind(self):
+        """ Listen on the socket, replacing a stale one
+
+            :raise IOError: another daemon is listening on the socket
+        """
+        if os.path.exists(self.path):
+            if is_listening(self.path):
+                raise IOError(errno.EADDRINUSE, "A daemon is already listening on %s" % self.path)
+            os.remove(self.path)
+
+        self._server = _UnixServer(self.path, _JobHandler)
+        self._server.diff_server = self
+        os.chmod(self.path, 0o600)
+
+    def serve_forever(self):
+        """ Serve jobs until `shutdown` is called """
+        if self._server is None:
+            self.bind()
+        logger.info("Listening on %s" % self.path)
+        self._server.serve_forever()
+
+    def shutdown(self):
+        """ Stop serving (from another thread) """
+        self._server.shutdown()
+
+    def close(self):
+        """ Wait for the running jobs and remove the socket """
+        if self._server is not None:
+            self._server.server_close()
+            self._server = None
+        self.executor.shutdown(wait=True)
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+def is_listening(path):
+    """ Return whether or not a daemon is listening on the socket `path` """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(path)
+        return True
+    except socket.error:
+        return False
+    finally:
+        client.close()
+
+
+def send_job(path, job):
+    """ Send a job to the daemon listening on `path` and wait for its result
+
+        :return: the result of the job
+        :raise socket.error: no daemon is listening on `path`
+    """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(path)
+        client.sendall(json.dumps(job).encode('utf-8') + b'\n')
+        response = client.makefile('rb').readline()
+    finally:
+        client.close()
+
+    if not response:
+        raise socket.error("The daemon closed the connection")
+    return json.loads(response.decode('utf-8'))
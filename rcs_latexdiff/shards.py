@@ -0,0 +1,97 @@
+from __future__ import print_function, absolute_import
+
+import re
+import difflib
+import logging
+
+logger = logging.getLogger("rcs-latexdiff")
+
+_BEGIN_DOCUMENT = '\\begin{document}'
+_END_DOCUMENT = '\\end{document}'
+
+# Headings at which a document may be split
+_HEADING = re.compile(r"^[ \t]*\\(?:chapter|section)\*?[ \t]*(?:\[[^\]\n]*\])?[ \t]*\{.*$", re.MULTILINE)
+
+
+def split_document(content):
+    """ Split a document into its preamble, its body and its end
+
+        :return: the preamble (up to and including \\begin{document}), the
+            body and the end (from \\end{document}), or `None` if the document
+            has no body
+    """
+    begin = content.find(_BEGIN_DOCUMENT)
+    end = content.rfind(_END_DOCUMENT)
+    if begin == -1 or end == -1 or end < begin:
+        return None
+
+    begin += len(_BEGIN_DOCUMENT)
+    return content[:begin], content[begin:end], content[end:]
+
+
+def headings(body):
+    """ Return the positions and the lines of the \\chapter and \\section headings """
+    return [(match.start(), match.group(0).strip()) for match in _HEADING.finditer(body)]
+
+
+def align_shards(old_body, new_body):
+    """ Split two versions of a body into pairs of shards at aligned headings
+
+        Headings are matched by their text; only the headings which appear
+        exactly once in each version are used, so that the alignment is never
+        ambiguous. Without such headings, the whole bodies form a single shard.
+
+        :return: list of (old shard, new shard); joining the old (resp. new)
+            shards gives back the old (resp. new) body
+    """
+    old_headings, new_headings = headings(old_body), headings(new_body)
+    old_titles = [title for pos, title in old_headings]
+    new_titles = [title for pos, title in new_headings]
+
+    matcher = difflib.SequenceMatcher(None, old_titles, new_titles, autojunk=False)
+    boundaries = [(0, 0)]
+    for i, j, size in matcher.get_matching_blocks():
+        for k in range(size):
+            title = old_titles[i + k]
+            if old_titles.count(title) == 1 and new_titles.count(title) == 1:
+                boundaries.append((old_headings[i + k][0], new_headings[j + k][0]))
+    boundaries.append((len(old_body), len(new_body)))
+
+    shards = []
+    for (old_start, new_start), (old_end, new_end) in zip(boundaries, boundaries[1:]):
+        if old_start == old_end and new_start == new_end:
+            continue
+        shards.append((old_body[old_start:old_end], new_body[new_start:new_end]))
+
+    logger.info("Document split into %d shards" % len(shards))
+    return shards
+
+
+def shard_documents(old_content, new_content):
+    """ Split two versions of a document into standalone shard documents
+
+        Each shard document is made of the preamble, the shard and the end
+        of its version of the document.
+
+        :return: list of (old document, new document), or `None` if the
+            documents cannot be split
+    """
+    old_parts, new_parts = split_document(old_content), split_document(new_content)
+    if old_parts is None or new_parts is None:
+        return None
+
+    return [(old_parts[0] + old_shard + old_parts[2], new_parts[0] + new_shard + new_parts[2])
+            for old_shard, new_shard in align_shards(old_parts[1], new_parts[1])]
+
+
+def join_diffs(diffs):
+    """ Join the diffs of the shard documents into a single document
+
+        :param diffs: latexdiff outputs, in order
+        :return: the joined document, or `None` if a diff has no body
+    """
+    parts = [split_document(diff) for diff in diffs]
+    if not parts or None in parts:
+        return None
+
+    return parts[0][0] + ''.join(body for preamble, body, end in parts) + parts[-1][2]
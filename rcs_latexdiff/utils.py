@@ -1,37 +1,122 @@
 from __future__ import print_function, absolute_import
 
+import os
 import subprocess
 import logging
 import re
+from collections import namedtuple
 
 logger = logging.getLogger("rcs-latexdiff.utils")
 
-def run_command(command, path=""):
-    """ Run a command and return its output
+class CommandResult(object):
+    """ Result of a command run by `execute`
 
-        :param path: where to execute the command
-        :param command: Command to be executed
-        :return: return code and the output produced by the command
-        :rtype: list
-        :warning: exit if it goes wrong
+        :param argv: the command line
+        :param returncode: the return code of the command
+        :param stdout: standard output of the command (bytes, `None` if redirected)
+        :param stderr: standard error of the command (bytes)
+        :param aborted: why the command has been killed (see `execute_watched`),
+            `None` if it ran to completion
+    """
+
+    def __init__(self, argv, returncode, stdout, stderr, aborted=None):
+        self.argv = argv
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+        self.aborted = aborted
+        self._text = None
+
+    @property
+    def ok(self):
+        """ Whether or not the command succeeded """
+        return self.returncode == 0
+
+    @property
+    def text(self):
+        """ Standard output decoded as UTF-8, decoded on first access only """
+        if self._text is None:
+            self._text = (self.stdout or b'').decode('utf-8')
+        return self._text
+
+    @property
+    def error_text(self):
+        """ Standard error decoded as UTF-8 (undecodable bytes are replaced) """
+        return (self.stderr or b'').decode('utf-8', 'replace')
+
+
+def execute(argv, cwd=None, stdout=None, env=None):
+    """ Run a command without a shell and return its result
+
+        :param argv: command line as a list of arguments
+        :param cwd: where to execute the command (default: current directory)
+        :param stdout: if given, file object the standard output is written into
+        :param env: if given, environment of the command
+        :return: the CommandResult; a command which cannot be started gets
+            the return code 127, like in a shell
+        :rtype: CommandResult
 
     """
+    argv = list(argv)
+    logger.debug("Run command: %s%s" % (" ".join(argv), " (in %s)" % cwd if cwd else ""))
     try:
-        # Forge command
-        if path not in ['', '.']:
-            command = '(cd {} && {})'.format(path, command)
+        process = subprocess.Popen(argv, cwd=cwd or None, stdout=stdout or subprocess.PIPE,
+                                   stderr=subprocess.PIPE, env=env)
+    except OSError as e:
+        logger.debug("Execution failed: %s" % (e))
+        return CommandResult(argv, 127, b'', str(e).encode('utf-8'))
+
+    output, error = process.communicate()
+    result = CommandResult(argv, process.returncode, output, error)
+
+    logger.debug("Return code: %d" % (result.returncode))
+    if not result.ok and error:
+        logger.debug("Error output: %s" % result.error_text.strip())
+    return result
 
-        logger.debug("Run command: %s" % (command))
-        process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        output = process.communicate()[0].decode('utf-8')
-        retcode = process.returncode
 
-        logger.debug("Return code: %d" % (retcode))
-        return retcode, output
+def execute_watched(argv, cwd=None, env=None, watch=None):
+    """ Run a command without a shell, reading its output (standard output
+        and error together) line by line as it is written, and kill it as
+        soon as a line calls for it
 
+        :param argv: command line as a list of arguments
+        :param cwd: where to execute the command (default: current directory)
+        :param env: if given, environment of the command
+        :param watch: function called with each line of output (bytes),
+            returning why the command must be killed, or `None`
+        :return: the CommandResult, the output being in `stdout`, and the
+            reason returned by `watch` in `aborted` if the command was killed
+        :rtype: CommandResult
+
+    """
+    argv = list(argv)
+    logger.debug("Run command: %s%s" % (" ".join(argv), " (in %s)" % cwd if cwd else ""))
+    try:
+        with open(os.devnull, 'rb') as devnull:
+            process = subprocess.Popen(argv, cwd=cwd or None, stdin=devnull, stdout=subprocess.PIPE,
+                                       stderr=subprocess.STDOUT, env=env)
     except OSError as e:
-        logger.info("Execution failed: %s" % (e))
-        exit(1)
+        logger.debug("Execution failed: %s" % (e))
+        return CommandResult(argv, 127, b'', str(e).encode('utf-8'))
+
+    lines = []
+    aborted = None
+    try:
+        for line in iter(process.stdout.readline, b''):
+            lines.append(line)
+            aborted = watch(line) if watch is not None else None
+            if aborted is not None:
+                logger.debug("Killing %s: %s" % (argv[0], aborted))
+                process.kill()
+                break
+    finally:
+        process.stdout.close()
+        process.wait()
+
+    logger.debug("Return code: %d" % (process.returncode))
+    return CommandResult(argv, process.returncode, b''.join(lines), b'', aborted)
+
 
 def write_file(content, filename):
     """ Write a file
@@ -41,13 +126,159 @@ def write_file(content, filename):
 
     """
     logger.debug("Writing content into %s" % filename)
-    if isinstance(content, unicode):
+    if not isinstance(content, bytes):
         content = content.encode("utf-8")
-    with open(filename, 'w') as f:
+    with open(filename, 'wb') as f:
         f.write(content)
 
+def read_text(filename):
+    """ Read a UTF-8 file
+
+        :param filename: name of the file
+        :return: the content of the file
+
+    """
+    with open(filename, 'rb') as f:
+        return f.read().decode('utf-8')
+
+# Environments whose content is neither stripped nor scanned for includes
+VERBATIM_ENVIRONMENTS = ['verbatim', 'verbatim*', 'Verbatim', 'Verbatim*', 'lstlisting', 'minted', 'comment']
+
+_LATEX_TOKEN = re.compile(r"""
+    (?P<comment>%[^\n]*)
+  | \\(?:input|include)(?![a-zA-Z@])\s*\{(?P<include>[^}]*)\}
+  | \\begin[ \t]*\{(?P<environment>[a-zA-Z]+\*?)\}
+  | \\verb\*?(?P<delimiter>[^a-zA-Z\s*])
+  | \\.
+""", re.VERBOSE | re.DOTALL)
+
+# An include command found by scan_latex
+Include = namedtuple('Include', ['command', 'name'])
+
+
+class Verbatim(type(u'')):
+    """ Text of a verbatim-like environment or of a \\verb found by
+        scan_latex, to be kept as is (e.g. a \\bibliography{} shown in a
+        listing is not a bibliography)
+    """
+    __slots__ = ()
+
+
+def scan_latex(content):
+    """ Remove the comments of a LaTeX content and look for its includes, in a
+        single pass.
+
+        - A line containing only a comment is removed completely
+        - Everything following a % is removed, except if it is escaped (\%)
+        - The content of verbatim-like environments and \verb is kept as is
+
+        :param content: LaTeX content
+        :return: list of segments, either text, `Verbatim` text for each
+            verbatim-like environment and \verb, or an `Include` tuple for
+            each \input{} or \include{} command
+
+    """
+    segments = []
+    pos = 0
+    match = _LATEX_TOKEN.search(content)
+    while match:
+        start, end = match.span()
+        kind = match.lastgroup
+
+        if kind == 'comment':
+            line_start = content.rfind('\n', 0, start) + 1
+            if line_start >= pos and not content[line_start:start].strip(' \t') and content[end:end + 1] == '\n':
+                # Only a comment on this line: remove the line completely
+                segments.append(content[pos:line_start])
+                end += 1
+            else:
+                segments.append(content[pos:start])
+            pos = end
+
+        elif kind == 'include':
+            segments.append(content[pos:start])
+            segments.append(Include(match.group(0), match.group('include').strip()))
+            pos = end
+
+        elif kind == 'environment' and match.group('environment') in VERBATIM_ENVIRONMENTS:
+            # Jump after the end of the environment
+            name = re.escape(match.group('environment'))
+            env_end = re.compile(r"\\end[ \t]*\{%s\}" % name).search(content, end)
+            end = env_end.end() if env_end else len(content)
+            segments.append(content[pos:start])
+            segments.append(Verbatim(content[start:end]))
+            pos = end
+
+        elif kind == 'delimiter':
+            # Jump after the closing delimiter of \verb, on the same line
+            closing = content.find(match.group('delimiter'), end)
+            if closing != -1 and '\n' not in content[end:closing]:
+                end = closing + 1
+                segments.append(content[pos:start])
+                segments.append(Verbatim(content[start:end]))
+                pos = end
+
+        match = _LATEX_TOKEN.search(content, end)
+
+    segments.append(content[pos:])
+    return [segment for segment in segments if segment]
+
+
 def remove_latex_comments(content):
-    # If a line contains only a comment, remove the line completely
-    content = re.sub(r'^[ \t]*%.*\r?\n', '', content, flags=re.MULTILINE)
-    # Remove all content which follows a % except if % is preceded by \
-    return re.sub(r'(?<!\\)%.*', '', content)
+    """ Remove the comments of a LaTeX content (see `scan_latex`)
+
+        :param content: LaTeX content
+        :return: the content without its comments
+
+    """
+    return ''.join(segment.command if isinstance(segment, Include) else segment
+                   for segment in scan_latex(content))
+
+
+# Commands naming the files needed to compile a document, with the extensions
+# tried when a name has none
+ASSET_EXTENSIONS = {
+    'includegraphics': ['.pdf', '.png', '.jpg', '.jpeg', '.eps'],
+    'bibliography': ['.bib'],
+    'addbibresource': ['.bib'],
+    'bibliographystyle': ['.bst'],
+    'documentclass': ['.cls'],
+    'usepackage': ['.sty'],
+    'RequirePackage': ['.sty'],
+}
+
+_ASSET_COMMAND = re.compile(r"""
+    \\(?P<command>%s)\*?\s*(?:\[[^\]]*\]\s*)*\{(?P<names>[^}]*)\}
+  | \\graphicspath\s*\{(?P<paths>(?:\s*\{[^}]*\})*)\s*\}
+""" % '|'.join(ASSET_EXTENSIONS), re.VERBOSE)
+
+
+def find_assets(content):
+    """ Look for the files a LaTeX content needs to compile: figures
+        (includegraphics, searched in the graphicspath), bibliographies,
+        bibliography styles, classes and packages
+
+        The names are not checked, so most packages and classes are actually
+        found in the TeX distribution rather than next to the document.
+
+        :param content: LaTeX content, without comments (see `scan_latex`)
+        :return: the candidate file names, in order of appearance
+
+    """
+    graphics_paths = ['']
+    references = []
+    for match in _ASSET_COMMAND.finditer(content):
+        if match.group('paths') is not None:
+            graphics_paths += re.findall(r'\{([^}]*)\}', match.group('paths'))
+            continue
+        for name in match.group('names').split(','):
+            if name.strip():
+                references.append((match.group('command'), name.strip()))
+
+    names = []
+    for command, name in references:
+        candidates = [name] if os.path.splitext(name)[1] else [name + ext for ext in ASSET_EXTENSIONS[command]]
+        if command == 'includegraphics':
+            candidates = [os.path.join(path, candidate) for path in graphics_paths for candidate in candidates]
+        names += [candidate for candidate in candidates if candidate not in names]
+    return names
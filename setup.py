@@ -8,6 +8,11 @@ try:
 except ImportError:
     requires.append('argparse')
 
+try:
+    import concurrent.futures
+except ImportError:
+    requires.append('futures')
+
 entry_points = {
     'console_scripts': [
         'rcs-latexdiff = rcs_latexdiff.rcs_latexdiff:main',
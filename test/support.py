@@ -0,0 +1,121 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from rcs_latexdiff import rcs, rcs_latexdiff
+
+
+def git(path, *args):
+  """ Run a git command in a throwaway repository and return its output """
+  command = ['git', '-c', 'user.name=test', '-c', 'user.email=test@example.com'] + list(args)
+  return subprocess.check_output(command, cwd=path).decode('utf-8')
+
+
+def write_files(path, files):
+  for filename, content in files.items():
+    filename = os.path.join(path, filename)
+    if not os.path.isdir(os.path.dirname(filename)):
+      os.makedirs(os.path.dirname(filename))
+    with open(filename, 'wb') as f:
+      f.write(content.encode('utf-8') if not isinstance(content, bytes) else content)
+
+
+def make_git_repo(*revisions):
+  """ Create a throwaway git repository
+
+      :param revisions: one dict {filename: content} per commit
+      :return: path of the repository
+  """
+  path = tempfile.mkdtemp(prefix='rcs-latexdiff-test-')
+  git(path, 'init', '-q')
+  for index, files in enumerate(revisions):
+    write_files(path, files)
+    git(path, 'add', '-A')
+    git(path, 'commit', '-q', '-m', 'revision %d' % index)
+  return path
+
+
+class CountingGit(rcs.Git):
+  """ Git recording the (commit, filename) of every file it reads """
+
+  def __init__(self):
+    super(CountingGit, self).__init__()
+    self.reads = []
+
+  def show_file(self, path, commit, filename):
+    self.reads.append((commit, filename))
+    return super(CountingGit, self).show_file(path, commit, filename)
+
+
+def remove_repo(path):
+  shutil.rmtree(path, ignore_errors=True)
+
+
+def svn(path, *args):
+  """ Run a svn command in a throwaway working copy and return its output """
+  command = ['svn', '--non-interactive'] + list(args)
+  return subprocess.check_output(command, cwd=path).decode('utf-8')
+
+
+def make_svn_repo(*revisions):
+  """ Create a throwaway svn repository (file://) and a working copy of it
+
+      :param revisions: one dict {filename: content} per commit
+      :return: path of the directory holding both, and path of the working copy
+  """
+  path = tempfile.mkdtemp(prefix='rcs-latexdiff-test-')
+  repository = os.path.join(path, 'repository')
+  working_copy = os.path.join(path, 'wc')
+  subprocess.check_call(['svnadmin', 'create', repository])
+  svn(path, 'checkout', '-q', 'file://' + repository, working_copy)
+  for index, files in enumerate(revisions):
+    write_files(working_copy, files)
+    svn(working_copy, 'add', '-q', '--force', '.')
+    svn(working_copy, 'commit', '-q', '-m', 'revision %d' % index)
+  svn(working_copy, 'update', '-q')
+  return path, working_copy
+
+
+def hg(path, *args):
+  """ Run a hg command in a throwaway repository and return its output """
+  command = ['hg', '--config', 'ui.username=test <test@example.com>'] + list(args)
+  return subprocess.check_output(command, cwd=path).decode('utf-8')
+
+
+def make_hg_repo(*revisions):
+  """ Create a throwaway Mercurial repository
+
+      :param revisions: one dict {filename: content} per commit
+      :return: path of the repository
+  """
+  path = tempfile.mkdtemp(prefix='rcs-latexdiff-test-')
+  hg(path, 'init')
+  for index, files in enumerate(revisions):
+    write_files(path, files)
+    hg(path, 'commit', '-q', '-A', '-m', 'revision %d' % index)
+  return path
+
+
+def make_args(*argv):
+  """ Parse a command line of rcs-latexdiff, without compiling nor opening
+      a pdf unless asked to (see `parse_arguments`)
+  """
+  return rcs_latexdiff.parse_arguments(['--no-pdf', '--no-open'] + list(argv))
+
+
+class GitRepoTestCase(unittest.TestCase):
+  """ Test case run in a throwaway git repository (`path`) of `revisions`,
+      read through an instance of `git_class` (`git`)
+  """
+  revisions = ({'main.tex': 'One\n'}, {'main.tex': 'Two\n'})
+  git_class = rcs.Git
+
+  def setUp(self):
+    self.path = make_git_repo(*self.revisions)
+    self.git = self.git_class()
+
+  def tearDown(self):
+    self.git.close()
+    remove_repo(self.path)
@@ -0,0 +1,226 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+try:
+  from unittest import mock
+except ImportError:
+  import mock
+
+from rcs_latexdiff import rcs_latexdiff
+from rcs_latexdiff.cache import Cache
+from rcs_latexdiff.utils import CommandResult
+from rcs_latexdiff.build import AssetStore, BuildDirectory, CompileError, fatal_error, CompileScheduler, search_path_env, auxiliary_state, bibtex_state
+
+
+class TestBuildDirectory(unittest.TestCase):
+  def setUp(self):
+    self.path = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.path)
+
+  def test_search_path_env(self):
+    env = search_path_env(self.path, {'TEXINPUTS': '/styles:', 'PATH': '/bin'})
+    self.assertEqual(env['TEXINPUTS'], os.pathsep.join([self.path, '/styles:']))
+    self.assertEqual(env['BIBINPUTS'], self.path + os.pathsep)
+    self.assertEqual(env['PATH'], '/bin')
+
+  def test_search_path_list(self):
+    env = search_path_env([self.path, '/assets'], {})
+    self.assertEqual(env['BSTINPUTS'], os.pathsep.join([self.path, '/assets', '']))
+
+  def test_collect_and_cleanup(self):
+    tex_filename = os.path.join(self.path, 'diff.tex')
+    with BuildDirectory() as build:
+      for name in ['diff.pdf', 'diff.aux', 'diff.log']:
+        with open(os.path.join(build.path, name), 'w') as f:
+          f.write(name)
+      self.assertEqual(build.collect(tex_filename), [os.path.join(self.path, 'diff.pdf')])
+      self.assertEqual(sorted(os.listdir(self.path)), ['diff.pdf'])
+      build.collect(tex_filename, everything=True)
+      self.assertEqual(sorted(os.listdir(self.path)), ['diff.aux', 'diff.log', 'diff.pdf'])
+    self.assertFalse(os.path.exists(build.path))
+
+  def test_given_directory_is_kept(self):
+    build = BuildDirectory(self.path)
+    build.cleanup()
+    self.assertTrue(os.path.isdir(self.path))
+
+
+class TestAssetStore(unittest.TestCase):
+  def test_materialize(self):
+    store = AssetStore()
+    try:
+      first, second = store.tree(), store.tree()
+      self.assertEqual(store.materialize({'figs/a.png': b'png', 'refs.bib': b'bib'}, first), 2)
+      store.materialize({'b.png': b'png'}, second)
+      store.materialize({'refs.bib': b'new bib'}, first)
+
+      with open(os.path.join(first, 'refs.bib'), 'rb') as f:
+        self.assertEqual(f.read(), b'new bib')
+      # Identical contents are stored once
+      self.assertTrue(os.path.samefile(os.path.join(first, 'figs', 'a.png'), os.path.join(second, 'b.png')))
+      self.assertEqual(len(Cache(store.path).entries()), 3)
+    finally:
+      store.cleanup()
+    self.assertFalse(os.path.exists(store.path))
+
+
+class TestCompileScheduler(unittest.TestCase):
+  def setUp(self):
+    self.path = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.path)
+
+  def test_parallel_builds(self):
+    builds = []
+    barrier = threading.Barrier(3) if hasattr(threading, 'Barrier') else None
+
+    def fake_compile(tex_filename, src_path, repeat=1, keep=False):
+      # Stands for a compiler: writes its outputs in its build directory
+      with BuildDirectory() as build:
+        builds.append(build.path)
+        if barrier is not None:
+          barrier.wait(timeout=5)
+        with open(os.path.join(build.path, 'out.pdf'), 'w') as f:
+          f.write(tex_filename)
+        shutil.copyfile(os.path.join(build.path, 'out.pdf'), os.path.splitext(tex_filename)[0] + '.pdf')
+      return os.path.splitext(tex_filename)[0] + '.pdf'
+
+    with CompileScheduler(fake_compile, workers=3) as scheduler:
+      futures = [scheduler.submit(os.path.join(self.path, 'diff%d.tex' % i), self.path) for i in range(3)]
+    results = [future.result() for future in futures]
+
+    self.assertEqual(results, [os.path.join(self.path, 'diff%d.pdf' % i) for i in range(3)])
+    self.assertEqual(len(set(builds)), 3)
+    self.assertFalse(any(os.path.exists(path) for path in builds))
+
+
+class TestConvergence(unittest.TestCase):
+  def setUp(self):
+    self.path = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.path)
+
+  def write(self, name, content):
+    with open(os.path.join(self.path, name), 'w') as f:
+      f.write(content)
+
+  def test_auxiliary_state(self):
+    self.write('diff.aux', '\\relax\n')
+    self.write('diff.log', 'log')
+    state = auxiliary_state(self.path)
+    self.assertEqual(list(state), ['diff.aux'])
+    self.write('diff.log', 'another log')
+    self.assertEqual(auxiliary_state(self.path), state)
+    self.write('diff.toc', 'toc')
+    self.assertNotEqual(auxiliary_state(self.path), state)
+
+  def test_bibtex_state(self):
+    self.write('diff.aux', '\\relax\n\\newlabel{a}{{1}{1}}\n')
+    self.assertIsNone(bibtex_state(self.path, self.path))
+
+    self.write('diff.aux', '\\citation{knuth}\n\\bibstyle{plain}\n\\bibdata{refs}\n')
+    self.write('refs.bib', '@book{knuth}')
+    state = bibtex_state(self.path, self.path)
+    self.assertIsNotNone(state)
+
+    # Labels do not matter to bibtex, citations and databases do
+    self.write('diff.aux', '\\citation{knuth}\n\\newlabel{a}{{2}{1}}\n\\bibstyle{plain}\n\\bibdata{refs}\n')
+    self.assertEqual(bibtex_state(self.path, self.path), state)
+    self.write('refs.bib', '@book{knuth, year=1984}')
+    self.assertNotEqual(bibtex_state(self.path, self.path), state)
+
+  def test_exec_pdflatex_stops_when_stable(self):
+    tex_filename = os.path.join(self.path, 'diff.tex')
+    self.write('diff.tex', '')
+    self.write('refs.bib', '@book{knuth}')
+    build_path = os.path.join(self.path, 'build')
+    os.mkdir(build_path)
+    commands, runs, directories = [], [], set()
+
+    def fake_execute(argv, cwd=None, stdout=None, env=None, watch=None):
+      # Stands for pdflatex: the references settle on the third pass
+      commands.append(argv[0])
+      directories.add((argv[0], cwd))
+      if argv[0] == 'pdflatex':
+        runs.append(argv)
+        passes = len(runs)
+        with open(os.path.join(build_path, 'diff.aux'), 'w') as f:
+          f.write('\\citation{knuth}\n\\bibdata{refs}\n\\newlabel{a}{{%d}{1}}\n' % min(passes, 3))
+        open(os.path.join(build_path, 'diff.pdf'), 'w').close()
+      return CommandResult(argv, 0, b'', b'')
+
+    with mock.patch.object(rcs_latexdiff, 'execute', side_effect=fake_execute), \
+        mock.patch.object(rcs_latexdiff, 'execute_watched', side_effect=fake_execute):
+      rcs_latexdiff.exec_pdflatex(tex_filename, self.path, build_dir=build_path)
+      self.assertEqual(commands, ['pdflatex', 'bibtex', 'pdflatex', 'pdflatex', 'pdflatex'])
+      # pdflatex resolves ./ and ../ from the sources, bibtex reads the .aux
+      self.assertEqual(directories, set([('pdflatex', self.path), ('bibtex', build_path)]))
+
+      # A rebuild in the same directory neither reruns bibtex nor cycles
+      del commands[:]
+      rcs_latexdiff.exec_pdflatex(tex_filename, self.path, build_dir=build_path)
+      self.assertEqual(commands, ['pdflatex'])
+    self.assertTrue(os.path.isfile(os.path.join(self.path, 'diff.pdf')))
+
+
+class TestFatalErrors(unittest.TestCase):
+  def test_fatal_error(self):
+    self.assertEqual(fatal_error(b'! Emergency stop.\n'), '! Emergency stop.')
+    self.assertIsNotNone(fatal_error(b'!  ==> Fatal error occurred, no output PDF file produced!\n'))
+    self.assertIsNotNone(fatal_error(b'Runaway argument?\n'))
+    self.assertIsNone(fatal_error(b'! Undefined control sequence.\n'))
+    self.assertIsNone(fatal_error(b'Output written on diff.pdf (1 page).\n'))
+    self.assertIsNone(fatal_error(b'[]\\OT1/cmr/m/n/10 Recovering from a Fatal error in the sensor\n'))
+    self.assertIsNone(fatal_error(b'Package foo Warning: Fatal error handling disabled\n'))
+
+  def test_exec_pdflatex_stops(self):
+    path = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, path)
+    runs = []
+
+    def fake_execute_watched(argv, cwd=None, env=None, watch=None):
+      runs.append(argv[0])
+      return CommandResult(argv, -9, b'! Emergency stop.\n', b'', watch(b'! Emergency stop.\n'))
+
+    with mock.patch.object(rcs_latexdiff, 'execute_watched', side_effect=fake_execute_watched):
+      with self.assertRaises(CompileError) as context:
+        rcs_latexdiff.exec_pdflatex(os.path.join(path, 'diff.tex'), path)
+    self.assertEqual(runs, ['pdflatex'])
+    self.assertEqual(context.exception.stage, 'pdflatex pass 1')
+    self.assertEqual(context.exception.reason, '! Emergency stop.')
+
+  def test_fallback(self):
+    attempts, remakes = [], []
+
+    def exec_fcn(tex_filename, src_path, repeat=1):
+      attempts.append(repeat)
+      if len(attempts) == 1:
+        raise CompileError('pdflatex pass 1', '! Emergency stop.', 0.5)
+      return 'diff.pdf'
+
+    self.assertEqual(rcs_latexdiff.compile_with_fallback(exec_fcn, 'diff.tex', '.', remakes.append, repeat=2),
+                     'diff.pdf')
+    self.assertEqual(attempts, [2, 2])
+    self.assertEqual(remakes, [rcs_latexdiff.SAFE_LATEXDIFF_ARGS])
+
+
+class TestCleanDiffFiles(unittest.TestCase):
+  def test_only_known_files_are_removed(self):
+    path = tempfile.mkdtemp()
+    try:
+      names = ['diff.tex', 'diff.tex.old', 'diff.tex.new', 'diff.pdf', 'diff.notes']
+      for name in names:
+        open(os.path.join(path, name), 'w').close()
+      rcs_latexdiff.clean_diff_files(os.path.join(path, 'diff.tex'), True)
+      self.assertEqual(sorted(os.listdir(path)), ['diff.notes', 'diff.pdf'])
+    finally:
+      shutil.rmtree(path)
+
+if __name__ == '__main__':
+    unittest.main()
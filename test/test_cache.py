@@ -0,0 +1,91 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from rcs_latexdiff import rcs_latexdiff
+from rcs_latexdiff.cache import Cache
+
+from .support import CountingGit, make_git_repo, remove_repo, write_files
+
+files = {
+  'main.tex': 'Intro % comment\n\\input{a.tex}\n\\input{b.tex}\n',
+  'a.tex': 'Content of a\n',
+  'b.tex': 'Content of b\n\\input{a.tex}\n',
+}
+
+
+class TestCache(unittest.TestCase):
+  def setUp(self):
+    self.cache_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.cache_dir)
+
+  def test_get_put(self):
+    cache = Cache(self.cache_dir)
+    self.assertIsNone(cache.get('file', 'key'))
+    cache.put('file', 'key', u'caf\xe9')
+    self.assertEqual(cache.get('file', 'key'), u'caf\xe9')
+    self.assertIsNone(cache.get('expanded', 'key'))
+    self.assertEqual(cache.stats()['entries'], 1)
+
+  def test_prune_least_recently_used(self):
+    cache = Cache(self.cache_dir, max_size=10)
+    for key in ['a', 'b', 'c']:
+      cache.put('file', key, '12345')
+    # Make 'a' the oldest entry but use it: 'b' becomes the least recently used
+    past = time.time() - 100
+    for key in ['a', 'b', 'c']:
+      os.utime(cache._entry_path('file', key), (past, past))
+      past += 10
+    cache.get('file', 'a')
+
+    removed, freed = cache.prune()
+    self.assertEqual((removed, freed), (1, 5))
+    self.assertIsNone(cache.get('file', 'b'))
+    self.assertEqual(cache.get('file', 'a'), '12345')
+
+    cache.prune(0)
+    self.assertEqual(cache.stats()['entries'], 0)
+
+
+class TestCachedGetFile(unittest.TestCase):
+  def setUp(self):
+    self.path = make_git_repo(files)
+    self.cache_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    remove_repo(self.path)
+    shutil.rmtree(self.cache_dir)
+
+  def get_file(self, commit, cache):
+    git = CountingGit()
+    try:
+      return rcs_latexdiff.get_file(git, self.path, '', commit, 'main.tex', cache=cache), len(git.reads)
+    finally:
+      git.close()
+
+  def test_committed_files(self):
+    expected, reads = self.get_file('HEAD', None)
+    self.assertEqual(reads, 3)
+
+    cache = Cache(self.cache_dir)
+    self.assertEqual(self.get_file('HEAD', cache), (expected, 3))
+    self.assertEqual(self.get_file('HEAD', cache), (expected, 0))
+    self.assertTrue(cache.stats()['namespaces']['expanded'][0] > 0)
+
+  def test_working_copy(self):
+    cache = Cache(self.cache_dir)
+    expected, reads = self.get_file(None, cache)
+    self.assertEqual(self.get_file(None, cache), (expected, 0))
+
+    # A modified file is read again
+    write_files(self.path, {'a.tex': 'Modified content of a\n'})
+    content, reads = self.get_file(None, cache)
+    self.assertEqual(reads, 1)
+    self.assertEqual(content, expected.replace('Content of a', 'Modified content of a'))
+
+if __name__ == '__main__':
+    unittest.main()
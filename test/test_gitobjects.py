@@ -0,0 +1,135 @@
+import os
+import subprocess
+import unittest
+try:
+  from unittest import mock
+except ImportError:
+  import mock
+
+from rcs_latexdiff import gitobjects, rcs
+from rcs_latexdiff.gitobjects import ObjectStore, UnsupportedObjectStore, apply_delta
+
+from .support import make_git_repo, remove_repo, git
+
+paragraph = ''.join('Line %d of a chapter which changes a little at each revision.\n' % i for i in range(200))
+
+revisions = [
+  {'main.tex': '\\documentclass{article}\n\\begin{document}\n\\input{chapter.tex}\n\\end{document}\n',
+   'chapter.tex': paragraph,
+   'sub/deep/section.tex': 'nested\n',
+   'sub dir/spaced name.tex': 'spaces in path\n',
+   'figure.pdf': b'%PDF\x00\xff\xfe binary',
+   'empty.tex': ''},
+  {'chapter.tex': paragraph.replace('Line 10 ', 'Line ten '),
+   'sub/deep/section.tex': 'nested, second revision\n'},
+  {'chapter.tex': paragraph.replace('Line 150 ', 'Line 150, ') + 'The end.\n'},
+]
+
+
+def cat_file(path, name):
+  """ Content of an object according to git, or None if it is missing """
+  try:
+    return subprocess.check_output(['git', 'cat-file', 'blob', name], cwd=path, stderr=subprocess.STDOUT)
+  except subprocess.CalledProcessError:
+    return None
+
+
+class TestObjectStore(unittest.TestCase):
+  def setUp(self):
+    self.path = make_git_repo(*revisions)
+    self.commits = git(self.path, 'rev-list', 'HEAD').split()
+    self.filenames = set(name for revision in revisions for name in revision)
+    self.filenames |= set(['missing.tex', 'sub/missing.tex', 'main.tex/not a dir'])
+
+  def tearDown(self):
+    remove_repo(self.path)
+
+  def assertIdentical(self):
+    store = ObjectStore.open(self.path)
+    try:
+      for commit in self.commits:
+        for filename in self.filenames:
+          expected = cat_file(self.path, '%s:%s' % (commit, filename))
+          obj = store.read(commit, filename)
+          self.assertEqual(obj[2] if obj else None, expected, filename)
+    finally:
+      store.close()
+
+  def test_loose_objects(self):
+    self.assertIdentical()
+
+  def test_packed_offset_deltas(self):
+    git(self.path, 'repack', '-a', '-d', '-f', '-q', '--depth=50', '--window=50')
+    self.assertTrue(git(self.path, 'count-objects').startswith('0 objects'))
+    self.assertIdentical()
+
+  def test_packed_ref_deltas(self):
+    git(self.path, '-c', 'repack.useDeltaBaseOffset=false', 'repack', '-a', '-d', '-f', '-q')
+    pack = [name for name in os.listdir(os.path.join(self.path, '.git', 'objects', 'pack')) if name.endswith('.idx')]
+    self.assertIn('chain length', git(self.path, 'verify-pack', '-v', os.path.join('.git', 'objects', 'pack', pack[0])))
+    self.assertIdentical()
+
+  def test_trees(self):
+    store = ObjectStore.open(self.path)
+    sha, obj_type, content = store.read(self.commits[0], 'sub/deep', content=False)
+    self.assertEqual(obj_type, 'tree')
+    self.assertEqual(sha, git(self.path, 'rev-parse', 'HEAD:sub/deep').strip())
+    store.close()
+
+  def test_bounded_caches(self):
+    store = ObjectStore.open(self.path)
+    with mock.patch.object(gitobjects, '_TREE_CACHE_SIZE', 2), mock.patch.object(gitobjects, '_COMMIT_CACHE_SIZE', 2):
+      for commit in self.commits:
+        store.read(commit, 'sub/deep/section.tex', content=False)
+    self.assertLessEqual(len(store._trees), 2)
+    self.assertLessEqual(len(store._commit_trees), 2)
+    store.close()
+    self.assertIdentical()
+
+  def test_unsupported_names(self):
+    store = ObjectStore.open(self.path)
+    self.assertRaises(UnsupportedObjectStore, store.read, 'HEAD', 'main.tex')
+    self.assertRaises(UnsupportedObjectStore, store.read, self.commits[0][:7], 'main.tex')
+    self.assertRaises(UnsupportedObjectStore, store.read, self.commits[0], './main.tex')
+    store.close()
+
+  def test_alternates_fall_back(self):
+    clone = self.path + '-shared'
+    subprocess.check_call(['git', 'clone', '-q', '--shared', self.path, clone])
+    try:
+      self.assertRaises(UnsupportedObjectStore, ObjectStore.open, clone)
+      repo = rcs.Git()
+      self.assertEqual(repo.show_file(clone, self.commits[-1], 'sub/deep/section.tex'), 'nested')
+      self.assertIsNone(repo._stores[clone])
+      repo.close()
+    finally:
+      remove_repo(clone)
+
+  def test_git_show_file(self):
+    git(self.path, 'gc', '-q')
+    native = rcs.Git()
+    batch = rcs.Git(native=False)
+    try:
+      for commit in self.commits:
+        for filename in self.filenames - set(['figure.pdf']):
+          self.assertEqual(native.show_file(self.path, commit, filename), batch.show_file(self.path, commit, filename))
+          self.assertEqual(native.file_id(self.path, commit, filename), batch.file_id(self.path, commit, filename))
+      # Nothing was read through git
+      self.assertEqual(native._readers, {})
+    finally:
+      native.close()
+      batch.close()
+
+
+class TestApplyDelta(unittest.TestCase):
+  def test_copy_and_insert(self):
+    base = b'0123456789'
+    # Sizes 10 and 7, copy 4 bytes at offset 2, insert "abc"
+    delta = b'\x0a\x07' + b'\x91\x02\x04' + b'\x03abc'
+    self.assertEqual(apply_delta(base, delta), b'2345abc')
+
+  def test_size_mismatch(self):
+    self.assertRaises(ValueError, apply_delta, b'01', b'\x0a\x01\x01a')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+import os
+import json
+import unittest
+
+from rcs_latexdiff.cache import MemoryCache
+from rcs_latexdiff.includes import IncludeGraph, IncludeCycleError, unchanged_subtrees, _same_content, dump_segments, load_segments
+from rcs_latexdiff.utils import scan_latex, Include, Verbatim
+
+from .support import CountingGit, GitRepoTestCase
+
+
+class TestIncludeGraph(GitRepoTestCase):
+  revisions = ({
+    'main.tex': '\\input{preamble.tex}\n\\input{one.tex}\n\\input{two.tex}\n',
+    'preamble.tex': '\\newcommand{\\x}{x}\n',
+    'one.tex': '\\input{preamble.tex}\nOne\n',
+    'two.tex': '\\input{preamble.tex}\n\\input{none.tex}\nTwo\n',
+    'self.tex': 'Self\n\\input{loop.tex}\n',
+    'loop.tex': '\\input{self.tex}\n',
+    'listing.tex': '\\begin{lstlisting}\n\\bibliography{refs}\n\\end{lstlisting}\n\\verb|\\bibliography{refs}|\n\\bibliography{refs}\n',
+  },)
+  git_class = CountingGit
+
+  def test_each_file_read_once(self):
+    graph = IncludeGraph(self.git, self.path, '', 'HEAD')
+    graph.build('main.tex')
+    content = graph.expand()
+
+    self.assertEqual(sorted(filename for commit, filename in self.git.reads), ['main.tex', 'none.tex', 'one.tex', 'preamble.tex', 'two.tex'])
+    self.assertIs(graph.nodes['one.tex'].includes[0][2], graph.nodes['preamble.tex'])
+    self.assertEqual(content.count('\\newcommand{\\x}{x}'), 3)
+
+  def test_cycle(self):
+    graph = IncludeGraph(self.git, self.path, '', 'HEAD')
+    with self.assertRaises(IncludeCycleError) as context:
+      graph.build('self.tex')
+    self.assertEqual(context.exception.cycle, ['self.tex', 'loop.tex', 'self.tex'])
+
+  def test_to_dict(self):
+    graph = IncludeGraph(self.git, self.path, '', 'HEAD')
+    graph.build('main.tex')
+    graph = json.loads(json.dumps(graph.to_dict()))
+
+    self.assertEqual(graph['root'], 'main.tex')
+    self.assertEqual(graph['nodes']['main.tex']['includes'], ['preamble.tex', 'one.tex', 'two.tex'])
+    self.assertEqual(graph['nodes']['preamble.tex']['includes'], [])
+
+  def test_write(self):
+    graph = IncludeGraph(self.git, self.path, '', 'HEAD')
+    graph.build('main.tex')
+    filename = os.path.join(self.path, 'flat.tex')
+    graph.write(filename)
+    with open(filename, 'rb') as f:
+      self.assertEqual(f.read().decode('utf-8'), graph.expand())
+
+  def test_inline_bibliography(self):
+    graph = IncludeGraph(self.git, self.path, '', 'HEAD', cache=MemoryCache())
+    graph.build('two.tex')
+    graph.nodes['preamble.tex'].segments.append('\\bibliographystyle{plain}\\bibliography{refs}')
+    key, expanded = graph.root.key(), graph.expand()
+
+    self.assertEqual(graph.inline_bibliography('\\begin{thebibliography}\\end{thebibliography}', 'two.bbl', 'id'), 1)
+    self.assertEqual(graph.bibliography, 'two.bbl')
+    self.assertIn('\\bibliographystyle{plain}\\begin{thebibliography}\\end{thebibliography}', graph.expand())
+    self.assertNotEqual(graph.expand(), expanded)
+    self.assertIsNotNone(key)
+    self.assertNotEqual(graph.root.key(), key)
+
+  def test_inline_bibliography_verbatim(self):
+    graph = IncludeGraph(self.git, self.path, '', 'HEAD')
+    graph.build('listing.tex')
+
+    self.assertEqual(graph.inline_bibliography('BBL', 'listing.bbl'), 1)
+    self.assertEqual(graph.expand(), '\\begin{lstlisting}\n\\bibliography{refs}\n\\end{lstlisting}\n\\verb|\\bibliography{refs}|\nBBL')
+
+  def test_dump_segments(self):
+    segments = scan_latex('\\input{a}\n\\verb|%|\n')
+    loaded = load_segments(dump_segments(segments))
+    self.assertEqual(loaded, segments)
+    self.assertEqual([type(segment) for segment in loaded], [Include, type(u''), Verbatim, type(u'')])
+
+class TestUnchangedSubtrees(GitRepoTestCase):
+  revisions = ({
+    'main.tex': '\\input{macros.tex}\n\\begin{document}\n\\input{one.tex}\n\\input{two.tex}\n\\input{three.tex}\n\\end{document}\n',
+    'macros.tex': '\\newcommand{\\x}{x}\n',
+    'one.tex': 'One\n\\input{sub.tex}\n',
+    'sub.tex': 'Sub\n',
+    'two.tex': 'Two\n\\input{sub.tex}\n',
+    'three.tex': 'Three\n',
+  }, {
+    'two.tex': 'Two, modified\n\\input{sub.tex}\n',
+  })
+
+  def setUp(self):
+    super(TestUnchangedSubtrees, self).setUp()
+    self.old = IncludeGraph(self.git, self.path, '', 'HEAD~1')
+    self.old.build('main.tex')
+    self.new = IncludeGraph(self.git, self.path, '', 'HEAD')
+    self.new.build('main.tex')
+
+  def test_unchanged_subtrees(self):
+    # The preamble is always given to latexdiff, sub.tex is unchanged in two.tex
+    self.assertEqual(unchanged_subtrees(self.old, self.new), ['one.tex', 'sub.tex', 'three.tex'])
+    # The subtrees are streamed, not kept expanded
+    self.assertEqual((self.old._expanded, self.new._expanded), ({}, {}))
+
+  def test_same_content(self):
+    self.assertTrue(_same_content(['ab', '', 'cd'], ['a', 'bcd', '']))
+    self.assertFalse(_same_content(['ab', 'cd'], ['ab', 'ce']))
+    self.assertFalse(_same_content(['ab', 'cd'], ['abcd', 'e']))
+    self.assertTrue(_same_content([], ['']))
+
+  def test_expand_with_replacements(self):
+    replacements = {'one.tex': 'ONE', 'three.tex': 'THREE'}
+    content = self.new.expand(replacements=replacements)
+    self.assertIn('% Input one.tex\nONE\n% End of Input one.tex', content)
+    self.assertIn('Two, modified\n% Input sub.tex\nSub', content)
+
+    for filename, placeholder in replacements.items():
+      content = content.replace(placeholder, self.new.expand(self.new.nodes[filename]))
+    self.assertEqual(content, self.new.expand())
+
+  def test_chunks_with_replacements(self):
+    replacements = {'one.tex': 'ONE', 'sub.tex': 'SUB'}
+    self.assertEqual(''.join(self.new.chunks(replacements=replacements)), self.new.expand(replacements=replacements))
+    self.assertEqual(''.join(self.new.chunks()), self.new.expand())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+import json
+import os
+import tempfile
+import unittest
+try:
+  from unittest import mock
+except ImportError:
+  import mock
+
+from rcs_latexdiff import rcs_latexdiff
+from rcs_latexdiff.includes import IncludeGraph
+from rcs_latexdiff.profile import Profiler, Span, add_hook, remove_hook
+from rcs_latexdiff.shards import shard_documents
+from rcs_latexdiff.utils import CommandResult
+
+from .support import GitRepoTestCase
+
+
+class TestProfiler(unittest.TestCase):
+  def test_no_hook(self):
+    with Span('stage', 'test') as span:
+      pass
+    self.assertIsNone(span.start)
+
+  def test_hook(self):
+    events = []
+    add_hook(events.append)
+    try:
+      with Span('stage', 'test', file='a.tex') as span:
+        span.args['bytes'] = 3
+      with self.assertRaises(ValueError):
+        with Span('failing', 'test'):
+          raise ValueError()
+    finally:
+      remove_hook(events.append)
+
+    self.assertEqual([event['name'] for event in events], ['stage', 'failing'])
+    self.assertEqual(events[0]['args'], {'file': 'a.tex', 'bytes': 3})
+    self.assertEqual(events[1]['args'], {'error': 'ValueError'})
+    self.assertGreaterEqual(events[0]['duration'], 0)
+
+  def test_trace_and_summary(self):
+    with Profiler() as profiler:
+      for i in range(2):
+        with Span('show_file', 'rcs') as span:
+          span.args['bytes'] = 10
+    with Span('ignored', 'rcs'):
+      pass
+
+    trace = profiler.trace()
+    self.assertEqual(len(trace['traceEvents']), 2)
+    self.assertEqual(set(trace['traceEvents'][0]), set(['name', 'cat', 'ph', 'ts', 'dur', 'pid', 'tid', 'args']))
+    self.assertEqual(trace['traceEvents'][0]['ts'], 0)
+    lines = profiler.summary().splitlines()
+    self.assertEqual(len(lines), 2)
+    self.assertEqual(lines[1].split()[:3] + lines[1].split()[-1:], ['rcs', 'show_file', '2', '20'])
+
+    filename = tempfile.mktemp(suffix='.json')
+    try:
+      profiler.write(filename)
+      with open(filename) as f:
+        self.assertEqual(json.load(f), trace)
+    finally:
+      os.remove(filename)
+
+
+class TestInstrumentation(GitRepoTestCase):
+  revisions = ({'main.tex': 'A\n\\input{chapter.tex}\n', 'chapter.tex': u'Caf\xe9\n'},)
+
+  def test_flatten_spans(self):
+    output = os.path.join(self.path, 'flat.tex')
+    with Profiler() as profiler:
+      graph = IncludeGraph(self.git, self.path, '', 'HEAD')
+      graph.build('main.tex')
+      graph.write(output)
+
+    names = [event['name'] for event in profiler.spans]
+    self.assertEqual(sorted(names), ['build', 'include', 'show_file', 'show_file', 'write'])
+    reads = dict((event['args']['file'], event['args']['bytes']) for event in profiler.spans
+                 if event['name'] == 'show_file')
+    self.assertEqual(sorted(reads), ['chapter.tex', 'main.tex'])
+    self.assertGreater(reads['main.tex'], reads['chapter.tex'])
+    # Bytes read, not characters
+    self.assertEqual(reads['chapter.tex'], len(u'Caf\xe9'.encode('utf-8')))
+
+  def test_sharded_diff_spans(self):
+    old = '\\begin{document}\n\\section{One}\nOne\n\\section{Two}\nTwo\n\\end{document}\n'
+    new = old.replace('One\n', 'One, modified\n').replace('Two\n', 'Two, modified\n')
+
+    def fake_execute(argv, cwd=None, stdout=None, env=None):
+      # Stands for latexdiff: the diff is the new shard
+      with open(argv[-1], 'rb') as f:
+        stdout.write(f.read())
+      return CommandResult(argv, 0, b'', b'')
+
+    diff_filename = os.path.join(self.path, 'diff.tex')
+    with mock.patch.object(rcs_latexdiff, 'execute', side_effect=fake_execute):
+      with Profiler() as profiler:
+        self.assertTrue(rcs_latexdiff.exec_sharded_diff(old, new, diff_filename, '', jobs=2))
+
+    shards = [event['args']['file'] for event in profiler.spans if event['name'] == 'latexdiff']
+    self.assertEqual(len(shards), len(shard_documents(old, new)))
+
+  def test_profile_argument(self):
+    args = rcs_latexdiff.parse_arguments(['--profile', 'main.tex', 'HEAD'])
+    self.assertEqual((args.profile, args.FILE), (rcs_latexdiff.DEFAULT_PROFILE, 'main.tex'))
+    args = rcs_latexdiff.parse_arguments(['--profile=trace.json', 'main.tex', 'HEAD'])
+    self.assertEqual(args.profile, 'trace.json')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,267 @@
+import os
+import tempfile
+import unittest
+import distutils.spawn
+try:
+  from unittest import mock
+except ImportError:
+  import mock
+
+from rcs_latexdiff import rcs
+from rcs_latexdiff.cache import Cache
+from rcs_latexdiff.rcs_latexdiff import get_file
+
+from .support import GitRepoTestCase, make_git_repo, make_svn_repo, make_hg_repo, remove_repo, write_files, git, svn, hg
+
+files = {
+  'main.tex': '\\documentclass{article}\n\\begin{document}\n\\input{chapter}\n\\end{document}\n',
+  'chapter.tex': '  Caf\xe9 au lait  \n\n',
+  'sub/section.tex': 'nested\n',
+  'sub dir/spaced name.tex': 'spaces in path\n',
+  'empty.tex': '',
+}
+
+class TestGitBatchReader(unittest.TestCase):
+  def setUp(self):
+    self.path = make_git_repo(files, {'chapter.tex': 'second revision\n'})
+
+  def tearDown(self):
+    remove_repo(self.path)
+
+  def test_identical_to_git_show(self):
+    batch = rcs.Git(batch=True)
+    process = rcs.Git(batch=False)
+    try:
+      for commit in ['HEAD', 'HEAD~1']:
+        for filename in list(files) + ['missing.tex', 'sub']:
+          self.assertEqual(batch.show_file(self.path, commit, filename),
+                           process.show_file(self.path, commit, filename))
+    finally:
+      batch.close()
+
+  def test_path_with_spaces(self):
+    path = make_git_repo({'sub dir/spaced name.tex': 'spaces in path\n'})
+    git = rcs.Git()
+    try:
+      self.assertEqual(git.show_file(path, 'HEAD', 'sub dir/spaced name.tex'), 'spaces in path')
+    finally:
+      git.close()
+      remove_repo(path)
+
+  def test_single_process(self):
+    git = rcs.Git()
+    git.show_file(self.path, 'HEAD', 'main.tex')
+    reader = git._readers[self.path]
+    process = reader._process
+    git.show_file(self.path, 'HEAD', 'chapter.tex')
+    self.assertIs(reader._process, process)
+
+    git.close()
+    self.assertIsNone(reader._process)
+    self.assertIsNotNone(process.returncode)
+
+  def test_restart_after_close(self):
+    git = rcs.Git()
+    git.close()
+    self.assertEqual(git.show_file(self.path, 'HEAD', 'chapter.tex'), 'second revision')
+    git.close()
+
+  def test_read_blobs(self):
+    binary = bytes(bytearray(range(256))) + b'\n\n'
+    path = make_git_repo({'figure.png': binary, 'main.tex': 'x'})
+    git = rcs.Git()
+    try:
+      for reader in [git, rcs.Git(native=False), rcs.Git(batch=False)]:
+        self.assertEqual(reader.read_blobs(path, 'HEAD', ['figure.png', 'missing.png', 'main.tex']),
+                         {'figure.png': binary, 'main.tex': b'x'})
+        reader.close()
+      self.assertEqual(git.read_blob(path, None, 'figure.png'), binary)
+      self.assertIsNone(git.read_blob(path, None, 'missing.png'))
+    finally:
+      remove_repo(path)
+
+
+class TestGitRevisions(GitRepoTestCase):
+  revisions = ({'a.tex': '1'}, {'a.tex': '2'}, {'a.tex': '3'})
+
+  def setUp(self):
+    super(TestGitRevisions, self).setUp()
+    git(self.path, 'tag', 'v1', 'HEAD~2')
+    git(self.path, 'tag', 'v2', 'HEAD')
+
+  def test_list_revisions(self):
+    head = git(self.path, 'rev-list', '--reverse', 'HEAD').split()
+    self.assertEqual(self.git.list_revisions(self.path, 'HEAD~2..HEAD'), head)
+    self.assertEqual(self.git.list_revisions(self.path, 'HEAD~1..'), head[1:])
+    self.assertIsNone(self.git.list_revisions(self.path, 'HEAD'))
+    self.assertIsNone(self.git.list_revisions(self.path, 'nope..HEAD'))
+
+  def test_resolve_commits(self):
+    head = git(self.path, 'rev-parse', 'HEAD').strip()
+    first = git(self.path, 'rev-parse', 'HEAD~2').strip()
+    self.assertEqual(self.git.resolve_commits(self.path, ['HEAD', 'v1', None, 'nope', head]),
+                     [head, first, None, None, head])
+    self.assertTrue(self.git.is_commit(self.path, 'v2'))
+    self.assertFalse(self.git.is_commit(self.path, 'HEAD:a.tex'))
+
+    # A single git process answers all the lookups
+    self.assertEqual(list(self.git._check_readers), [self.path])
+
+  def test_list_tags(self):
+    self.assertEqual(self.git.list_tags(self.path), ['v1', 'v2'])
+
+class TestFindRepository(unittest.TestCase):
+  def setUp(self):
+    self.path = os.path.realpath(make_git_repo({'doc/chapters/intro.tex': 'intro\n'}))
+    rcs._repositories.clear()
+
+  def tearDown(self):
+    rcs._repositories.clear()
+    remove_repo(self.path)
+
+  def test_nested_directory(self):
+    found, root = rcs.find_repository(os.path.join(self.path, 'doc', 'chapters'))
+    self.assertIsInstance(found, rcs.Git)
+    self.assertEqual(root, self.path)
+    self.assertIsInstance(rcs.get_rcs_class(os.path.join(self.path, 'doc')), rcs.Git)
+
+  def test_cached_for_visited_directories(self):
+    rcs.find_repository(os.path.join(self.path, 'doc', 'chapters'))
+    self.assertIn(os.path.join(self.path, 'doc'), rcs._repositories)
+    self.assertEqual(rcs._repositories[os.path.join(self.path, 'doc')][1], self.path)
+
+  def test_gitfile(self):
+    worktree = tempfile.mkdtemp(prefix='rcs-latexdiff-test-')
+    try:
+      with open(os.path.join(worktree, '.git'), 'w') as f:
+        f.write('gitdir: %s\n' % os.path.join(self.path, '.git'))
+      found, root = rcs.find_repository(worktree)
+      self.assertIsInstance(found, rcs.Git)
+      self.assertEqual(root, os.path.abspath(worktree))
+    finally:
+      remove_repo(worktree)
+
+  def test_ambiguous(self):
+    os.mkdir(os.path.join(self.path, '.svn'))
+    self.assertEqual(rcs.find_repository(self.path), (None, None))
+    # Left to the RCS commands, svn is not a valid repository here
+    self.assertIsInstance(rcs.get_rcs_class(self.path), rcs.Git)
+
+  def test_no_repository(self):
+    path = tempfile.mkdtemp(prefix='rcs-latexdiff-test-')
+    try:
+      self.assertIsNone(rcs.find_repository(path)[0])
+    finally:
+      remove_repo(path)
+
+  def test_relative_paths(self):
+    git = rcs.Git()
+    root, relative, filename = git.get_relative_paths(os.path.join(self.path, 'doc', 'chapters', 'intro.tex'))
+    self.assertEqual((root, relative, filename), (self.path, os.path.join('doc', 'chapters'), 'intro.tex'))
+
+@unittest.skipUnless(distutils.spawn.find_executable('svnadmin'), 'svn not found')
+class TestSVN(unittest.TestCase):
+  def setUp(self):
+    self.path, self.wc = make_svn_repo(files, {'chapter.tex': 'second revision\n'})
+
+  def tearDown(self):
+    remove_repo(self.path)
+
+  def test_export_identical_to_svn_cat(self):
+    export = rcs.SVN()
+    cat = rcs.SVN(export=False)
+    try:
+      for commit in ['1', '2']:
+        for filename in list(files) + ['missing.tex', 'sub']:
+          self.assertEqual(export.show_file(self.wc, commit, filename),
+                           cat.show_file(self.wc, commit, filename))
+    finally:
+      export.close()
+
+  def test_single_export_per_revision(self):
+    repo = rcs.SVN()
+    with mock.patch('rcs_latexdiff.rcs.execute', wraps=rcs.execute) as execute:
+      for filename in files:
+        repo.show_file(self.wc, '2', filename)
+      commands = [call[0][0][1] for call in execute.call_args_list]
+    self.assertEqual(commands.count('export'), 1)
+    self.assertNotIn('cat', commands)
+
+    directory = repo._exports[(self.wc, '2')]
+    repo.close()
+    self.assertFalse(os.path.exists(directory))
+
+  def test_cached_revision_needs_no_server(self):
+    cache = Cache(os.path.join(self.path, 'cache'))
+    expected = get_file(rcs.SVN(), self.wc, '', '2', 'main.tex', cache=cache)
+
+    repo = rcs.SVN()
+    with mock.patch('rcs_latexdiff.rcs.execute', wraps=rcs.execute) as execute:
+      self.assertEqual(get_file(repo, self.wc, '', '2', 'main.tex', cache=cache), expected)
+      commands = [call[0][0][1] for call in execute.call_args_list]
+    # Only the local 'svn info' of the working copy
+    self.assertEqual(commands, ['info'])
+    repo.close()
+
+  def test_moving_revisions(self):
+    repo = rcs.SVN()
+    self.assertEqual(repo.resolve_commit(self.wc, 'HEAD'), '2')
+    write_files(self.wc, {'chapter.tex': 'third revision\n'})
+    svn(self.wc, 'commit', '-q', '-m', 'revision 3')
+    self.assertEqual(repo.resolve_commit(self.wc, 'HEAD'), '3')
+    repo.close()
+
+@unittest.skipUnless(distutils.spawn.find_executable('hg'), 'hg not found')
+class TestHg(unittest.TestCase):
+  def setUp(self):
+    self.path = os.path.realpath(make_hg_repo(files, {'chapter.tex': 'second revision\n'}))
+    hg(self.path, 'tag', 'v1', '-r', '0')
+    self.hg = rcs.Hg()
+
+  def tearDown(self):
+    self.hg.close()
+    remove_repo(self.path)
+
+  def test_identical_to_hg_cat(self):
+    process = rcs.Hg(server=False)
+    for commit in ['0', '1']:
+      for filename in list(files) + ['missing.tex']:
+        self.assertEqual(self.hg.show_file(self.path, commit, filename),
+                         process.show_file(self.path, commit, filename))
+    self.assertEqual(self.hg.show_file(self.path, '0', 'sub dir/spaced name.tex'), 'spaces in path')
+    self.assertEqual(self.hg.show_file(self.path, '1', 'chapter.tex'), 'second revision')
+
+  def test_single_process(self):
+    self.hg.show_file(self.path, '0', 'main.tex')
+    server = self.hg._servers[self.path]
+    process = server._process
+    self.hg.show_file(self.path, '1', 'chapter.tex')
+    self.assertIs(server._process, process)
+
+    self.hg.close()
+    self.assertIsNone(server._process)
+    self.assertIsNotNone(process.returncode)
+
+  def test_resolve_commits(self):
+    nodes = hg(self.path, 'log', '-r', '0:1', '--template', '{node}\n').split()
+    self.assertEqual(self.hg.resolve_commits(self.path, ['0', 'v1', 'missing']), [nodes[0], nodes[0], None])
+    self.assertEqual(self.hg.list_revisions(self.path, '0::1'), nodes)
+    self.assertEqual(self.hg.list_tags(self.path), ['v1'])
+    self.assertEqual(self.hg.file_id(self.path, '1', 'main.tex'), 'hg:%s:main.tex' % nodes[1])
+
+  def test_moving_revisions(self):
+    tip = self.hg.resolve_commit(self.path, 'tip')
+    write_files(self.path, {'chapter.tex': 'third revision\n'})
+    hg(self.path, 'commit', '-q', '-m', 'revision 2')
+    self.assertNotEqual(self.hg.resolve_commit(self.path, 'tip'), tip)
+    self.assertEqual(self.hg.resolve_commit(self.path, tip), tip)
+
+  def test_detection(self):
+    rcs._repositories.clear()
+    self.assertIsInstance(rcs.get_rcs_class(os.path.join(self.path, 'sub')), rcs.Hg)
+    root, relative, filename = self.hg.get_relative_paths(os.path.join(self.path, 'sub', 'section.tex'))
+    self.assertEqual((root, relative, filename), (self.path, 'sub', 'section.tex'))
+    rcs._repositories.clear()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,356 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+try:
+  from unittest import mock
+except ImportError:
+  import mock
+from concurrent.futures import ThreadPoolExecutor
+
+from rcs_latexdiff import rcs_latexdiff
+from rcs_latexdiff.build import CompileError
+from rcs_latexdiff.cache import Cache, MemoryCache
+from rcs_latexdiff.shards import shard_documents
+
+from .support import CountingGit, GitRepoTestCase, make_args, remove_repo, git
+
+old_files = {
+  'main.tex': 'Intro\n\\input{a}\nMiddle % comment\n\\include{b.tex}\n\\input{a}\nEnd\n',
+  'a.tex': 'Content of a\n\\input{c}\n',
+  'b.tex': 'Content of b\n',
+  'c.tex': 'Content of c\n',
+}
+
+new_files = {
+  'a.tex': 'New content of a\n\\input{c}\n\\input{missing}\n',
+}
+
+expected_new = """Intro
+% Input a.tex
+New content of a
+% Input c.tex
+Content of c
+
+% End of Input c.tex
+% Input missing.tex
+
+% End of Input missing.tex
+
+% End of Input a.tex
+Middle 
+% Input b.tex
+Content of b
+
+% End of Input b.tex
+% Input a.tex
+New content of a
+% Input c.tex
+Content of c
+
+% End of Input c.tex
+% Input missing.tex
+
+% End of Input missing.tex
+
+% End of Input a.tex
+End
+"""
+
+
+class TestGetFile(GitRepoTestCase):
+  revisions = (old_files, new_files)
+
+  def test_working_copy(self):
+    content = rcs_latexdiff.get_file(self.git, self.path, '', None, 'main.tex')
+    self.assertEqual(content, expected_new)
+
+  def test_concurrent_is_identical(self):
+    for commit in ['HEAD~1', 'HEAD', None]:
+      sequential = rcs_latexdiff.get_file(self.git, self.path, '', commit, 'main.tex')
+      with ThreadPoolExecutor(max_workers=4) as executor:
+        concurrent = rcs_latexdiff.get_file(self.git, self.path, '', commit, 'main.tex', executor)
+      self.assertEqual(sequential, concurrent)
+
+  def test_get_graphs_concurrently(self):
+    old, new = rcs_latexdiff.get_graphs_concurrently(self.git, self.path, '', ['HEAD~1', None], 'main.tex', 2)
+    self.assertEqual(old.expand(), rcs_latexdiff.get_file(self.git, self.path, '', 'HEAD~1', 'main.tex'))
+    self.assertEqual(new.expand(), rcs_latexdiff.get_file(self.git, self.path, '', None, 'main.tex'))
+
+class TestResultCache(GitRepoTestCase):
+  def setUp(self):
+    super(TestResultCache, self).setUp()
+    self.cache_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.cache_dir)
+
+  def run_diff(self, old, new=None, *options):
+    args = make_args(*(list(options) + [os.path.join(self.path, 'main.tex'), old] + ([new] if new else [])))
+
+    def fake_diff(old_filename, new_filename, diff_filename, latexdiff_args):
+      with open(diff_filename, 'w') as f:
+        f.write('diff of %s' % args.OLD)
+
+    with mock.patch.object(rcs_latexdiff, 'exec_diff', side_effect=fake_diff) as exec_diff:
+      rcs_latexdiff.run(self.git, args, Cache(self.cache_dir))
+    with open(os.path.join(self.path, 'diff.tex')) as f:
+      return exec_diff.call_count, f.read()
+
+  def test_result_cache(self):
+    self.assertEqual(self.run_diff('HEAD~1', 'HEAD'), (1, 'diff of HEAD~1'))
+    # Same commits under other names
+    self.assertEqual(self.run_diff(git(self.path, 'rev-parse', 'HEAD~1').strip(), 'HEAD')[0], 0)
+    self.assertEqual(self.run_diff('HEAD~1', 'HEAD', '--utf8'), (1, 'diff of HEAD~1'))
+    self.assertEqual(self.run_diff('HEAD~1', 'HEAD', '--rebuild'), (1, 'diff of HEAD~1'))
+    self.assertEqual(self.run_diff('HEAD'), (1, 'diff of HEAD'))
+
+  def test_safer_diff_has_its_own_key(self):
+    args = make_args('--dirty', os.path.join(self.path, 'main.tex'), 'HEAD~1', 'HEAD')
+    args.makepdf = True
+    compiles = []
+
+    def fake_diff(old_filename, new_filename, diff_filename, latexdiff_args):
+      with open(diff_filename, 'w') as f:
+        f.write('safe diff' if rcs_latexdiff.SAFE_LATEXDIFF_ARGS in latexdiff_args else 'diff')
+
+    def fake_pdflatex(tex_filename, src_path, repeat=1, keep=False, cwd=None):
+      # Only the diff made with the safer arguments compiles
+      compiles.append(tex_filename)
+      with open(tex_filename) as f:
+        if f.read() != 'safe diff':
+          raise CompileError('pdflatex pass 1', '! Emergency stop.', 0.1)
+      pdf_filename = os.path.splitext(tex_filename)[0] + '.pdf'
+      open(pdf_filename, 'w').close()
+      return pdf_filename
+
+    for expected_diffs in [2, 0]:
+      with mock.patch.object(rcs_latexdiff, 'exec_diff', side_effect=fake_diff) as exec_diff, \
+          mock.patch.object(rcs_latexdiff, 'choose_compiler', return_value=fake_pdflatex):
+        rcs_latexdiff.run(self.git, args, Cache(self.cache_dir))
+      self.assertEqual(exec_diff.call_count, expected_diffs)
+
+    # The safer diff is reused as such, never as the diff, nor is its pdf
+    self.assertEqual(len(compiles), 4)
+    with open(os.path.join(self.path, 'diff.tex')) as f:
+      self.assertEqual(f.read(), 'safe diff')
+
+
+class TestStitchDiff(unittest.TestCase):
+  def test_stitch_diff(self):
+    path = tempfile.mkdtemp()
+    filename = os.path.join(path, 'diff.tex')
+    try:
+      with open(filename, 'wb') as f:
+        f.write(b'\\DIFadd{x}\n\\rcslatexdiffunchanged{0}\n')
+      self.assertTrue(rcs_latexdiff.stitch_diff(filename, {'\\rcslatexdiffunchanged{0}': u'Caf\xe9'}))
+      with open(filename, 'rb') as f:
+        self.assertEqual(f.read().decode('utf-8'), u'\\DIFadd{x}\nCaf\xe9\n')
+
+      self.assertFalse(rcs_latexdiff.stitch_diff(filename, {'\\rcslatexdiffunchanged{1}': 'lost'}))
+
+      # A placeholder both deleted and added is not put back twice
+      with open(filename, 'wb') as f:
+        f.write(b'\\DIFdel{\\rcslatexdiffunchanged{0}}\\DIFadd{\\rcslatexdiffunchanged{0}}\n')
+      self.assertFalse(rcs_latexdiff.stitch_diff(filename, {'\\rcslatexdiffunchanged{0}': 'twice'}))
+    finally:
+      remove_repo(path)
+
+
+def copy_diff(old_filename, new_filename, diff_filename, latexdiff_args):
+  """ Stands for latexdiff: the diff is the new document """
+  shutil.copyfile(new_filename, diff_filename)
+
+
+def replace_diff(old_filename, new_filename, diff_filename, latexdiff_args):
+  """ Stands for latexdiff: the whole old document deleted, the new one added """
+  with open(old_filename) as old, open(new_filename) as new, open(diff_filename, 'w') as diff:
+    diff.write('\\DIFdel{%s}\\DIFadd{%s}' % (old.read(), new.read()))
+
+
+class TestIncrementalDiff(GitRepoTestCase):
+  revisions = ({
+    'main.tex': '\\input{macros.tex}\n\\begin{document}\n\\input{one.tex}\n\\input{two.tex}\n\\end{document}\n',
+    'macros.tex': '\\newcommand{\\x}{x}\n',
+    'one.tex': 'One\n\\input{sub.tex}\n',
+    'sub.tex': 'Sub\n',
+    'two.tex': 'Two\n',
+  }, {
+    'two.tex': 'Two, modified\n',
+  })
+
+  def make_diff(self, latexdiff, incremental):
+    dst_filename = os.path.join(self.path, 'diff.tex')
+    with mock.patch.object(rcs_latexdiff, 'exec_diff', side_effect=latexdiff) as exec_diff:
+      rcs_latexdiff.make_diff(self.git, 'HEAD~1', 'HEAD', self.path, '', 'main.tex', dst_filename, '',
+                              incremental=incremental)
+    with open(dst_filename) as f:
+      return f.read(), exec_diff.call_count
+
+  def test_same_as_full_diff(self):
+    diff, calls = self.make_diff(copy_diff, True)
+    self.assertEqual(calls, 1)
+    self.assertEqual(diff, self.make_diff(copy_diff, False)[0])
+
+  def test_placeholder_twice_falls_back(self):
+    diff, calls = self.make_diff(replace_diff, True)
+    self.assertEqual(calls, 2)
+    self.assertEqual(diff, self.make_diff(replace_diff, False)[0])
+    self.assertNotIn('rcslatexdiffunchanged', diff)
+
+
+class TestMakeSeries(GitRepoTestCase):
+  revisions = ({'main.tex': 'One\n'}, {'main.tex': 'Two\n'}, {'main.tex': 'Three\n'})
+  git_class = CountingGit
+
+  def test_snapshots_are_shared(self):
+    revisions = self.git.list_revisions(self.path, 'HEAD~2..HEAD')
+    output_dir = os.path.join(self.path, 'diffs')
+    summary = rcs_latexdiff.make_series(self.git, revisions, self.path, '', 'main.tex', output_dir, '',
+                                        jobs=2, clean=False)
+
+    # Each revision is read once
+    self.assertEqual(sorted(self.git.reads), sorted((revision, 'main.tex') for revision in revisions))
+
+    labels = [revision[:7] for revision in revisions]
+    self.assertEqual([entry['tex'] for entry in summary], [
+      os.path.join(output_dir, 'diff-%s-%s.tex' % (labels[0], labels[1])),
+      os.path.join(output_dir, 'diff-%s-%s.tex' % (labels[1], labels[2])),
+    ])
+    with open(os.path.join(output_dir, 'snapshot-%s.tex' % labels[1])) as f:
+      self.assertEqual(f.read(), 'Two')
+    with open(os.path.join(output_dir, 'index.json')) as f:
+      self.assertEqual(json.load(f)['revisions'], revisions)
+
+  def test_failed_compile_keeps_the_diff(self):
+    revisions = self.git.list_revisions(self.path, 'HEAD~2..HEAD')
+    output_dir = os.path.join(self.path, 'diffs')
+
+    def fake_pdflatex(tex_filename, src_path, repeat=1, keep=False, cwd=None):
+      # Only the diff with the last revision compiles
+      pdf_filename = os.path.splitext(tex_filename)[0] + '.pdf'
+      with open(tex_filename) as f:
+        if f.read() == 'Three':
+          open(pdf_filename, 'w').close()
+      return pdf_filename
+
+    with mock.patch.object(rcs_latexdiff, 'exec_diff', side_effect=copy_diff):
+      summary = rcs_latexdiff.make_series(self.git, revisions, self.path, '', 'main.tex', output_dir, '',
+                                          exec_fcn=fake_pdflatex)
+
+    self.assertIsNone(summary[0]['pdf'])
+    self.assertTrue(os.path.isfile(summary[0]['tex']))
+    self.assertIsNone(summary[1]['tex'])
+    self.assertTrue(os.path.isfile(summary[1]['pdf']))
+
+class TestAssets(GitRepoTestCase):
+  revisions = (
+    {'doc/main.tex': '\\includegraphics{figs/old}\n\\includegraphics{figs/plot}\n\\bibliography{refs}\n',
+     'doc/figs/old.png': b'old figure', 'doc/figs/plot.pdf': b'plot 1', 'doc/refs.bib': b'@book{a}',
+     'doc/unused.png': b'unused'},
+    {'doc/main.tex': '\\includegraphics{figs/plot}\n\\bibliography{refs}\n', 'doc/figs/plot.pdf': b'plot 2'})
+
+  def setUp(self):
+    super(TestAssets, self).setUp()
+    self.store = rcs_latexdiff.get_asset_store()
+    self.addCleanup(self.store.cleanup)
+
+  def test_materialize_assets(self):
+    # The working copy has moved on: the commits must be compiled with their own files
+    with open(os.path.join(self.path, 'doc', 'figs', 'plot.pdf'), 'wb') as f:
+      f.write(b'working copy')
+
+    graphs = rcs_latexdiff.get_graphs(self.git, self.path, 'doc', 'HEAD~1', 'HEAD', 'main.tex')
+    tree = rcs_latexdiff.materialize_assets(self.git, self.path, 'doc', graphs, self.store)
+
+    files = {}
+    for dirpath, dirnames, filenames in os.walk(tree):
+      for filename in filenames:
+        with open(os.path.join(dirpath, filename), 'rb') as f:
+          files[os.path.relpath(os.path.join(dirpath, filename), tree)] = f.read()
+    self.assertEqual(files, {os.path.join('figs', 'old.png'): b'old figure',
+                             os.path.join('figs', 'plot.pdf'): b'plot 2', 'refs.bib': b'@book{a}'})
+
+    src_path = os.path.join(self.path, 'doc')
+    self.assertEqual(rcs_latexdiff.compile_search_path(self.path, 'doc', 'HEAD', tree), [tree, src_path])
+    self.assertEqual(rcs_latexdiff.compile_search_path(self.path, 'doc', None, tree), [src_path, tree])
+
+  def test_assets_key(self):
+    graphs = rcs_latexdiff.get_graphs(self.git, self.path, 'doc', 'HEAD', None, 'main.tex')
+    key = rcs_latexdiff.get_assets_key(self.git, self.path, 'doc', graphs)
+    self.assertIsNotNone(key)
+    self.assertEqual(rcs_latexdiff.get_assets_key(self.git, self.path, 'doc', graphs), key)
+
+    # Editing a figure or a bibliography of the working copy changes the pdf
+    with open(os.path.join(self.path, 'doc', 'refs.bib'), 'wb') as f:
+      f.write(b'@book{a, year=2000}')
+    self.assertNotEqual(rcs_latexdiff.get_assets_key(self.git, self.path, 'doc', graphs), key)
+
+  def test_store_in_cache(self):
+    cache = Cache(tempfile.mkdtemp())
+    try:
+      store = rcs_latexdiff.get_asset_store(MemoryCache(backend=cache))
+      self.assertEqual(store.path, os.path.join(cache.path, 'blob'))
+      self.assertFalse(store.temporary)
+    finally:
+      shutil.rmtree(cache.path)
+
+
+class TestInlineBbl(GitRepoTestCase):
+  revisions = ({'main.tex': 'Text\n\\bibliography{refs}\n', 'main.bbl': '\\bibitem{a} Old entry\n'},
+               {'main.bbl': '\\bibitem{a} New entry\n'})
+
+  def test_inline_bbl(self):
+    old, new = rcs_latexdiff.get_graphs(self.git, self.path, '', 'HEAD~1', 'HEAD', 'main.tex', inline_bbl=True)
+    self.assertEqual(old.expand(), 'Text\n\\bibitem{a} Old entry\n')
+    self.assertEqual(new.expand(), 'Text\n\\bibitem{a} New entry\n')
+    self.assertEqual(rcs_latexdiff.watched_files(new), [os.path.join(self.path, 'main.bbl'),
+                                                        os.path.join(self.path, 'main.tex')])
+
+  def test_missing_bbl(self):
+    git(self.path, 'rm', '-q', 'main.bbl')
+    git(self.path, 'commit', '-q', '-m', 'no bbl')
+    graph = rcs_latexdiff.get_graph(self.git, self.path, '', 'HEAD', 'main.tex', inline_bbl=True)
+    self.assertEqual(graph.expand(), 'Text\n\\bibliography{refs}')
+    self.assertIsNone(graph.bibliography)
+
+
+class TestWatch(GitRepoTestCase):
+  revisions = ({
+    'main.tex': '\\documentclass{article}\n\\begin{document}\n\\input{one.tex}\n\\input{two}\n\\end{document}\n',
+    'one.tex': '\\section{One}\nOne\n',
+  },)
+
+  def test_watched_files(self):
+    graph = rcs_latexdiff.get_graph(self.git, self.path, '', None, 'main.tex')
+    self.assertEqual(rcs_latexdiff.watched_files(graph),
+                     [os.path.join(self.path, name) for name in ['main.tex', 'one.tex', 'two', 'two.tex']])
+
+  def test_wait_for_changes(self):
+    filenames = [os.path.join(self.path, 'one.tex'), os.path.join(self.path, 'two.tex')]
+
+    def save():
+      with open(filenames[1], 'w') as f:
+        f.write('Two\n')
+
+    timer = threading.Timer(0.05, save)
+    timer.start()
+    self.assertEqual(rcs_latexdiff.wait_for_changes(filenames, interval=0.01, debounce=0.01), filenames[1:])
+    timer.join()
+
+  def test_unchanged_shards_are_reused(self):
+    old = '\\begin{document}\n\\section{One}\nOne\n\\section{Two}\nTwo\n\\end{document}\n'
+    new = old.replace('Two\n', 'Two, modified\n')
+    cache = MemoryCache()
+    for old_shard, new_shard in shard_documents(old, new):
+      cache.put('shard', rcs_latexdiff.get_shard_key(old_shard, new_shard, ''), new_shard)
+
+    diff_filename = os.path.join(self.path, 'diff.tex')
+    with mock.patch.object(rcs_latexdiff, 'exec_diff') as exec_diff:
+      self.assertTrue(rcs_latexdiff.exec_sharded_diff(old, new, diff_filename, '', cache=cache))
+    self.assertEqual(exec_diff.call_count, 0)
+    with open(diff_filename) as f:
+      self.assertEqual(f.read(), new)
+
+if __name__ == '__main__':
+    unittest.main()
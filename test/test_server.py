@@ -0,0 +1,144 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+try:
+  from unittest import mock
+except ImportError:
+  import mock
+
+from rcs_latexdiff import rcs_latexdiff
+from rcs_latexdiff.cache import MemoryCache
+from rcs_latexdiff.server import DiffServer, send_job
+
+from .support import GitRepoTestCase, make_args, remove_repo, write_files, git
+
+
+class TestDiffServer(unittest.TestCase):
+  def setUp(self):
+    self.path = tempfile.mkdtemp()
+    self.socket = os.path.join(self.path, 'daemon.sock')
+
+  def tearDown(self):
+    shutil.rmtree(self.path)
+
+  def serve(self, handler, workers=1):
+    server = DiffServer(self.socket, handler, workers)
+    server.bind()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+
+    def stop():
+      server.shutdown()
+      thread.join()
+      server.close()
+    self.addCleanup(stop)
+    return server
+
+  def test_round_trip(self):
+    self.serve(lambda job: {'ok': True, 'echo': job['value']})
+    self.assertEqual(send_job(self.socket, {'value': 42}), {'ok': True, 'echo': 42})
+
+  def test_failing_job(self):
+    def handler(job):
+      raise ValueError('broken job')
+    self.serve(handler)
+    self.assertEqual(send_job(self.socket, {}), {'ok': False, 'error': 'broken job'})
+
+  def test_identical_jobs_are_joined(self):
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def handler(job):
+      calls.append(job)
+      started.set()
+      release.wait()
+      return {'ok': True}
+
+    server = DiffServer(self.socket, handler, workers=2)
+    first = server.submit({'file': 'a.tex', 'old': 'HEAD'})
+    started.wait()
+    second = server.submit({'old': 'HEAD', 'file': 'a.tex'})
+    other = server.submit({'file': 'b.tex', 'old': 'HEAD'})
+    release.set()
+
+    self.assertIs(first, second)
+    self.assertEqual(other.result(), {'ok': True})
+    self.assertEqual(len(calls), 2)
+    server.close()
+
+  def test_already_running(self):
+    self.serve(lambda job: {})
+    self.assertRaises(IOError, DiffServer(self.socket, None).bind)
+
+
+class TestRunJob(GitRepoTestCase):
+  def test_run_job(self):
+    job = vars(make_args(os.path.join(self.path, 'main.tex'), 'HEAD~1', 'HEAD'))
+
+    def fake_diff(old_filename, new_filename, diff_filename, latexdiff_args):
+      with open(diff_filename, 'w') as f:
+        f.write('diff')
+
+    with mock.patch.object(rcs_latexdiff, 'exec_diff', side_effect=fake_diff):
+      result = rcs_latexdiff.run_job(job, MemoryCache())
+    self.assertEqual(result, {'ok': True, 'tex': os.path.join(self.path, 'diff.tex'), 'pdf': None})
+
+    job['OLD'] = 'missing'
+    self.assertFalse(rcs_latexdiff.run_job(job, MemoryCache())['ok'])
+
+  def test_new_repository(self):
+    path = tempfile.mkdtemp(prefix='rcs-latexdiff-test-')
+    self.addCleanup(remove_repo, path)
+    write_files(path, {'main.tex': 'One\n'})
+    job = vars(make_args(os.path.join(path, 'main.tex'), 'HEAD'))
+    self.assertEqual(rcs_latexdiff.run_job(job, MemoryCache())['error'], "No RCS repository found")
+
+    # The daemon notices the repository created since
+    git(path, 'init', '-q')
+    git(path, 'add', '-A')
+    git(path, 'commit', '-q', '-m', 'revision 0')
+    with mock.patch.object(rcs_latexdiff, 'exec_diff'):
+      self.assertTrue(rcs_latexdiff.run_job(job, MemoryCache())['ok'])
+
+class TestConcurrentJobs(GitRepoTestCase):
+  revisions = ({'main.tex': 'One\n'}, {'main.tex': 'Two\n'}, {'main.tex': 'Three\n'})
+
+  def test_jobs_writing_the_same_diff(self):
+    socket = os.path.join(self.path, 'daemon.sock')
+    filename = os.path.join(self.path, 'main.tex')
+    running, overlaps = [], []
+
+    def fake_diff(old_filename, new_filename, diff_filename, latexdiff_args):
+      # Both jobs write diff.tex, diff.tex.old and diff.tex.new
+      running.append(new_filename)
+      overlaps.append(len(running) > 1)
+      with open(new_filename) as f:
+        new = f.read()
+      time.sleep(0.1)
+      with open(new_filename) as f:
+        overlaps.append(f.read() != new)
+      with open(diff_filename, 'w') as f:
+        f.write('diff with %s' % new)
+      running.remove(new_filename)
+
+    def handler(job):
+      result = rcs_latexdiff.run_job(job, MemoryCache())
+      with open(result['tex']) as f:
+        result['content'] = f.read()
+      return result
+
+    server = DiffServer(socket, handler, workers=2)
+    with mock.patch.object(rcs_latexdiff, 'exec_diff', side_effect=fake_diff):
+      first = server.submit(vars(make_args(filename, 'HEAD~2', 'HEAD~1')))
+      second = server.submit(vars(make_args(filename, 'HEAD~1', 'HEAD')))
+      results = [first.result(), second.result()]
+    server.close()
+
+    self.assertEqual([result['content'] for result in results], ['diff with Two', 'diff with Three'])
+    self.assertFalse(any(overlaps))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+import distutils.spawn
+import os
+import shutil
+import tempfile
+import unittest
+
+from rcs_latexdiff import rcs_latexdiff
+from rcs_latexdiff.shards import align_shards, shard_documents, join_diffs
+
+old_document = r"""\documentclass{article}
+\begin{document}
+Abstract
+\section{Introduction}
+Old introduction
+\section*{Results}
+Old results
+\section{Conclusion}
+Conclusion
+\end{document}
+"""
+
+new_document = r"""\documentclass{article}
+\begin{document}
+Abstract
+\section{Introduction}
+New introduction
+\section{Method}
+Method
+\section*{Results}
+New results
+\section{Conclusion}
+Conclusion
+\end{document}
+"""
+
+
+class TestShards(unittest.TestCase):
+  def test_align_shards(self):
+    shards = align_shards(old_document, new_document)
+    self.assertEqual(len(shards), 4)
+    self.assertEqual(''.join(old for old, new in shards), old_document)
+    self.assertEqual(''.join(new for old, new in shards), new_document)
+    self.assertEqual(shards[1], ('\\section{Introduction}\nOld introduction\n',
+                                 '\\section{Introduction}\nNew introduction\n\\section{Method}\nMethod\n'))
+
+  def test_ambiguous_headings(self):
+    old = '\\section{A}\nx\n\\section{A}\ny\n'
+    new = '\\section{A}\nx\n\\section{A}\nz\n'
+    self.assertEqual(align_shards(old, new), [(old, new)])
+
+  def test_shard_documents(self):
+    shards = shard_documents(old_document, new_document)
+    self.assertEqual(len(shards), 4)
+    for old, new in shards:
+      self.assertTrue(old.startswith('\\documentclass{article}\n\\begin{document}'))
+      self.assertTrue(new.endswith('\\end{document}\n'))
+
+    self.assertEqual(join_diffs([new for old, new in shards]), new_document)
+    self.assertIsNone(shard_documents('no body', new_document))
+
+  @unittest.skipUnless(distutils.spawn.find_executable('latexdiff'), 'latexdiff not found')
+  def test_same_as_unsharded(self):
+    path = tempfile.mkdtemp()
+    try:
+      old_filename, new_filename = os.path.join(path, 'old.tex'), os.path.join(path, 'new.tex')
+      rcs_latexdiff.write_file(old_document, old_filename)
+      rcs_latexdiff.write_file(new_document, new_filename)
+
+      unsharded = os.path.join(path, 'unsharded.tex')
+      rcs_latexdiff.exec_diff(old_filename, new_filename, unsharded, '')
+      sharded = os.path.join(path, 'sharded.tex')
+      self.assertTrue(rcs_latexdiff.exec_sharded_diff(old_document, new_document, sharded, '', jobs=2))
+
+      with open(unsharded) as f, open(sharded) as g:
+        self.assertEqual(f.read(), g.read())
+    finally:
+      shutil.rmtree(path)
+
+if __name__ == '__main__':
+    unittest.main()
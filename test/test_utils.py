@@ -1,3 +1,7 @@
+import os
+import sys
+import tempfile
+import time
 import unittest
 from rcs_latexdiff import utils
 
@@ -16,10 +20,112 @@ lorem ipsum 3
 lorem ipsum 5
 """
 
+contentWithVerbatim = r"""Text % comment
+  % indented comment
+\\% comment after a line break
+\begin{verbatim}
+% not a comment \input{kept}
+\end{verbatim}
+\verb|%| and \verb*+\input{kept}+
+\begin{lstlisting}[language=TeX]
+\include{kept} % kept
+\end{lstlisting}
+% last line without newline"""
+
+contentWithVerbatimWithoutComments = r"""Text 
+\\
+\begin{verbatim}
+% not a comment \input{kept}
+\end{verbatim}
+\verb|%| and \verb*+\input{kept}+
+\begin{lstlisting}[language=TeX]
+\include{kept} % kept
+\end{lstlisting}
+"""
+
+contentWithIncludes = r"""\input{a}\include {b.tex}\input
+  { c } \\input{d} \includegraphics{e} \inputfoo{f} % \input{g}
+"""
+
 class TestUtils(unittest.TestCase):
   def test_remove_latex_comments(self):
     parsedContent = utils.remove_latex_comments(contentWithComments)
     self.assertEqual(parsedContent, contentWithoutComments)
 
+  def test_remove_latex_comments_verbatim(self):
+    parsedContent = utils.remove_latex_comments(contentWithVerbatim)
+    self.assertEqual(parsedContent, contentWithVerbatimWithoutComments)
+
+  def test_scan_latex(self):
+    segments = utils.scan_latex(contentWithIncludes)
+    self.assertEqual(segments, [
+      utils.Include(r'\input{a}', 'a'),
+      utils.Include(r'\include {b.tex}', 'b.tex'),
+      utils.Include('\\input\n  { c }', 'c'),
+      r" \\input{d} \includegraphics{e} \inputfoo{f} ",
+      "\n",
+    ])
+    self.assertEqual(''.join(utils.scan_latex(contentWithVerbatim)), contentWithVerbatimWithoutComments)
+
+  def test_scan_latex_verbatim(self):
+    verbatim = [segment for segment in utils.scan_latex(contentWithVerbatim) if isinstance(segment, utils.Verbatim)]
+    self.assertEqual(verbatim, [
+      '\\begin{verbatim}\n% not a comment \\input{kept}\n\\end{verbatim}',
+      r'\verb|%|',
+      r'\verb*+\input{kept}+',
+      '\\begin{lstlisting}[language=TeX]\n\\include{kept} % kept\n\\end{lstlisting}',
+    ])
+
+  def test_find_assets(self):
+    content = ('\\documentclass[a4paper]{thesis}\\usepackage{amsmath, local}\n'
+               '\\graphicspath{{figures/}}\n'
+               '\\includegraphics[width=3cm]{plot}\\includegraphics*{photo.jpg}\n'
+               '\\bibliography{refs,more.bib}\\bibliographystyle{plain}\n')
+    self.assertEqual(utils.find_assets(content), [
+      'thesis.cls', 'amsmath.sty', 'local.sty',
+      'plot.pdf', 'plot.png', 'plot.jpg', 'plot.jpeg', 'plot.eps',
+      'figures/plot.pdf', 'figures/plot.png', 'figures/plot.jpg', 'figures/plot.jpeg', 'figures/plot.eps',
+      'photo.jpg', 'figures/photo.jpg', 'refs.bib', 'more.bib', 'plain.bst',
+    ])
+
+
+class TestExecute(unittest.TestCase):
+  def test_output(self):
+    result = utils.execute([sys.executable, '-c', 'import sys; sys.stdout.write("a b"); sys.stderr.write("err"); sys.exit(3)'])
+    self.assertEqual(result.returncode, 3)
+    self.assertFalse(result.ok)
+    self.assertEqual(result.stdout, b'a b')
+    self.assertEqual(result.text, 'a b')
+    self.assertEqual(result.error_text, 'err')
+
+  def test_watched(self):
+    script = 'import sys, time; print("one"); sys.stderr.write("two\\n"); sys.stdout.flush(); time.sleep(%d)'
+    result = utils.execute_watched([sys.executable, '-c', script % 0])
+    self.assertTrue(result.ok)
+    self.assertIsNone(result.aborted)
+    self.assertEqual(sorted(result.text.split()), ['one', 'two'])
+
+    started = time.time()
+    result = utils.execute_watched([sys.executable, '-c', script % 60],
+                                   watch=lambda line: 'stop' if line.strip() == b'one' else None)
+    self.assertLess(time.time() - started, 30)
+    self.assertEqual(result.aborted, 'stop')
+    self.assertFalse(result.ok)
+
+  def test_cwd_and_redirection(self):
+    path = tempfile.mkdtemp(prefix='with space ')
+    with tempfile.TemporaryFile() as output:
+      result = utils.execute([sys.executable, '-c', 'import os; print(os.getcwd())'], cwd=path, stdout=output)
+      output.seek(0)
+      self.assertTrue(result.ok)
+      self.assertIsNone(result.stdout)
+      self.assertTrue(output.read().strip().endswith(path.split('/')[-1].encode('utf-8')))
+    os.rmdir(path)
+
+  def test_missing_command(self):
+    result = utils.execute(['rcs-latexdiff-no-such-command'])
+    self.assertEqual(result.returncode, 127)
+    self.assertFalse(result.ok)
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file